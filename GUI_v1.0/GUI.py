@@ -485,7 +485,9 @@ class GUI:
                 recording = np.copy(temp)
                 logging.debug("recording copied")
                 
-                self.input_recording = (recording['in'] - self.adc_0) / self.adc_scale
+                # Volts in float32, in place (no float64 temporaries)
+                self.input_recording = np.subtract(recording['in'], self.adc_0, dtype=np.float32)
+                self.input_recording /= self.adc_scale
                 self.output_recording = recording['out']
                 
                 logging.debug("recordings broken up")
@@ -1,4 +1,4 @@
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pool
 import serial
 # import sys
 from serial.tools import list_ports
@@ -31,6 +31,122 @@ class ReadLine:
             else:
                 self.buf.extend(data)
 
+    def read_block(self):
+        """Return every complete line waiting on the port as one bytes block,
+        keeping any partial line for next time. Blocks until at least one
+        byte arrives (or the port timeout passes) if nothing is waiting."""
+        waiting = self.s.in_waiting
+        self.buf.extend(self.s.read(waiting if waiting else 1))
+        end = self.buf.rfind(b"\n")
+        if end < 0:
+            return b""
+        block = bytes(self.buf[:end+1])
+        del self.buf[:end+1]
+        return block
+
+
+def parse_lines(block):
+    """
+    Parse a block of complete tab-separated lines in one pass, returning the
+    last two fields of every line (EMG value and microsecond timestamp) as
+    float64 arrays.
+
+    When every line has the same number of fields the whole block is split
+    and converted at once. Ragged or corrupt blocks fall back to parsing
+    line by line, dropping any line that doesn't parse.
+    """
+    n_lines = block.count(b"\n")
+    tokens = block.split()
+    try:
+        if (n_lines and len(tokens) % n_lines == 0
+                and block.count(b"\t") == len(tokens) - n_lines):
+            table = np.array(tokens).astype(np.float64).reshape(n_lines, -1)
+            return table[:, -2].copy(), table[:, -1].copy()
+    except ValueError:
+        pass
+
+    values = []
+    times = []
+    for line in block.splitlines():
+        fields = line.split(b"\t")
+        try:
+            value, time = float(fields[-2]), float(fields[-1])
+        except (ValueError, IndexError):
+            continue
+        values.append(value)
+        times.append(time)
+    return np.array(values), np.array(times)
+
+
+def unwrap_micros(micros, last_micros, wrap_counter):
+    """
+    Undo the wrap of a 32-bit microsecond counter (micros() on the Arduino)
+    over a block of timestamps. Any step backwards is taken as a wrap.
+
+    Returns the unwrapped timestamps (float64 us), and the last raw timestamp
+    and wrap count to carry into the next block.
+    """
+    if len(micros) == 0:
+        return micros, last_micros, wrap_counter
+    previous = micros[0] if last_micros is None else last_micros
+    wraps = wrap_counter + np.cumsum(np.diff(micros, prepend=previous) < 0)
+    return micros + wraps * 2.0**32, micros[-1], int(wraps[-1])
+
+class RingBuffer:
+    """Fixed-capacity circular buffer over a numpy array. Appending is O(1)
+    and never reallocates; once full, each new value overwrites the oldest.
+
+        capacity: number of values kept
+        dtype: numpy dtype of the backing array
+    """
+
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, dtype=dtype)
+        self.index = 0      # next write position
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count == self.capacity
+
+    def append(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def extend(self, values):
+        values = np.asarray(values)[-self.capacity:]
+        n = len(values)
+        if n == 0:
+            return
+        first = min(n, self.capacity - self.index)
+        self.data[self.index:self.index + first] = values[:first]
+        self.data[:n - first] = values[first:]
+        self.index = (self.index + n) % self.capacity
+        self.count = min(self.capacity, self.count + n)
+
+    def oldest(self):
+        """Value that the next append will overwrite (when full)"""
+        return self.data[self.index if self.full() else 0]
+
+    def newest(self):
+        return self.data[self.index - 1]
+
+    def ordered(self):
+        """Copy of the contents, oldest first"""
+        if not self.full():
+            return self.data[:self.count].copy()
+        return np.concatenate((self.data[self.index:], self.data[:self.index]))
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+
 class real_time_peak_detection():
     """Peak detection algorithm. Takes a rolling mean & std dev, and identifies
     any points that lay outside of a set threshold * std dev range of the mean.
@@ -45,60 +161,149 @@ class real_time_peak_detection():
         influence: How much the identified outliers should affect the rolling
         mean and std dev figures. 0 - no effect, 1 - treated like a non-outlier
 
+        history: number of past signals kept in self.signals. Defaults to lag.
+
+    Each sample is compared against the mean and std dev of the previous lag
+    filtered samples, excluding the most recent one. The window is a RingBuffer
+    with a sliding Welford mean/variance, so a sample costs O(1) and memory is
+    fixed. thresholding_block() runs the same algorithm over a whole block.
     """
 
-    def __init__(self, array, lag, threshold, influence):
-        self.y = list(array)
-        self.length = len(self.y)
-        self.lag = lag
+    def __init__(self, array, lag, threshold, influence, history=None):
+        self.lag = int(lag)
         self.threshold = threshold
         self.influence = influence
-        self.signals = [0] * len(self.y)
-        self.filteredY = np.array(self.y).tolist()
-        self.avgFilter = [0] * len(self.y)
-        self.stdFilter = [0] * len(self.y)
-        self.avgFilter[self.lag - 1] = np.mean(self.y[0:self.lag]).tolist()
-        self.stdFilter[self.lag - 1] = np.std(self.y[0:self.lag]).tolist()
-
+        self.length = len(array)
+        self.signals = RingBuffer(self.lag if history is None else history, dtype=np.int8)
+
+        self.window = RingBuffer(self.lag)
+        self.window.extend(np.asarray(array, dtype=np.float64))
+        self.pending = None     # last filtered value, enters the window next sample
+        self.resync()
+
+    def resync(self):
+        """Recompute the window statistics exactly, clearing rounding drift"""
+        values = self.window.ordered()
+        if len(values):
+            self.mean = float(np.mean(values))
+            self.M2 = float(np.sum((values - self.mean) ** 2))
+        else:
+            self.mean = 0.0
+            self.M2 = 0.0
+        self.pushes = 0
+
+    def std(self):
+        if len(self.window) == 0:
+            return 0.0
+        return np.sqrt(max(self.M2 / len(self.window), 0.0))
+
+    def push(self, value):
+        """Slide value into the window, updating mean and M2 in O(1)"""
+        if self.window.full():
+            old = self.window.oldest()
+            self.window.append(value)
+            new_mean = self.mean + (value - old) / self.window.count
+            self.M2 += (value - old) * (value - new_mean + old - self.mean)
+            self.mean = new_mean
+        else:
+            self.window.append(value)
+            delta = value - self.mean
+            self.mean += delta / self.window.count
+            self.M2 += delta * (value - self.mean)
 
+        self.pushes += 1
+        if self.pushes >= self.lag:
+            self.resync()
 
     #@profile
     def thresholding_algo(self, new_value):
-        self.y.append(new_value)
-        i = len(self.y) - 1
-        self.length = len(self.y)
-        if i < self.lag:
-            return 0
-        elif i == self.lag:
-            self.signals = [0] * len(self.y)
-            self.filteredY = np.array(self.y).tolist()
-            self.avgFilter = [0] * len(self.y)
-            self.stdFilter = [0] * len(self.y)
-            self.avgFilter[self.lag - 1] = np.mean(self.y[0:self.lag]).tolist()
-            self.stdFilter[self.lag - 1] = np.std(self.y[0:self.lag]).tolist()
-            return 0
-
-        self.signals += [0]
-        self.filteredY += [0]
-        self.avgFilter += [0]
-        self.stdFilter += [0]
-
-        if abs(self.y[i] - self.avgFilter[i - 1]) > self.threshold * self.stdFilter[i - 1]:
-            if self.y[i] > self.avgFilter[i - 1]:
-                self.signals[i] = 1
-            else:
-                self.signals[i] = -1
+        self.length += 1
 
-            self.filteredY[i] = self.influence * self.y[i] + (1 - self.influence) * self.filteredY[i - 1]
-            self.avgFilter[i] = np.mean(self.filteredY[(i - self.lag):i])
-            self.stdFilter[i] = np.std(self.filteredY[(i - self.lag):i])
+        if abs(new_value - self.mean) > self.threshold * self.std():
+            signal = 1 if new_value > self.mean else -1
+            previous = self.pending if self.pending is not None else self.window.newest()
+            filtered = self.influence * new_value + (1 - self.influence) * previous
         else:
-            self.signals[i] = 0
-            self.filteredY[i] = self.y[i]
-            self.avgFilter[i] = np.mean(self.filteredY[(i - self.lag):i])
-            self.stdFilter[i] = np.std(self.filteredY[(i - self.lag):i])
+            signal = 0
+            filtered = new_value
+
+        if self.pending is not None:
+            self.push(self.pending)
+        self.pending = filtered
+        self.signals.append(signal)
 
-        return self.signals[i]
+        return signal
+
+    def thresholding_block(self, values, max_segment=8192):
+        """
+        Run thresholding_algo over a block of samples, returning an int8
+        array of signals. Identical results to calling it per sample.
+
+        Works optimistically: assumes no outliers, computes every sample's
+        window mean and std dev at once from cumulative sums, and accepts
+        everything up to the first outlier. The outlier (which feeds back into
+        the window when influence < 1) and any outliers directly after it
+        go through the per-sample path before the next vectorised pass.
+        Segments start at lag samples and double while they come back clean,
+        up to max_segment.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        signals = np.zeros(len(values), dtype=np.int8)
+        lag = self.lag
+        segment_length = lag
+        s = 0
+        while s < len(values):
+            if self.pending is None or not self.window.full():
+                signals[s] = self.thresholding_algo(values[s])
+                s += 1
+                continue
+
+            segment = values[s:s + segment_length]
+            m = len(segment)
+
+            # Filtered stream: window (lag values), pending, then the segment
+            # assuming it contains no outliers. Sample k is compared against
+            # stream[k:k + lag].
+            stream = np.concatenate((self.window.ordered(), [self.pending], segment))
+            ref = self.mean
+            sums = np.concatenate(([0.0], np.cumsum(stream - ref)))
+            squares = np.concatenate(([0.0], np.cumsum((stream - ref) ** 2)))
+            mean = (sums[lag:lag + m] - sums[:m]) / lag
+            var = (squares[lag:lag + m] - squares[:m]) / lag - mean ** 2
+            mean += ref
+            std = np.sqrt(np.maximum(var, 0.0))
+
+            outlier = np.abs(segment - mean) > self.threshold * std
+            if self.influence == 1:
+                # Outliers are passed through unchanged, so the optimistic
+                # stream is exact for the whole segment
+                accepted = m
+            else:
+                accepted = int(np.argmax(outlier)) if outlier.any() else m
+
+            signals[s:s + accepted] = np.where(outlier[:accepted],
+                                               np.where(segment[:accepted] > mean[:accepted], 1, -1),
+                                               0)
+            if accepted:
+                self.window.extend(stream[lag:lag + accepted])
+                self.pending = stream[lag + accepted]
+                self.length += accepted
+                self.signals.extend(signals[s:s + accepted])
+                self.resync()
+            s += accepted
+            if accepted == m:
+                segment_length = min(2 * segment_length, max_segment)
+                continue
+            segment_length = lag
+
+            # Per-sample path through the outlier and any run following it
+            while s < len(values):
+                signals[s] = self.thresholding_algo(values[s])
+                s += 1
+                if signals[s - 1] == 0:
+                    break
+
+        return signals
 
 class dataThread:
     def __init__(self,
@@ -172,13 +377,13 @@ class dataThread:
         self.burst_center_index = 0
         self.last_R_peak = 0
         self.starting_time = 0
-        self.overflowed = False
+        self.last_micros = None
 
 
         #Kept states and buffers for filtering and peak finding - minimise the amount of vectors here!
-        self.peak_smoothing_buffer = np.zeros(1)
-        self.filter_warmup_buffer = np.zeros(1)
-        self.QRS_analysis_buffer = np.zeros(1)
+        self.peak_smoothing_buffer = RingBuffer(self.peak_smoothing_window_length)
+        self.filter_warmup_buffer = RingBuffer(self.filter_lag)
+        self.QRS_analysis_buffer = RingBuffer(self.QRS_analysis_buffer_length)
 
 
     def receive_settings(self):
@@ -254,24 +459,39 @@ class dataThread:
             if self.clear_flag:
                 self.clear_dataThread()
                 self.clear_flag = False
-                while(ser.in_waiting):
-                    line = rl.readline()
-                
-            while(ser.in_waiting):
-                try:
-                #Read and break up arduino output - same form as EMG
-                    line = rl.readline()
-                    string = line.decode()
-                    split_string = string.split("\t")
-                    length = string.count('\t') + 1
-                    settings_ticks += 1
-
-                    #save EMG output, clamp to 2V otherwise return 0
-                    if (abs(float(split_string[length - 2])) < 2.3):
-                        self.EMG = float(split_string[length-2])
-                    else:
-                        self.EMG = 0
+                ser.reset_input_buffer()
+                rl.buf.clear()
 
+            try:
+                #Read and break up all complete arduino lines - same form as EMG
+                block = rl.read_block()
+                if not block:
+                    continue
+                EMG, micros = parse_lines(block)
+                if len(EMG) == 0:
+                    continue
+                settings_ticks += len(EMG)
+
+                #save EMG output, clamp to 2V otherwise return 0
+                EMG[~(np.abs(EMG) < 2.3)] = 0
+
+                micros, self.last_micros, self.wrap_counter = unwrap_micros(micros,
+                                                                            self.last_micros,
+                                                                            self.wrap_counter)
+                if (self.time_set == False):
+                    self.starting_time = micros[0] / 1e6
+                    print(self.starting_time)
+                    self.time_set = True
+                x = micros / 1e6 - self.starting_time
+
+                # One row per sample: time, EMG, smoothed peaks, last R peak
+                batch = np.empty((len(EMG), 4))
+                batch[:, 0] = x
+                batch[:, 1] = EMG
+
+                for i in range(len(EMG)):
+                    self.EMG = EMG[i]
+                    self.x = x[i]
 
                     # Check for a long list of zeros (unit off). State machine will detect unit
                     # off after 100ms of zeros, and check for a signal. When the unit boots,
@@ -287,80 +507,39 @@ class dataThread:
                         self.unit_off == False
                         self.clear_and_reset()
 
-                    if (len(self.QRS_analysis_buffer) < self.QRS_analysis_buffer_length):
-                        self.QRS_analysis_buffer = np.append(self.QRS_analysis_buffer, self.EMG)
-                    else:
-                        self.QRS_analysis_buffer = np.roll(self.QRS_analysis_buffer,-1)
-                        self.QRS_analysis_buffer[-1] = self.EMG
-
-                    # self.sample_count += 1
+                    self.QRS_analysis_buffer.append(self.EMG)
 
                     #rectify EMG, perform the R-R identification and calculations
                     self.EMG_rect = abs(self.EMG)
-                    # self.x = self.sample_count / 1000
-                    self.x = float(split_string[length - 1]) / 1e6 - self.starting_time + (self.wrap_counter * 4294.967295) 
-                    # print(float(split_string[length - 1]) / 1e6)
-                    # print(self.starting_time)
-                    # print(self.x)
-                    
-                    
-                    if (((float(split_string[length - 1]) / 1e6) < self.starting_time)
-                        and self.overflowed == False):
-                        print("Overflow detected!")
-                        print("Starting time" + str(self.starting_time))
-                        self.wrap_counter += 1
-                        self.overflowed = True
-                    
-                    if (self.overflowed == True and
-                        ((float(split_string[length - 1]) / 1e6) > self.starting_time)):
-                        self.overflowed = False
-                    
-                        # if (self.wrap_counter == 0):
-                        #     self.starting_time = 4294.967295 - self.starting_time
-                        #     print("Wrap count = 0")
-                        #     print("New Starting time" + str(self.starting_time))
-                        # else:
-                        #     self.starting_time += 4293.967295
-                        #     print("Wrap count = 1")
-                        #     print("New Starting time" + str(self.starting_time))
-                        # self.wrap_counter += 1
-                    
-                    if (self.time_set == False):
-                        self.starting_time = self.x
-                        print(self.starting_time)
-                        self.time_set = True
-                        self.x = 0
-                        
 
                     self.detect_peaks()
                     self.smooth_peaks()
                     if (self.x > 0.5):
                         self.index_R_wave()
 
-                    self.dataQueue.put([self.x,
-                                        self.EMG,
-                                        self.peaks_detected_smoothed,
-                                        self.last_R_peak
-                                        ],
-                                       block=True,
-                                       timeout=1)
-                    if (settings_ticks >= 50):                  
-                        self.receive_settings()
-                        settings_ticks = 0
-                    
-                except:
-                    traceback.print_exc()
-                    # pass
+                    batch[i, 2] = self.peaks_detected_smoothed
+                    batch[i, 3] = self.last_R_peak
+
+                # Publish the block as one message rather than one per sample
+                self.dataQueue.put(batch, block=True, timeout=1)
+
+                if (settings_ticks >= 50):
+                    self.receive_settings()
+                    settings_ticks = 0
+
+            except:
+                traceback.print_exc()
+                # pass
 
 
     def detect_peaks(self):
 
         """ Run peak-detection algorithm over EMG stream
         Saves peak signal to an EMG_peaks vector """
-        if (len(self.filter_warmup_buffer) < self.filter_lag):
-            self.filter_warmup_buffer = np.append(self.filter_warmup_buffer, self.EMG_rect)
-        elif ((len(self.filter_warmup_buffer) >= self.filter_lag) & (~self.filters_started)):
-            self.filter = real_time_peak_detection(self.filter_warmup_buffer, self.filter_lag, self.filter_threshold, self.filter_influence)
+        if (not self.filter_warmup_buffer.full()):
+            self.filter_warmup_buffer.append(self.EMG_rect)
+        elif (self.filter_warmup_buffer.full() & (~self.filters_started)):
+            self.filter = real_time_peak_detection(self.filter_warmup_buffer.ordered(), self.filter_lag, self.filter_threshold, self.filter_influence)
             self.filters_started = True
         elif (self.filters_started):
             self.peak_detected = self.filter.thresholding_algo(self.EMG_rect)
@@ -375,13 +554,9 @@ class dataThread:
 
         self.peak_sum += self.peak_detected
 
-        if (self.peak_smoothing_counter > self.peak_smoothing_window_length):
-            self.peak_sum -= self.peak_smoothing_buffer[0]
-            self.peak_smoothing_buffer = np.roll(self.peak_smoothing_buffer, -1)
-            self.peak_smoothing_buffer[-1] = self.peak_detected
-
-        else:
-            self.peak_smoothing_buffer = np.append(self.peak_smoothing_buffer, self.peak_detected)
+        if (self.peak_smoothing_buffer.full()):
+            self.peak_sum -= self.peak_smoothing_buffer.oldest()
+        self.peak_smoothing_buffer.append(self.peak_detected)
 
         self.peaks_detected_smoothed = self.peak_sum / self.peak_smoothing_window_length
         if self.peaks_detected_smoothed > 0.95:
@@ -456,7 +631,7 @@ class dataThread:
         # eprint(start_index)
         # eprint(stop_index)
 
-        QRS_slice = np.ravel(self.QRS_analysis_buffer[start_index:stop_index])
+        QRS_slice = self.QRS_analysis_buffer.ordered()[start_index:stop_index]
 
         # As long as we're not at the very start of the recording, find the
         # max and min gradients in the slice, and find the zero crossing between
@@ -563,6 +738,158 @@ class dataThread:
 
 
 
+    # ************************* Offline analysis  *************************
+
+    def analyse_recording(self, EMG, x):
+        """
+        Run the live signal chain (clamp, peak detection, smoothing,
+        debounce, gradient zero-crossing) over a whole stored recording in a
+        few vectorised passes, rather than replaying it sample by sample.
+
+        Differences from the live chain: the debounce is a clean hysteresis
+        - a burst opens on the debounce_cycles'th sample above threshold and
+        closes on the debounce_cycles'th below. The live state machine also
+        re-fires on runs of below-threshold samples while already falling,
+        using a stale pulse start; that is not reproduced.
+
+        Parameters
+        ----------
+        EMG : array
+            Raw EMG/ECG samples, as sent by the unit.
+        x : array
+            Sample times in s, as produced by the live thread.
+
+        Returns
+        -------
+        R_peaks : ndarray
+            Time of every resolved R peak (s).
+        intervals : ndarray
+            R-R intervals (s), len(R_peaks) - 1.
+
+        """
+        EMG = np.array(EMG, dtype=np.float64)
+        EMG[~(np.abs(EMG) < 2.3)] = 0
+        x = np.asarray(x, dtype=np.float64)
+
+        smoothed = self.peak_signal_offline(np.abs(EMG))
+        rises, falls = self.debounce_offline(smoothed, x)
+        R_peaks = self.resolve_R_waves_offline(EMG, x, rises, falls)
+        return R_peaks, np.diff(R_peaks)
+
+    def peak_signal_offline(self, EMG_rect):
+        """Peak detection and moving-average smoothing over a whole signal,
+        equivalent to detect_peaks then smooth_peaks per sample (including
+        filter resets when the smoothed signal saturates)."""
+        n = len(EMG_rect)
+        lag = self.filter_lag
+        window = self.peak_smoothing_window_length
+        signals = np.zeros(n, dtype=np.int8)
+        smoothed = np.zeros(n)
+        if n <= lag:
+            return smoothed
+
+        # Warm-up fills lag samples, the filter is built on the next one
+        filter = real_time_peak_detection(EMG_rect[:lag], lag, self.filter_threshold, self.filter_influence)
+        start = lag + 1
+        while start < n:
+            signals[start:] = filter.thresholding_block(EMG_rect[start:])
+            sums = np.cumsum(signals, dtype=np.int64)
+            smoothed = (sums - np.concatenate((np.zeros(window), sums))[:n]) / window
+
+            # Restart from the first saturation, as smooth_peaks would
+            resets = np.flatnonzero(smoothed[start:] > 0.95)
+            if not len(resets):
+                break
+            self.reset_filters()
+            filter = self.filter
+            start += int(resets[0]) + 1
+
+        smoothed[smoothed > 1] = 0
+        return smoothed
+
+    def debounce_offline(self, peaks_smoothed, x):
+        """Find burst edges in the smoothed peak signal. Returns sample
+        indices of each burst's rising and falling edges. One searchsorted
+        per edge over cumulative above/below-threshold counts."""
+        first = int(np.searchsorted(x, 0.5, side='right'))
+        above = peaks_smoothed[first:] > self.peak_burst_threshold
+        n_above = np.cumsum(above)
+        n_below = np.cumsum(~above)
+        d = self.debounce_cycles
+
+        rises = []
+        falls = []
+        counted = 0
+        while True:
+            rise = int(np.searchsorted(n_above, counted + d))
+            if rise >= len(above):
+                break
+            fall = int(np.searchsorted(n_below, n_below[rise] + d))
+            if fall >= len(above):
+                break
+            rises.append(rise + first)
+            falls.append(fall + first)
+            counted = n_above[fall]
+
+        return np.array(rises, dtype=np.int64), np.array(falls, dtype=np.int64)
+
+    def resolve_R_waves_offline(self, EMG, x, rises, falls):
+        """resolve_R_wave for every burst at once. QRS windows are cut from
+        the signal as the live analysis buffer would have held them, stacked,
+        and differentiated, smoothed and searched along axis 1."""
+        centers = (x[rises] + x[falls]) / 2 - (self.peak_smoothing_window_length / 2000)
+        keep = centers != 0
+        falls = falls[keep]
+        centers = centers[keep]
+
+        half_cycle = self.QRS_cycle_duration / 2
+        start_times = centers - half_cycle
+        stop_times = centers + half_cycle
+
+        # Slice of the analysis buffer (last QRS_analysis_buffer_length
+        # samples up to the falling edge) that the live thread would take
+        starts = np.zeros(len(falls), dtype=np.int64)
+        lengths = np.zeros(len(falls), dtype=np.int64)
+        for i, fall in enumerate(falls):
+            buffer_length = min(fall + 1, self.QRS_analysis_buffer_length)
+            start_index = -int((x[fall] - start_times[i]) * 1000)
+            stop_index = -int((x[fall] - stop_times[i]) * 1000)
+            a, b, _ = slice(start_index, stop_index).indices(buffer_length)
+            starts[i] = fall + 1 - buffer_length + a
+            lengths[i] = max(0, b - a)
+
+        local_R_index = np.zeros(len(falls), dtype=np.int64)
+        g = self.gradient_smoothing_samples
+        for m in np.unique(lengths):
+            if m < 2:
+                continue    # np.gradient would raise, live code skips these
+            rows = np.flatnonzero(lengths == m)
+            windows = EMG[starts[rows, None] + np.arange(m)]
+            cycle_gradients = np.gradient(windows, axis=1)
+            smoothed_gradients = rolling_mean(cycle_gradients, size=g, axis=1)
+            max_gradient_index = (np.argmax(smoothed_gradients, axis=1) - g / 2).astype(np.int64)
+            min_gradient_index = (np.argmin(smoothed_gradients, axis=1) - g / 2).astype(np.int64)
+
+            #if leads are on backwards, switch max and min
+            swap = max_gradient_index > min_gradient_index
+            max_gradient_index, min_gradient_index = (np.where(swap, min_gradient_index, max_gradient_index),
+                                                      np.where(swap, max_gradient_index, min_gradient_index))
+
+            # First sign change of the gradient in [max, min], with python's
+            # negative slice index semantics
+            lo = np.clip(np.where(max_gradient_index < 0, max_gradient_index + m, max_gradient_index), 0, m)
+            hi = min_gradient_index + 1
+            hi = np.clip(np.where(hi < 0, hi + m, hi), 0, m)
+            sign_changes = np.diff(np.signbit(cycle_gradients), axis=1)
+            j = np.arange(m - 1)
+            candidates = sign_changes & (j >= lo[:, None]) & (j < hi[:, None] - 1)
+            found = candidates.any(axis=1) & ((min_gradient_index - max_gradient_index) > 2)
+            crossing = np.argmax(candidates, axis=1) - lo + max_gradient_index
+            local_R_index[rows] = np.where(found, crossing, 0)
+
+        resolved = local_R_index != 0
+        return start_times[resolved] + local_R_index[resolved] / 1000
+
     def clear_dataThread(self):
 
         # Clear signal chain
@@ -579,8 +906,8 @@ class dataThread:
         self.last_R_peak = 0
         self.starting_time = 0
         self.time_set = False
-        self.peak_smoothing_buffer = np.zeros(1)
-        self.QRS_analysis_buffer = np.zeros(1)
+        self.peak_smoothing_buffer.clear()
+        self.QRS_analysis_buffer.clear()
 
 
     def reset_filters(self):
@@ -607,3 +934,28 @@ class dataThread:
         print('Disconnected...')
         # df = pd.DataFrame(self.csvData)
         # df.to_csv('/home/rikisenia/Desktop/data.csv')
+
+
+def _analyse_file(args):
+    path, columns, settings = args
+    data = np.loadtxt(path, delimiter=",", usecols=columns)
+    return dataThread(**settings).analyse_recording(data[:, 1], data[:, 0])
+
+
+def analyse_recordings(paths, processes=None, columns=(0, 1), **settings):
+    """
+    Run dataThread.analyse_recording over a set of stored recordings, one
+    file per worker process.
+
+    Arguments:
+        paths: list of CSV files
+        processes: size of the worker pool, default os.cpu_count()
+        columns: (time, EMG) column indices in the files
+        settings: dataThread keyword arguments (filter_lag etc.)
+
+    Returns:
+        dict of path: (R_peaks, intervals)
+    """
+    with Pool(processes) as pool:
+        results = pool.map(_analyse_file, [(path, columns, settings) for path in paths])
+    return dict(zip(paths, results))
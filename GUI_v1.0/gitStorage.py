@@ -9,19 +9,75 @@ import sys
 from multiprocessing import Process, Queue
 import gitlab
 import base64
+import hashlib
 import os
+import time
 from datetime import datetime
 # from .models import Meme
 import json
 
+# Read size for hashing and encoding. A multiple of 3 so that base64 chunks
+# concatenate without padding in the middle.
+_chunk_bytes = 3 * (1 << 20)
+
+
+def file_digest(file_path):
+    """sha256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encode_file(file_path):
+    """base64 content of a file, encoded a chunk at a time so a large binary
+    capture is never held raw and encoded at once"""
+    parts = []
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_chunk_bytes), b""):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
 
 class Sync:
-    def __init__(self):
+    """
+    Uploads data files to the storage repository on GitLab.
+
+    Files are committed in batches, several files to one multi-action commit.
+    A local manifest of the sha256 of every file already uploaded is kept in
+    manifest_path. It is rewritten after each batch lands, so unchanged files
+    are skipped and an interrupted upload resumes where it stopped.
+
+    init arguments:
+        manifest_path: JSON manifest file
+        batch_files: max files per commit
+        batch_bytes: max encoded content per commit
+        retries: attempts per batch before giving up on it
+        backoff: initial retry delay in s, doubled each attempt
+        connect: callable returning the project object. Defaults to the
+            GitLab server; pass a local mock exposing repository_tree() and
+            commits.create() to test without a network.
+    """
+    def __init__(self,
+                 manifest_path="./sync_manifest.json",
+                 batch_files=50,
+                 batch_bytes=20 * (1 << 20),
+                 retries=4,
+                 backoff=1.0,
+                 connect=None):
         self.GitlabURL = "https://eng-git.canterbury.ac.nz/"
         self.access_token = "sY_ieZczMq1hyhiuPbbd"  
         self.project_id = "10347"
         self.progress = 0
         self.progressQueue = Queue()
+
+        self.manifest_path = manifest_path
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.connect = connect if connect is not None else self.connect_gitlab
     #
     # def create_file(self):
     #     f = project.files.create({'file_path': 'testfile.txt',
@@ -63,140 +119,148 @@ class Sync:
         self.commit_p = Process(target=self.commit_file, args=[files, filepaths])
         self.commit_p.start()
 
+    def connect_gitlab(self):
+        gl = gitlab.Gitlab(self.GitlabURL, private_token=self.access_token)
+        gl.auth()
+        return gl.projects.get(self.project_id)
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        """Write via a temporary file and rename, so an interruption never
+        leaves a half-written manifest"""
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.manifest_path)
+
+    def remote_paths(self, project):
+        """Paths of every file already in the repository"""
+        tree = project.repository_tree(recursive=True, all=True)
+        return set(item['path'] for item in tree if item.get('type', 'blob') == 'blob')
+
+    def make_batches(self, pending):
+        """Split (repo_path, file_path, digest, size) entries into batches of
+        at most batch_files files and batch_bytes of base64 content"""
+        batches = []
+        batch = []
+        batch_size = 0
+        for entry in pending:
+            encoded_size = 4 * ((entry[3] + 2) // 3)
+            if batch and (len(batch) >= self.batch_files
+                          or batch_size + encoded_size > self.batch_bytes):
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+            batch.append(entry)
+            batch_size += encoded_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def commit_batch(self, project, batch, remote):
+        """Commit one batch as a single multi-action commit, retrying with
+        exponential backoff. remote is refreshed after a failure, in case
+        a create/update guess was wrong."""
+        folders = sorted(set(repo_path.split("/")[0] for repo_path, _, _, _ in batch))
+        delay = self.backoff
+        for attempt in range(self.retries):
+            try:
+                actions = [{'action': 'update' if repo_path in remote else 'create',
+                            'file_path': repo_path,
+                            'content': encode_file(file_path),
+                            'encoding': 'base64'}
+                           for repo_path, file_path, _, _ in batch]
+                project.commits.create({'branch': 'master',
+                                        'commit_message': " " + ", ".join(folders),
+                                        'actions': actions})
+                return True
+            except Exception as e:
+                print("couldnt upload batch ({} files), attempt {}".format(len(batch), attempt + 1))
+                print(e)
+                if attempt + 1 == self.retries:
+                    return False
+                time.sleep(delay)
+                delay *= 2
+                try:
+                    remote.clear()
+                    remote.update(self.remote_paths(project))
+                except Exception as e:
+                    print(e)
+        return False
+
     def commit_file(self, files, filepaths):  # -> bool:
-        """Commit a file to the repository
+        """Commit files to the repository, skipping any whose content has
+        already been uploaded
 
         Parameters
         ----------
-        project_id: int
-            the project id to commit into. E.g. 1582
-        file_path: str
-            the file path to commit. NOTE: expecting a path relative to the
-            repo path. This will also be used as the path to commit into.
-            If you want to use absolute local path you will also have to
-            pass a parameter for the file relative repo path
-        gitlab_url: str
-            The gitlab url. E.g. https://gitlab.example.com
-        private_token: str
-            Private access token. See doc for more details
-        branch: str
-            The branch you are working in. See note below for more about this
+        files: list of str
+            file names, committed as <parent folder>/<file name>
+        filepaths: list of str
+            local paths of the files
+
+        Returns
+        -------
+        True if every file is now in the repository (uploaded by this call
+        or previously), False otherwise.
         """
-        gl = gitlab.Gitlab(self.GitlabURL, private_token=self.access_token)
-        # print(gl)
+        manifest = self.load_manifest()
+        success = True
 
-        try:
-            #     # get the project by the project id
-            # print(gl.projects.list())
-            project = gl.projects.get(self.project_id)
-            #
-            # commits = gl.project.list()
-            # gl = gitlab.Gitlab('https://gitlab.com/*********', private_token='******************')
-            gl.auth()
-            # projects = gl.projects.list()
-            # print(project.repository_tree())
-            # return HttpResponse(projects[0].name)
-            repo_tree = project.repository_tree()
-            # print("Checking git")
-            # print(project.repository_tree())
-            # print("got tree")
-            repo = []
-            for r in repo_tree:
-                repo.append(r['name'])
-            # print(len(project.repository_tree()))
-            # print(len(repo))
-            # print(filepaths)
-            # print(repo)
-            for i in range(len(files)):
-                # print(i)
-                file_name = files[i]
-                file_path = filepaths[i]
-                self.progress = (100 * (i + 1)) / len(files)
-                self.progressQueue.put(self.progress)
-                # print(repo['name'])
-
-                if (file_path.split("/")[-2] + "/" + file_name) not in repo:
-                    # print('---------------------')
-                    # print("uploading: " + file_path.split("\\")[-2])
-                    # print('---------------------')
-                    # print(file_name)
-                    try:
-                        data = {
-                                'branch': 'master',
-                                'commit_message': " " + file_path.split("/")[-2],
-                                'actions': [
-                                    {
-                                        'action': 'create',
-                                        'file_path': file_path.split("/")[-2] + "/" + file_name,
-                                        'content': open(file_path).read(),
-                                    }
-                                        # {
-                                        #     # Binary files need to be base64 encoded
-                                        #     'action': 'create',
-                                        #     'file_path': 'logo.png',
-                                        #     'content': base64.b64encode(open('logo.png').read()),
-                                        #     'encoding': 'base64',
-                                        # }
-                                ]
-                            }
-                        commit = project.commits.create(data)
-                        # print('successfully commited')
-                    except Exception as e:
-                        print('couldnt upload ' + file_name)
-                        print(e)
-                else:
-                    try:
-                        data = {
-                                'branch': 'master',
-                                'commit_message': " " + file_path.split("/")[-2],
-                                'actions': [
-                                    {
-                                        'action': 'update',
-                                        'file_path': file_path.split("/")[-2] + "/" + file_name,
-                                        'content': open(file_path).read(),
-                                    }
-                                    # {
-                                    #     # Binary files need to be base64 encoded
-                                    #     'action': 'create',
-                                    #     'file_path': 'logo.png',
-                                    #     'content': base64.b64encode(open('logo.png').read()),
-                                    #     'encoding': 'base64',
-                                    # }
-                                ]
-                            }
-                        commit = project.commits.create(data)
-                        # print('successfully commited')
-                    except Exception as e:
-                        print('couldnt upload ' + file_name)
-                        print(e)
-                        
-            self.progress = 0
+        pending = []
+        for file_name, file_path in zip(files, filepaths):
+            repo_path = file_path.split("/")[-2] + "/" + file_name
+            try:
+                digest = file_digest(file_path)
+                size = os.path.getsize(file_path)
+            except OSError as e:
+                print('couldnt read ' + file_name)
+                print(e)
+                success = False
+                continue
+            if manifest.get(repo_path) != digest:
+                pending.append((repo_path, file_path, digest, size))
+
+        if not pending:
             self.progressQueue.put(1000)
-            
-            #
-            #     # read the file contents
-            # with open(file_path, 'r') as fin:
-            #     content = fin.read()
-            # timestamp_string = now.strftime("%d_%m_%Y_%H_%M_%S_")
-
-            # file_data = {'branch': "master",
-            #              'commit_message': 'Test completed' + datetime.now().strftime("%d_%m_%Y_%H_%M_%S_")}
-            #
-
-            # resp = project.files.create(file_data)
-            # #     # do something with resp
+            return success
+
+        try:
+            project = self.connect()
+            remote = self.remote_paths(project)
         except gitlab.exceptions.GitlabGetError as get_error:
             # project does not exists
             print(f"could not find no project with id {self.project_id}: {get_error}")
             return False
-        except gitlab.exceptions.GitlabCreateError as create_error:
-            # project does not exists
-            print(f"could not create file: {create_error}")
+        except Exception as e:
+            print(f"could not connect: {e}")
             return False
-        # except gitlab.exceptions.GitlabConnectionError:
-        #     print("no internet")
 
-        return True
+        batches = self.make_batches(pending)
+        done = 0
+        for batch in batches:
+            if self.commit_batch(project, batch, remote):
+                for repo_path, _, digest, _ in batch:
+                    manifest[repo_path] = digest
+                    remote.add(repo_path)
+                self.save_manifest(manifest)
+            else:
+                success = False
+            done += len(batch)
+            self.progress = (100 * done) / len(pending)
+            self.progressQueue.put(self.progress)
+
+        self.progress = 0
+        self.progressQueue.put(1000)
+        return success
 
 
 def check_ping():
@@ -1,5 +1,7 @@
 import sys
 import os
+# writer, event_log and storage are shared with the API
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RP API"))
 import tkinter as tk
 from tkinter import font as tkfont
 from tkinter import ttk
@@ -14,18 +16,19 @@ from functools import partial
 
 import numpy as np
 import cProfile
-from GS_timing import micros
+import threading
+import queue
 
 from datetime import datetime
 import pstats
-import time
-from functools import wraps
 from gitStorage import Sync, check_ping
 
 import csv
 from time import sleep
 
 import logging
+from writer import get_writer
+from profiling import timed
 
 
 np.set_printoptions(threshold=sys.maxsize)
@@ -92,14 +95,9 @@ def check_directory_exists(directory):
 
 
 def time_this(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.perf_counter()
-        r = func(*args, **kwargs)
-        end = time.perf_counter()
-        print('{}.{} : {}'.format(func.__module__, func.__name__, end - start))
-        return r
-    return wrapper
+    """Time every call of func as a profiling span (see profiling.py), so
+    it lands in profiling.session's summary, histograms and Chrome trace."""
+    return timed('{}.{}'.format(func.__module__, func.__name__))(func)
 
 class NumpyFloatToFixConverter(object):
     """*** IMPORTED FROM RIG LIBRARY, RIG NOT AVAILABLE THROUGH CONDA CHANNELS***
@@ -371,6 +369,19 @@ class GUI:
                                            interval=self.animation_delay,
                                            blit=False)
 
+        # Messages from the data process. Tk calls are only safe from this
+        # thread, so on POSIX a listener thread wakes the Tk loop through a
+        # pipe it watches. Windows Tk can't watch pipes, so there the Tk
+        # loop polls the data process' queue instead.
+        self.messages = queue.Queue()
+        self.message_poll_delay = 20    # ms, Windows only
+        self.poll_id = None
+        self.wake_pipe = None
+        if os.name == "posix":
+            self.wake_pipe = os.pipe()
+            self.graph_w.tk.createfilehandler(self.wake_pipe[0], tk.READABLE, self.on_wake)
+        self.start_listener()
+
         
 
    # **************************** GUI Callbacks  *********************
@@ -443,10 +454,12 @@ class GUI:
         # self.save_data()
         
     def kick(self):
+        self.stop_listener()
         self.data.close()
         self.data = sp.dataThread()
         self.stop_trial()
         self.data.start_Process()
+        self.start_listener()
 
     def stop_trial(self):
         """ Turns red light green and saves the current trial"""
@@ -464,8 +477,11 @@ class GUI:
 
     def close_graph(self):
         """Does what it says on the tin."""
+        self.stop_listener()
         self.data.close()
         self.stop_trial()
+        if self.wake_pipe is not None:
+            self.graph_w.tk.deletefilehandler(self.wake_pipe[0])
         self.graph_w.destroy()
         self.running = False
         return "break"
@@ -493,13 +509,19 @@ class GUI:
         if self.hangpoint:
             logging.debug("save")
         label = self.label_var.get()
+        # Create the file now so queued saves never share a name
         i = 0
-        while os.path.exists(self.datadir + '{}{}.csv'.format(label, i)):
-            i += 1
-        np.savetxt(self.datadir + '{}{}.csv'.format(label, i), 
-                   [self.CH1_recording, self.CH2_recording], 
-                   delimiter=",",
-                   header="Sample rate: {}".format(125000000 / self.FPGA_config["CIC_divider"]))
+        while True:
+            try:
+                open(self.datadir + '{}{}.csv'.format(label, i), 'x').close()
+                break
+            except FileExistsError:
+                i += 1
+        # Written on the writer thread, so the Tk loop carries on
+        get_writer().submit(self.datadir + '{}{}.csv'.format(label, i), 
+                            np.array([self.CH1_recording, self.CH2_recording]), "csv",
+                            delimiter=",",
+                            header="Sample rate: {}".format(125000000 / self.FPGA_config["CIC_divider"]))
         
     def send_config_to_data(self, event):
         if self.hangpoint:
@@ -529,13 +551,72 @@ class GUI:
             logging.debug("Didn't send config to data process")
             # logging.debug(e)
             
-    def receive_info_from_data(self):
+    def start_listener(self):
+        """Start passing the data process' messages to the Tk loop: a
+        daemon thread blocks on its queue and wakes Tk for each message
+        (POSIX), or the Tk loop polls the queue (Windows)."""
+        if self.wake_pipe is None:
+            self.poll_id = self.graph_w.after(self.message_poll_delay, self.poll_messages)
+            return
+        self.listener = threading.Thread(target=self.listen,
+                                         args=(self.data.data_to_GUI_Queue,),
+                                         daemon=True)
+        self.listener.start()
+
+    def stop_listener(self):
+        """Stop polling, or wake the listener with a None sentinel so it
+        exits."""
+        if self.wake_pipe is None:
+            if self.poll_id is not None:
+                self.graph_w.after_cancel(self.poll_id)
+                self.poll_id = None
+            return
+        try:
+            self.data.data_to_GUI_Queue.put(None, block=False)
+        except Exception as e:
+            logging.debug(e)
+
+    def listen(self, data_to_GUI_Queue):
+        while True:
+            message = data_to_GUI_Queue.get()
+            if message is None:
+                break
+            self.messages.put(message)
+            # One byte per message wakes the Tk loop (on_wake)
+            os.write(self.wake_pipe[1], b"\0")
+
+    def on_wake(self, fd, mask):
+        """Tk file handler: handle the messages the listener has passed on."""
+        os.read(fd, 4096)
+        while True:
+            try:
+                message = self.messages.get(block=False)
+            except queue.Empty:
+                break
+            self.receive_info_from_data(message)
+
+    def poll_messages(self):
+        """Windows: handle messages waiting on the data process' queue,
+        then poll again in message_poll_delay ms."""
+        while True:
+            try:
+                message = self.data.data_to_GUI_Queue.get(block=False)
+            except queue.Empty:
+                break
+            self.receive_info_from_data(message)
+        try:
+            self.poll_id = self.graph_w.after(self.message_poll_delay, self.poll_messages)
+        except tk.TclError as e:
+            # Window destroyed
+            logging.debug(e)
+
+    def receive_info_from_data(self, message):
         if self.hangpoint:
             logging.debug("receive")
         try:
             if self.hangpoint:
                 logging.debug("receivr try")
-            data_ready, memory_name = self.data.data_to_GUI_Queue.get(block=False)
+            data_ready, memory_name = message
             logging.debug ("{}, {}".format(data_ready, memory_name))
             self.hangpoint = False
             if memory_name:
@@ -553,8 +634,12 @@ class GUI:
                  #copy into kept array
                 recording = np.copy(temp)
                 logging.debug("recording copied")
-                self.CH1_recording = (recording['CH1'] - self.adc1_0) / self.adc1_scale
-                self.CH2_recording = (recording['CH2'] - self.adc2_0) / self.adc2_scale
+                # Volts in float32, subtract and divide in place (no float64
+                # temporaries the size of the recording)
+                self.CH1_recording = np.subtract(recording['CH1'], self.adc1_0, dtype=np.float32)
+                self.CH1_recording /= self.adc1_scale
+                self.CH2_recording = np.subtract(recording['CH2'], self.adc2_0, dtype=np.float32)
+                self.CH2_recording /= self.adc2_scale
                 logging.debug("recordings broken up")
                 del temp
                 logging.debug("received data")
@@ -575,38 +660,15 @@ class GUI:
        
 
     def main(self):
-        
-        dataMicros = micros()
-        GUIMicros = micros()
+        """Run the Tk event loop. Data process messages are handled by
+        on_wake() (POSIX) or poll_messages() (Windows)."""
         if self.hangpoint:
             logging.debug("mainloop trigd")
-        while(self.running):
-            if self.hangpoint:
-                    logging.debug("running trigd")
-            currentMicros = micros()
-            
-            if ((currentMicros - dataMicros) > 100000):
-                dataMicros = currentMicros
-                if self.hangpoint:
-                    logging.debug("dataMicros trigd")
-                if (self.data.process_isRun):
-                    if self.hangpoint:
-                        logging.debug("receive(mainloop) trigd")
-                    self.receive_info_from_data()
-                    
-            if ((currentMicros - GUIMicros) > 100000):
-                
-                GUIMicros = currentMicros
-                if self.hangpoint:
-                    logging.debug("GUIMicros trigd")
-                
-                try:
-                    self.graph_w.update()
-            
-                except tk._tkinter.TclError as e:
-                    logging.debug(e)
-                    break
-            
+        try:
+            self.graph_w.mainloop()
+        except tk._tkinter.TclError as e:
+            logging.debug(e)
+        self.running = False
         return 0
 
 
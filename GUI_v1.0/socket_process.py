@@ -78,7 +78,7 @@ class dataThread:
 
      # **************** Local Inter-process Comms with GUI****************** #
 
-    def fetch_instructions(self):
+    def fetch_instructions(self, block=False):
         """ Get and save instructions from GUI thread:
 
             config: New config struct for FPGA
@@ -86,10 +86,14 @@ class dataThread:
             record request: First request from GUI, initiates shared memory setup and handshake
             trigger: Shared memory set up, ready to receive & send to GUI.
 
+            block: wait for the next instruction rather than returning False
+            when none is queued. The idle loop blocks so it sleeps until the
+            GUI sends something; the transfer loops poll.
+
         """
 
         try:
-            self.trigger, self.config, self.config_change, [self.record_request, self.bytes_to_receive] = self.GUI_to_data_Queue.get(block=False)
+            self.trigger, self.config, self.config_change, [self.record_request, self.bytes_to_receive] = self.GUI_to_data_Queue.get(block=block)
             logging.debug("message received")
             return True
         except Exception as e:
@@ -266,8 +270,8 @@ class dataThread:
 
 
         while(True):
-             # Check for instructions and dispatch accordingly
-            if self.fetch_instructions():
+             # Wait for instructions and dispatch accordingly
+            if self.fetch_instructions(block=True):
 
                 if self.config_change:
                     self.send_settings_to_FPGA()
@@ -1,6 +1,7 @@
 import numpy as np
 from matplotlib.backends.backend_qt5agg import (FigureCanvas)
 import matplotlib.figure as mpl_fig
+from envelope import MinMaxPyramid, attach_envelope
 
 ## This is the FigureCanvas in which the plot is drawn. (according https://stackoverflow.com/questions/57891219/how-to-make-a-fast-matplotlib-live-plot-in-a-pyqt5-gui)
 class MyFigureCanvas(FigureCanvas):
@@ -29,18 +30,33 @@ class MyFigureCanvas(FigureCanvas):
         # Set figure options
         self.figure.tight_layout()
         
+        # Envelope callbacks from the previous recording, see update_canvas
+        self.envelopes = []
+        self.callback_ids = []
+        
+        # Scope (blitting) state, see start_scope
+        self.scope_backgrounds = None
+        self.scope_draw_cid = None
+        
+    def disconnect_envelopes(self):
+        """Stop the previous recording's envelopes redrawing on zoom."""
+        for ax, cid in self.callback_ids:
+            ax.callbacks.disconnect(cid)
+        self.callback_ids = []
+        
     def update_canvas(self, data, scale, offset):
         
         # # 2 Line mode
-        scaled_data=[data[0]*scale[0]+offset[0],data[1]*scale[2]+offset[2]]
+        # Build a min/max envelope per trace once per recording, and scale
+        # only the points that are drawn rather than the whole recording.
+        self.envelopes = [MinMaxPyramid(data[0]), MinMaxPyramid(data[1])]
         # ax 0
-        self.line0.set_data(range(len(scaled_data[0])), scaled_data[0])
-        self.ax[0].set_xlim((0,len(scaled_data[0])))
-        self.ax[0].set_ylim((np.min(scaled_data[0]), np.max(scaled_data[0])))
+        self.disconnect_envelopes()
+        self.callback_ids.append((self.ax[0], attach_envelope(self.ax[0], self.line0, self.envelopes[0],
+                                                              y_scale=scale[0], y_offset=offset[0])))
         # ax 1
-        self.line2.set_data(range(len(scaled_data[1])), scaled_data[1])
-        self.ax[1].set_xlim((0,len(scaled_data[1])))
-        self.ax[1].set_ylim((np.min(scaled_data[1]), np.max(scaled_data[1])))
+        self.callback_ids.append((self.ax[1], attach_envelope(self.ax[1], self.line2, self.envelopes[1],
+                                                              y_scale=scale[2], y_offset=offset[2])))
         
         # 4 Line mode
         # scaled_data=[data[0]*scale[0]+offset[0],data[1]*scale[1]+offset[1],data[2]*scale[2]+offset[2],data[3]*scale[3]+offset[3]]
@@ -57,4 +73,65 @@ class MyFigureCanvas(FigureCanvas):
         
         # redraw canvas
         self.draw()
+        
+    ## Live scope mode. Lines are animated artists drawn over a cached
+    ## background, so a frame only redraws the two lines (blitting).
+    def start_scope(self, n_samples):
+        self.disconnect_envelopes()
+        x = np.arange(n_samples)
+        for ax, line in ((self.ax[0], self.line0), (self.ax[1], self.line2)):
+            line.set_data(x, np.zeros(n_samples, dtype=np.float32))
+            line.set_animated(True)
+            ax.set_xlim((0, n_samples))
+        self.scope_ylims = [None, None]
+        # Recapture the background whenever the whole figure is redrawn
+        # (first draw, resize, axis limit change).
+        self.scope_draw_cid = self.mpl_connect('draw_event', self.capture_scope_background)
+        self.draw()
+        
+    def capture_scope_background(self, event=None):
+        self.scope_backgrounds = [self.copy_from_bbox(ax.bbox) for ax in self.ax]
+        self.ax[0].draw_artist(self.line0)
+        self.ax[1].draw_artist(self.line2)
+        
+    def update_scope(self, traces, limits):
+        """Redraw the scope lines.
+        
+        traces: [IN, OUT] arrays, already scaled, of the length given to
+            start_scope
+        limits: [(min, max), (min, max)] of the traces, from cached per-frame
+            envelopes rather than a scan of the traces
+        """
+        full_redraw = False
+        for i, (lo, hi) in enumerate(limits):
+            current = self.scope_ylims[i]
+            # Only rescale when the trace leaves the axes or shrinks to under
+            # half of them - a rescale costs a full redraw.
+            if (current is None or lo < current[0] or hi > current[1]
+                    or (hi - lo) < 0.5 * (current[1] - current[0])):
+                margin = 0.05 * (hi - lo) if hi > lo else 1
+                self.scope_ylims[i] = (lo - margin, hi + margin)
+                self.ax[i].set_ylim(self.scope_ylims[i])
+                full_redraw = True
+        
+        self.line0.set_ydata(traces[0])
+        self.line2.set_ydata(traces[1])
+        
+        if full_redraw or self.scope_backgrounds is None:
+            self.draw()
+            return
+        
+        for ax, line, background in zip(self.ax, (self.line0, self.line2), self.scope_backgrounds):
+            self.restore_region(background)
+            ax.draw_artist(line)
+            self.blit(ax.bbox)
+        
+    def stop_scope(self):
+        if self.scope_draw_cid is not None:
+            self.mpl_disconnect(self.scope_draw_cid)
+            self.scope_draw_cid = None
+        self.scope_backgrounds = None
+        self.line0.set_animated(False)
+        self.line2.set_animated(False)
+        self.draw()
         
\ No newline at end of file
@@ -1,9 +1,12 @@
 import sys
 import numpy as np
 import os
+# writer, event_log and storage are shared with the API
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RP API"))
 import logging
 from matplotlib.backends.backend_qt5agg import (NavigationToolbar2QT as NavigationToolbar)
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, QObject, pyqtSignal
+import threading
 from multiprocessing.shared_memory import SharedMemory
 
 from traceback import format_exc
@@ -12,10 +15,37 @@ from traceback import format_exc
 from UI import Ui_MainWindow, QtWidgets
 import socket_process as sp
 from Canvas import MyFigureCanvas
+from writer import recording_writer
 from float_converter import NumpyFloatToFixConverter
 float_to_fix = NumpyFloatToFixConverter(True, 16, 16)
 float_to_fix(1)
 
+
+class QueueListener(QObject):
+    """Blocks on a multiprocessing Queue in a daemon thread and re-emits each
+    message as a Qt signal, so the GUI wakes as soon as the data process
+    reports something instead of polling the queue on a timer. Signals
+    emitted from the thread are queued onto the GUI thread by Qt."""
+    message = pyqtSignal(object)
+    
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        
+    def start(self):
+        self.thread.start()
+        
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            self.message.emit(message)
+            
+    def stop(self):
+        self.queue.put(None)
+
     
 class Window(QtWidgets.QMainWindow):
     def __init__(self,parent=None):
@@ -43,6 +73,15 @@ class Window(QtWidgets.QMainWindow):
         self.ui.polynomial.released.connect(self.RadioButtonMode)
         self.ui.CBC.released.connect(self.RadioButtonMode)
         
+        # Scope button, next to the measurement button
+        self.buttonScope = QtWidgets.QPushButton("Start Scope", self.ui.centralwidget)
+        self.buttonScope.setFont(self.ui.buttonMeasurement.font())
+        self.ui.gridLayout.addWidget(self.buttonScope, 16, 0, 1, 1)
+        self.buttonScope.clicked.connect(self.ButtonPressScope)
+        
+        # Saves run on a writer thread, so the event loop never waits on disk
+        self.writer = recording_writer()
+        
         # Create data processing thread
         self.data = sp.dataThread()
         self.data.start_Process()
@@ -74,9 +113,19 @@ class Window(QtWidgets.QMainWindow):
         # init float to fix conversion
         self.FloatToFix = NumpyFloatToFixConverter(signed=True, n_bits=32, n_frac=16)
         
-        #init monitor timer
-        self.timer = QTimer()
-        self.timer.timeout.connect(lambda: self.monitor())
+        #init monitor: wake on messages from the data process
+        self.monitoring = False
+        self.listener = QueueListener(self.data.data_to_GUI_Queue)
+        self.listener.message.connect(self.monitor)
+        self.listener.start()
+        
+        # Live scope: frame rate, ring buffer and on-screen window sizes
+        self.scope = 0
+        self.scope_fps = 30
+        self.scope_ring_frames = 64
+        self.scope_display_frames = 10
+        self.scope_timer = QTimer()
+        self.scope_timer.timeout.connect(lambda: self.scope_tick())
 
     def closeEvent(self, event):
         # Close shared memory
@@ -85,23 +134,34 @@ class Window(QtWidgets.QMainWindow):
             self.shared_mem.unlink()
         except:
             pass
+        # Finish queued saves
+        self.writer.close()
         # Close data processing thread
         self.data.close()
         # stop monitoring
         try:
-            self.timer.stop()
+            self.listener.stop()
+            self.scope_timer.stop()
         except:
             pass
         # close logging
         logging.shutdown()   
         
-    def monitor(self):
+    def monitor(self, message):
         if (self.data.process_isRun):
             try:
-                data_ready, memory_name = self.data.data_to_GUI_Queue.get(block=False)
+                data_ready, memory_name = message
                 logging.debug ("{}, {}".format(data_ready, memory_name))
                 
-                if memory_name:
+                if data_ready == 2:
+                    # Always handled, so a scope buffer arriving after a stop
+                    # is still released.
+                    self.ScopeAllocated(memory_name)
+                
+                elif not self.monitoring:
+                    logging.debug("Message ignored, no measurement running")
+                
+                elif memory_name:
                     logging.debug(memory_name)
                     self.shared_mem = SharedMemory(name=memory_name, size=self.num_bytes, create=False)
                     # Send trigger and number of bytes to server
@@ -123,7 +183,7 @@ class Window(QtWidgets.QMainWindow):
         self.measurement = 0
         self.ui.buttonMeasurement.setText("Start Measurement") # change button text
         # Stop data recording monitoring
-        self.timer.stop()        
+        self.monitoring = False
         #create array with view of shared mem
         logging.debug("data_ready recognised")
         temp = np.ndarray((self.num_samples), dtype=np.dtype([('in', np.int16), ('out', np.int16)]), buffer=self.shared_mem.buf)
@@ -145,19 +205,122 @@ class Window(QtWidgets.QMainWindow):
             if (os.path.isdir(datadir) != True):
                 os.mkdir(datadir)
             label = self.ui.inputFileName.text()
+            # Create the file now so queued saves never share a name
             i = 0
-            while os.path.exists(datadir + '{}{}.csv'.format(label, i)):
-                i += 1
-            np.savetxt(datadir + '{}{}.csv'.format(label, i), 
-                        np.transpose([recording['in'], recording['out']]), 
-                        delimiter=";", fmt='%d',
-                        header="Sample rate: {}".format(125000000 / self.FPGA_config["CIC_divider"]))
+            while True:
+                try:
+                    open(datadir + '{}{}.csv'.format(label, i), 'x').close()
+                    break
+                except FileExistsError:
+                    i += 1
+            self.writer.submit(datadir + '{}{}.csv'.format(label, i), recording, "csv",
+                               delimiter=";", fmt='%d',
+                               header="Sample rate: {}".format(125000000 / self.FPGA_config["CIC_divider"]))
+            logging.debug("Save queued, writer {}".format(self.writer.stats()))
         
         # Close shared memory
         self.shared_mem.close()
         self.shared_mem.unlink()
         
         
+## Live scope
+    def ButtonPressScope(self):
+        if self.scope == 0:
+            if self.measurement:
+                logging.debug("Scope not started, measurement in progress")
+                return
+            self.scope = 1
+            self.buttonScope.setText("Stop Scope")
+            self.ui.buttonMeasurement.setEnabled(False)
+            #Send config before streaming
+            self.ButtonPressSend()
+            
+            # One frame per redraw at the target frame rate
+            sample_rate = 125000000 / self.FPGA_config["CIC_divider"]
+            self.scope_frame_samples = max(1, int(sample_rate / self.scope_fps))
+            packet = [0, self.FPGA_config, False, [False, self.scope_frame_samples * 4, self.scope_ring_frames]]
+            try:
+                self.data.GUI_to_data_Queue.put(packet, block=False)
+                # ScopeAllocated is called once the ring buffer exists
+            except:
+                logging.debug("Didn't send scope request to data process")
+        else:
+            self.StopScope()
+            
+    def ScopeAllocated(self, memory_name):
+        if self.scope == 0:
+            # Scope was stopped before the ring buffer arrived, release it
+            shared_mem = SharedMemory(name=memory_name, create=False)
+            shared_mem.close()
+            shared_mem.unlink()
+            return
+        self.scope_dtype = np.dtype([('in', np.int16), ('out', np.int16)])
+        self.shared_mem = SharedMemory(name=memory_name, create=False)
+        self.scope_count = np.ndarray((1,), dtype=np.uint64, buffer=self.shared_mem.buf)
+        self.scope_ring = np.ndarray((self.scope_ring_frames, self.scope_frame_samples),
+                                     dtype=self.scope_dtype,
+                                     buffer=self.shared_mem.buf, offset=sp._scope_header_bytes)
+        self.scope_frames_read = 0
+        
+        # Rolling display buffer, plus per-frame min/max so the axis limits
+        # never need a pass over the whole display
+        n_display = self.scope_frame_samples * self.scope_display_frames
+        self.scope_display = np.zeros((2, n_display), dtype=np.float32)
+        self.scope_envelopes = np.zeros((2, self.scope_display_frames, 2), dtype=np.float32)
+        self.scale=[float(self.ui.inputScal0.text()),float(self.ui.inputScal1.text()),float(self.ui.inputScal2.text()),float(self.ui.inputScal3.text())]
+        self.offset=[float(self.ui.inputOffset0.text()),float(self.ui.inputOffset1.text()),float(self.ui.inputOffset2.text()),float(self.ui.inputOffset3.text())]
+        
+        self.canvas.start_scope(n_display)
+        self.scope_timer.start(int(1000 / self.scope_fps))
+        
+    def scope_tick(self):
+        frames_written = int(self.scope_count[0])
+        new_frames = frames_written - self.scope_frames_read
+        if new_frames <= 0:
+            return
+        # If we have fallen a whole ring behind, skip to the newest frames.
+        # The slot the writer is filling is never read.
+        new_frames = min(new_frames, self.scope_ring_frames - 1, self.scope_display_frames)
+        first = frames_written - new_frames
+        self.scope_frames_read = frames_written
+        
+        n_new = new_frames * self.scope_frame_samples
+        self.scope_display[:, :-n_new] = self.scope_display[:, n_new:]
+        self.scope_envelopes[:, :-new_frames] = self.scope_envelopes[:, new_frames:]
+        for i, frame in enumerate(range(first, frames_written)):
+            samples = self.scope_ring[frame % self.scope_ring_frames]
+            start = len(self.scope_display[0]) - n_new + i * self.scope_frame_samples
+            stop = start + self.scope_frame_samples
+            for trace, (name, scale, offset) in enumerate((('in', self.scale[0], self.offset[0]),
+                                                           ('out', self.scale[2], self.offset[2]))):
+                view = self.scope_display[trace, start:stop]
+                np.multiply(samples[name], scale, out=view, casting='unsafe')
+                view += offset
+                slot = self.scope_display_frames - new_frames + i
+                self.scope_envelopes[trace, slot] = (view.min(), view.max())
+        
+        limits = [(self.scope_envelopes[trace, :, 0].min(), self.scope_envelopes[trace, :, 1].max())
+                  for trace in range(2)]
+        self.canvas.update_scope(self.scope_display, limits)
+        
+    def StopScope(self):
+        self.scope = 0
+        self.buttonScope.setText("Start Scope")
+        self.ui.buttonMeasurement.setEnabled(True)
+        self.scope_timer.stop()
+        try:
+            self.data.GUI_to_data_Queue.put([0, self.FPGA_config, False, [False, 0, -1]], block=False)
+        except:
+            logging.debug("Didn't send scope stop to data process")
+        try:
+            del self.scope_count, self.scope_ring
+            self.canvas.stop_scope()
+            self.shared_mem.close()
+            self.shared_mem.unlink()
+        except AttributeError:
+            # Stopped before the ring buffer was allocated
+            pass
+        
 ## Define button functions
     def ButtonPressSend(self):
         """Update FPGA config struct with variables from GUI """
@@ -472,7 +635,7 @@ class Window(QtWidgets.QMainWindow):
                 self.measurement = 1
                 self.ui.buttonMeasurement.setText("Stop Measurement") # change button text
                 # Start data recording monitoring
-                self.timer.start(250)
+                self.monitoring = True
                 
             except:
                 logging.debug("Didn't send config to data process")
@@ -481,7 +644,7 @@ class Window(QtWidgets.QMainWindow):
             self.measurement = 0
             self.ui.buttonMeasurement.setText("Start Measurement") # change button text
             # Stop data recording monitoring
-            self.timer.stop()
+            self.monitoring = False
             # Close shared memory
             self.shared_mem.close()
             self.shared_mem.unlink()
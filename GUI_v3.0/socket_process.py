@@ -7,8 +7,16 @@ import struct
 import logging
 import select
 import sys
+import event_log
 # import fabric
 
+# Scope ring buffer layout: uint64 count of completed frames, then the frames
+_scope_header_bytes = 8
+# Bytes requested per scope stream request (~45 minutes at 100 kHz)
+_scope_request_bytes = 1 << 30
+
+log = event_log.get_logger("socket")
+
 class StreamToLogger(object):
     """
     Fake file-like stream object that redirects writes to a logger instance.
@@ -46,6 +54,9 @@ class dataThread:
         self.trigger = False
         self.config_change = False
         self.record_request = False
+        self.scope_request = 0
+        # Messages that arrived while the scope was streaming, handled after
+        self.deferred = []
 
         #FPGA config struct
         self.config = { "trigger":0,
@@ -79,7 +90,7 @@ class dataThread:
 
      # **************** Local Inter-process Comms with GUI****************** #
 
-    def fetch_instructions(self):
+    def fetch_instructions(self, block=False):
         """ Get and save instructions from GUI thread:
 
             config: New config struct for FPGA
@@ -87,14 +98,26 @@ class dataThread:
             record request: First request from GUI, initiates shared memory setup and handshake
             trigger: Shared memory set up, ready to receive & send to GUI.
 
+            block: wait for the next instruction rather than returning False
+            when none is queued. The idle loop blocks so it sleeps until the
+            GUI sends something; the transfer loops poll.
+
         """
 
         try:
-            self.trigger, self.config, self.config_change, [self.record_request, self.bytes_to_receive] = self.GUI_to_data_Queue.get(block=False)
-            logging.debug("message received")
+            if self.deferred:
+                message = self.deferred.pop(0)
+            else:
+                message = self.GUI_to_data_Queue.get(block=block)
+            self.trigger, self.config, self.config_change, request = message
+            self.record_request, self.bytes_to_receive = request[:2]
+            # Optional third entry: number of frames to start a scope ring
+            # buffer with, or -1 to stop the scope.
+            self.scope_request = request[2] if len(request) > 2 else 0
+            log.debug("message received")
             return True
         except Exception as e:
-            #logging.debug(str(e))
+            #log.debug(str(e))
             return False
 
     def inform_GUI(self, event):
@@ -104,18 +127,48 @@ class dataThread:
 
         if event == "allocated":
             self.data_to_GUI_Queue.put([0, self.shared_memory_name], block=False)
-            logging.debug(self.shared_memory_name + "sent to GUI")
+            log.debug("%s sent to GUI", self.shared_memory_name)
 
         elif event == "data_ready":
             self.data_to_GUI_Queue.put([1, 0], block=False)
 
+        elif event == "scope_allocated":
+            self.data_to_GUI_Queue.put([2, self.shared_memory_name], block=False)
+            log.debug("%s (scope) sent to GUI", self.shared_memory_name)
+
+    def scope_stop_requested(self):
+        """Poll for the GUI's scope stop while streaming. Anything else
+        (e.g. a config change) is kept for the main loop, so it is handled
+        once the scope has stopped rather than lost."""
+        stop = False
+        while True:
+            try:
+                message = self.GUI_to_data_Queue.get(block=False)
+            except Exception:
+                return stop
+            request = message[3]
+            if len(request) > 2 and request[2] < 0:
+                stop = True
+            else:
+                self.deferred.append(message)
+
     def initiate_record(self):
         self.shared_mem = SharedMemory(size=self.bytes_to_receive, create=True)
         self.shared_memory_name = self.shared_mem.name
 
         #Tell GUI the memory is allocated
         self.inform_GUI("allocated")
-        logging.debug("inform GUI executed")
+        log.debug("inform GUI executed")
+    def initiate_scope(self):
+        """Allocate the scope's shared ring buffer: an 8-byte frame counter
+        followed by scope_request frames of bytes_to_receive bytes each."""
+        self.frame_bytes = self.bytes_to_receive
+        self.n_frames = self.scope_request
+        self.shared_mem = SharedMemory(size=_scope_header_bytes + self.frame_bytes * self.n_frames,
+                                       create=True)
+        self.shared_memory_name = self.shared_mem.name
+        self.inform_GUI("scope_allocated")
+
      # ************************ TCP Comms with RP MCU  ********************* #
 
     def send_settings_to_FPGA(self):
@@ -140,44 +193,42 @@ class dataThread:
 
         self.open_socket()
         if (self.initiate_transfer("config") < 1):
-            logging.debug("Socket type (config) not acknowledged by server")
+            log.warning("Socket type (config) not acknowledged by server")
         else:
             try:
                 self.s.sendall(config_send)
             except Exception as e:
-                logging.debug("config send error")
-                logging.debug(e)
+                log.warning("config send error: %s", e)
 
         self.close_socket()
-        logging.debug("FPGA settings sent")
+        log.debug("FPGA settings sent")
 
 
 
     def record(self):
         self.open_socket()
         if (self.initiate_transfer("recording") < 1):
-            logging.debug("Socket type (record) not acknowledged by server")
+            log.warning("Socket type (record) not acknowledged by server")
 
         #Create view of shared memory buffer
 
         view = memoryview(self.shared_mem.buf)
-        logging.debug("memory view created")
-        logging.debug("{} to receive".format(self.bytes_to_receive))
+        log.debug("memory view created")
+        log.debug("%s to receive", self.bytes_to_receive)
 
         # wait for trigger confirmation from server - process may get stuck in
         # this loop if trigger acknowledgement is lost
         if (self.wait_for_ack() != 1):
-            logging.debug("Record acknowledge not received")
+            log.warning("Record acknowledge not received")
             return
 
-        logging.debug("start receive")
+        log.debug("start receive")
 
         while (self.bytes_to_receive):
             #Load info into array in nbyte chunks
             nbytes = self.s.recv_into(view, self.bytes_to_receive)
             view = view[nbytes:]
             self.bytes_to_receive -= nbytes
-            logging.debug(self.bytes_to_receive)
 
         self.purge_socket()
         self.close_socket()
@@ -187,16 +238,70 @@ class dataThread:
         self.shared_mem.close()
         del self.shared_mem
 
+    def scope(self):
+        """Stream fixed-size frames into the shared ring buffer until the GUI
+        asks to stop. Frame n goes into slot n % n_frames, and the frame
+        counter at the head of the buffer is only advanced once a frame is
+        complete, so the GUI can read every slot behind the counter."""
+        frames_written = np.ndarray((1,), dtype=np.uint64, buffer=self.shared_mem.buf)
+        frames_written[0] = 0
+        ring = memoryview(self.shared_mem.buf)[_scope_header_bytes:]
+        # One long request instead of one per frame, so there are no
+        # handshake gaps in the stream.
+        frames_per_request = max(1, _scope_request_bytes // self.frame_bytes)
+        streaming = True
+
+        while streaming:
+            self.bytes_to_receive = frames_per_request * self.frame_bytes
+            self.open_socket()
+            if (self.initiate_transfer("recording") < 1 or self.wait_for_ack() != 1):
+                log.warning("Scope stream not acknowledged by server")
+                break
+
+            for _ in range(frames_per_request):
+                slot = int(frames_written[0]) % self.n_frames
+                view = ring[slot * self.frame_bytes:(slot + 1) * self.frame_bytes]
+                remaining = self.frame_bytes
+                while remaining:
+                    nbytes = self.s.recv_into(view, remaining)
+                    if not nbytes:
+                        log.warning("Scope stream closed by server")
+                        streaming = False
+                        break
+                    view = view[nbytes:]
+                    remaining -= nbytes
+                del view
+                if not streaming:
+                    break
+                frames_written[0] += 1
+
+                if self.scope_stop_requested():
+                    streaming = False
+                    break
+
+            if streaming:
+                # Request complete, so the server has stopped sending
+                self.purge_socket()
+            # Stopped mid-request: close without purging, or the rest of the
+            # request would be drained first. The trigger off sent next
+            # stops the server.
+            self.close_socket()
+
+        del frames_written, ring
+        self.shared_mem.close()
+        del self.shared_mem
+        self.scope_request = 0
+
     def wait_for_ack(self, ack_value=1):
         """ Wait for an acknowledge byte from MCU. If no byte or incorrect value
         received, log error and return -1. Returns 1 on ack. """
         ack = int.from_bytes(self.s.recv(4), "little", signed=False)
-        logging.debug("Ack value received: {}, expected {}".format(ack, ack_value))
+        log.debug("Ack value received: %s, expected %s", ack, ack_value)
         
         if ack == ack_value:
             return 1
         else:
-            logging.debug("Bad acknowledge")
+            log.warning("Bad acknowledge")
             return -1
 
     def purge_socket(self):
@@ -215,7 +320,7 @@ class dataThread:
                 purged = self.s.recv(16384)
                 print("{} bytes received in purge, header = {} {} {} {}".format(len(purged), purged[0], purged[1], purged[3], purged[4]))
             except Exception as e:
-                logging.debug("Purge recv error: {}".format(e))
+                log.debug("Purge recv error: %s", e)
                 break
 
     def close_socket(self):
@@ -230,7 +335,7 @@ class dataThread:
         try:
             self.s.connect((self.ip, self.port))
         except Exception as e:
-            logging.debug(e)
+            log.debug(e)
 
     def initiate_transfer(self, type='config'):
         """ Send request info to MCU, await acknowledgement. Sends 4-byte 0 to initiate
@@ -256,42 +361,51 @@ class dataThread:
         """
             """
 
-        #Set up socketlog.log debug log
-        logging.basicConfig(filename='socketlog.log',
-                            level=logging.DEBUG,
-                            format='%(asctime)s %(message)s',
-                            datefmt='%m/%d/%Y %I:%M:%S %p')
+        #Set up socketlog.log, written by a background thread so the
+        #receive loop never waits on the disk
+        event_log.configure('socketlog.log', level=logging.INFO)
 
-        logging.debug('Logfile initialised')
-        log = logging.getLogger('socket')
-        sys.stdout = StreamToLogger(log, logging.DEBUG)
-        sys.stderr = StreamToLogger(log, logging.DEBUG)
+        log.info('Logfile initialised')
+        sys.stdout = StreamToLogger(event_log.get_logger('stdout'), logging.INFO)
+        sys.stderr = StreamToLogger(event_log.get_logger('stderr'), logging.WARNING)
 
 
         while(True):
-             # Check for instructions and dispatch accordingly
-            if self.fetch_instructions():
+             # Wait for instructions and dispatch accordingly
+            if self.fetch_instructions(block=True):
 
                 if self.config_change:
                     self.send_settings_to_FPGA()
                     self.config_change = 0
 
                 elif self.record_request:
-                    logging.debug("request received")
+                    log.debug("request received")
                     self.initiate_record()
                     self.record_request = False
 
+                elif self.scope_request > 0:
+                    log.debug("scope request received")
+                    self.initiate_scope()
+                    self.config['trigger'] = 1
+                    self.send_settings_to_FPGA()
+
+                    self.scope()
+
+                    self.config['trigger'] = 0
+                    self.send_settings_to_FPGA()
+                    log.debug("Scope stopped, trigger off sent")
+
                 elif self.trigger:
                     #Trigger FPGA, start recording
                     self.config['trigger'] = 1
                     self.send_settings_to_FPGA()
-                    logging.debug("{} to receive".format(self.bytes_to_receive))
+                    log.debug("%s to receive", self.bytes_to_receive)
 
                     self.record()
 
                     self.config['trigger'] = 0
                     self.send_settings_to_FPGA()
-                    logging.debug("Trigger off sent")
+                    log.debug("Trigger off sent")
 
                 else:
                     sleep(0.1)
@@ -304,8 +418,8 @@ class dataThread:
         """End process and close socket when GUI is closed"""
 
         self.isrun = False
-        logging.debug("Close called")
-        logging.debug("{} s".format(self.s))
+        log.debug("Close called")
+        log.debug("%s s", self.s)
 
         if self.process_isRun:
             self.process.terminate()
@@ -313,4 +427,4 @@ class dataThread:
 
         if self.s != None:
             self.s.close()
-            logging.debug("socket closed")
+            log.debug("socket closed")
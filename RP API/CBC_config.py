@@ -6,13 +6,13 @@ Created on Thu Jul 20 16:54:25 2023
 CBC config class.
 Dictionary which stores desired physical parameters for combined CBC settings.
 
-Class overrides __getattr__ and __setattr__ methods so that each key can be
-called as an attribute, for convenience in API calls.
-
-Overrides __setitem__ to not allow any non-specified keys to be added.
+Each key can be read and set as an item or as an attribute, for convenience in
+API calls. Keys can't be added, and values are type and limit checked on every
+set - see _config_record.py.
 
 """
 from _utils import *
+from _config_record import config_record
 
 _CBC_keys = ["CBC_enabled",
              "input_order",
@@ -95,55 +95,6 @@ _limits = {"CBC_enabled": [0, 1],
 
 
 
-class CBC_config(dict):
-
-    def __init__(self, default_values=None):
-        super().__init__({key: 0 for key in _CBC_keys})
-        if default_values:
-            for key, value in default_values.items():
-                if key in _CBC_keys:
-                    self[key] = value
-                else:
-                    print(f"Warning: The key '{key}' is not included in CBC settings and has been discarded.")
-
-    def __getattr__(self, item):
-        if item in self:
-            return self[item]
-        else:
-            raise AttributeError(f"'CBC Config' object has no attribute '{item}'")
-
-    def __setattr__(self, key, value):
-        self[key] = value
-
-    def __setitem__(self, key, value):
-        """Check that key is part of the allowed list, then perform type and
-        value checks before setting any items. """
-
-        if key in _CBC_keys:
-
-            if type(value) == _datatypes[key]:
-                if self.is_within_limits(value, _limits[key]):
-                    super().__setitem__(key, value)
-                else:
-                    raise ValueError(f"{value} is outside of _limits for {key}, which are {_limits[key]}")
-
-            elif _datatypes[key] == float and type(value) == int:
-                if self.is_within_limits(value, _limits[key]):
-                    super().__setitem__(key, float(value))
-                else:
-                    raise ValueError(f"{value} is outside of _limits for {key}, which are {_limits[key]}")
-
-            else:
-                raise TypeError(f"Parameter entered is of type '{type(value)}' whereas {key} expects a parameter of type {_datatypes[key]}")
-        else:
-            raise KeyError(f"'Channel Config' object does not support adding new keys. Key '{key}' rejected")
-
-    def is_within_limits(self, value, limits):
-        if type(limits[0]) == str:
-            return value in limits
-
-        else:
-            if len(limits) != 2:
-                raise ValueError("_limits list must contain exactly two items.")
-            lower_limit, upper_limit = sorted(limits)
-            return lower_limit <= value <= upper_limit
+class CBC_config(config_record, keys=_CBC_keys, datatypes=_datatypes,
+                 limits=_limits, name="CBC Config", limits_label="_limits"):
+    __slots__ = ()
@@ -15,6 +15,7 @@ fingers out of this portion of the code - already sanitised inputs from config
 dicts allowed only.
 
 """
+from _config_record import config_record
 
 config_keys = ["system",
                "CH1_settings",
@@ -36,34 +37,11 @@ config_keys = ["system",
                "Parameter_N",
                ]
 
+# struct format of the config packet sent to the server, in config_keys order
+# (60 bytes)
+config_format = "BBBBiiiiiiiiiiiiii"
 
-class FPGA_config(dict):
 
-    def __init__(self, default_values=None):
-        super().__init__({key: 0 for key in config_keys})
-        if default_values:
-            for key, value in default_values.items():
-                if key in config_keys:
-                    self[key] = value
-                else:
-                    raise KeyError(f"Warning: The key '{key}' is not included in CBC settings and has been discarded.")
-
-
-    def __getattr__(self, item):
-        if item in self:
-            return self[item]
-        else:
-            raise AttributeError(f"'FPGA Config' object has no attribute '{item}'")
-
-    def __setattr__(self, key, value):
-        self[key] = value
-
-    def __setitem__(self, key, value):
-        """Check that key is part of the allowed list, then perform type and
-        value checks before setting any items. """
-
-        if key in config_keys:
-            super().__setitem__(key, value)
-
-        else:
-            raise KeyError(f"'FPGA Config' object does not support adding new keys")
+class FPGA_config(config_record, keys=config_keys, name="FPGA Config",
+                  unknown_default="raise"):
+    __slots__ = ()
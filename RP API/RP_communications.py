@@ -6,17 +6,21 @@ data transfer into and out of the RedPitaya from the PC.
 
 @author: cca78
 """
-from multiprocessing import Process
+from multiprocessing import Process, Queue, Event, RawValue
+import queue
 from multiprocessing.shared_memory import SharedMemory
 from time import sleep
-import numpy as np
 import socket
 import struct
 import logging
 import select
 import sys
 import traceback
-from FPGA_config import FPGA_config, config_keys
+from FPGA_config import FPGA_config, config_keys, config_format
+from profiling import session, span
+import event_log
+
+log = event_log.get_logger("comms")
 
 
 class StreamToLogger(object):
@@ -62,6 +66,7 @@ class RP_communications(object):
         #State toggles and counters
         self.process = None
         self.bytes_to_receive = 0
+        self.bytes_received = 0
 
         #FPGA config dict
         self.config = FPGA_config()
@@ -70,16 +75,24 @@ class RP_communications(object):
         self.port = port
         self.ip = ip
         self.socket = None
+        # Stand-in for the board (replay.replay_source), or None
+        self.source = None
     
         
     # =========================================================================
     # Communications with the RP
     # =========================================================================
-    def send_settings_to_FPGA(self):
+    def send_settings_to_FPGA(self, packed=None):
         """
         Called by RP.update_FPGA_settings()
         Opens the socket and sends updates to the server by. Changes of settings
         made by the config dictionaries in RP.FPGA_config, RP.channel, and RP.CBC.
+
+        Parameters
+        ----------
+        packed : bytes-like, optional
+            An already packed config (e.g. from campaign.py) to send instead.
+            self.config is updated to match it. The default is None.
         
         Returns
         -------
@@ -87,37 +100,45 @@ class RP_communications(object):
 
         """
         # Get config and package into c-readable struct
-        format_ = "BBBBiiiiiiiiiiiiii"
-        
-        logging.debug(self.config)
-        
-        values_to_pack = [self.config[key] for key in config_keys]
-
-        config_send = struct.pack(format_, *values_to_pack)
-        logging.debug("################ FPGA SIMULATION INFO #################")
-        logging.debug("Hex below is the config signal (S_AXIS_CFG) for CBC portion of the config bus:")
-        logging.debug(config_send[4:][::-1].hex())
-        logging.debug("Hex below is the config signal (S_AXIS_CFG) for CH1:")
-        logging.debug(config_send[4:28][::-1].hex())
-        logging.debug("Hex below is the config signal (S_AXIS_CFG) for CH2:")
-        logging.debug(config_send[28:52][::-1].hex())
-        logging.debug("################ END FPGA NONSENSE #################")
+        with span("packing"):
+            if packed is None:
+                values_to_pack = [self.config[key] for key in config_keys]
+                config_send = struct.pack(config_format, *values_to_pack)
+            else:
+                config_send = bytes(packed)
+                self.config.update(zip(config_keys, struct.unpack(config_format, config_send)))
+
+        # Config dump and FPGA simulation hex, only built when comms is
+        # logging at DEBUG
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", dict(self.config))
+            log.debug("################ FPGA SIMULATION INFO #################")
+            log.debug("Hex below is the config signal (S_AXIS_CFG) for CBC portion of the config bus:")
+            log.debug(config_send[4:][::-1].hex())
+            log.debug("Hex below is the config signal (S_AXIS_CFG) for CH1:")
+            log.debug(config_send[4:28][::-1].hex())
+            log.debug("Hex below is the config signal (S_AXIS_CFG) for CH2:")
+            log.debug(config_send[28:52][::-1].hex())
+            log.debug("################ END FPGA NONSENSE #################")
+
+        if self.source is not None:
+            self.source.configure(config_send)
+            return
 
         self.open_socket()
         if (self.initiate_transfer("config") < 1):
-            logging.debug("Socket type (config) not acknowledged by server")
+            log.warning("Socket type (config) not acknowledged by server")
         else:
             try:
                 self.socket.sendall(config_send)
             except Exception as e:
-                logging.debug("config send error")
-                logging.debug(e)
+                log.warning("config send error: %s", e)
 
         self.close_socket()
-        logging.debug("FPGA settings sent")
+        log.debug("FPGA settings sent")
         
         
-    def recording_process(self, shared_memory_name):
+    def recording_process(self, shared_memory_name, should_stop=None, poll_interval=0.05):
         """
         Called by RP.start_record()
         Opens a new parallel thread (process) to enable sampling measurments 
@@ -128,6 +149,12 @@ class RP_communications(object):
         shared_memory_name : TYPE 
             Reference to shared memory address(?)
             TODO2: add datatype (its a string?)
+        should_stop : callable, optional
+            Called every poll_interval seconds with the number of bytes
+            received so far. Returning True ends the recording early. The
+            default is None, meaning receive everything.
+        poll_interval : float, optional
+            Seconds between should_stop calls. The default is 0.05.
 
         Returns
         -------
@@ -145,12 +172,31 @@ class RP_communications(object):
         # sys.stdout = StreamToLogger(log, logging.DEBUG)
         # sys.stderr = StreamToLogger(log, logging.DEBUG)
         
-        self.rec_process = Process(target=self.record, args=(shared_memory_name,))   
+        # Spans timed in the recording process come back through span_queue.
+        # progress counts bytes received, and setting stop ends the transfer.
+        self.bytes_received = 0
+        span_queue = Queue()
+        progress = RawValue('q', 0)
+        stop = Event()
+        self.rec_process = Process(target=self.record, args=(shared_memory_name, span_queue, progress, stop))   
         self.rec_process.start()
+        timeout = 0.5 if should_stop is None else poll_interval
+        while True:
+            try:
+                session.merge(span_queue.get(timeout=timeout))
+                break
+            except queue.Empty:
+                if should_stop is not None and not stop.is_set() and should_stop(progress.value):
+                    stop.set()
+                if not self.rec_process.is_alive():
+                    break
         self.rec_process.join()       
         self.rec_process.close()  
+        self.bytes_received = progress.value
+        if self.source is not None:
+            self.source.advance(self.bytes_received)
         
-    def record(self, shared_memory_name):
+    def record(self, shared_memory_name, span_queue=None, progress=None, stop=None):
         """
         Called by RP.start_record()
         This function is called as a Process item. Measurements from hardware 
@@ -161,42 +207,82 @@ class RP_communications(object):
         shared_memory_name : TYPE 
             Reference to shared memory address(?)
             TODO2: add datatype (its a string?)
+        span_queue : multiprocessing.Queue, optional
+            Profiling spans timed in this process are put here when it ends.
+        progress : multiprocessing.RawValue('q'), optional
+            Updated with the number of bytes received.
+        stop : multiprocessing.Event, optional
+            When set, stop receiving and close the socket.
 
         Returns
         -------
         None.
         
         """
-        
-        self.open_socket()
-        if (self.initiate_transfer("recording") < 1):
-            logging.debug("Socket type (record) not acknowledged by server")
+        # A forked process starts with a copy of the parent's spans; drop
+        # them so only this recording's are sent back
+        session.clear()
+        try:
+            self._record(shared_memory_name, progress, stop)
+        finally:
+            if span_queue is not None:
+                span_queue.put(session.take())
+
+    def _record(self, shared_memory_name, progress=None, stop=None):
+        # Restart the log writer in this process (a forked copy doesn't run)
+        event_log.configure()
+        if self.source is not None:
+            connection = self.source.connect(self.bytes_to_receive)
+        else:
+            self.open_socket()
+            if (self.initiate_transfer("recording") < 1):
+                log.warning("Socket type (record) not acknowledged by server")
+            connection = self.socket
 
         #Create view of shared memory buffer
         self.shared_mem = SharedMemory(name=shared_memory_name, size=self.bytes_to_receive, create=False)
         
         
         view = memoryview(self.shared_mem.buf)
-        logging.debug("memory view created")
-        logging.debug("{} to receive".format(self.bytes_to_receive))
+        log.debug("memory view created")
+        log.debug("%d to receive", self.bytes_to_receive)
 
         # wait for trigger confirmation from server - process may get stuck in
         # this loop if trigger acknowledgement is lost
-        if (self.wait_for_ack() != 1):
-            logging.debug("Record acknowledge not received")
+        if self.source is None and (self.wait_for_ack() != 1):
+            log.warning("Record acknowledge not received")
             return
 
-        logging.debug("start receive")
-
-        while (self.bytes_to_receive):
-            #Load info into array in nbyte chunks
-            nbytes = self.socket.recv_into(view, self.bytes_to_receive)
-            view = view[nbytes:]
-            self.bytes_to_receive -= nbytes
-            #logging.debug(self.bytes_to_receive)
-
-        self.purge_socket()
-        self.close_socket()
+        log.debug("start receive")
+
+        received = 0
+        stopped = False
+        with span("receive"):
+            while (self.bytes_to_receive):
+                #Load info into array in nbyte chunks
+                nbytes = connection.recv_into(view, self.bytes_to_receive)
+                if not nbytes:
+                    log.warning("Connection closed with %d bytes still to receive", self.bytes_to_receive)
+                    break
+                view = view[nbytes:]
+                self.bytes_to_receive -= nbytes
+                #log.debug("%d", self.bytes_to_receive)
+                if progress is not None:
+                    received += nbytes
+                    progress.value = received
+                if stop is not None and stop.is_set():
+                    stopped = True
+                    break
+
+        if stopped:
+            # Cut short: drop the connection rather than draining the rest
+            # of the capture, which is the time being saved.
+            event_log.log_event(log, logging.INFO, "record stopped early",
+                                received=received, remaining=self.bytes_to_receive)
+        elif self.source is None:
+            self.purge_socket()
+        if self.source is None:
+            self.close_socket()
 
         del view
         self.shared_mem.close()
@@ -225,17 +311,18 @@ class RP_communications(object):
         """
         
         if type == 'config':
-            payload = np.uint32(0)
+            payload = struct.pack("<I", 0)
             ack_value = 2
         if type == 'recording':
-            payload = np.uint32(self.bytes_to_receive)
-            ack_value = np.uint32(self.bytes_to_receive)
-
-        self.socket.sendall(payload)
-        if (self.wait_for_ack(ack_value) == 1):
-            return 1
-        else:
-            return -1
+            payload = struct.pack("<I", self.bytes_to_receive)
+            ack_value = self.bytes_to_receive
+
+        with span("handshake"):
+            self.socket.sendall(payload)
+            if (self.wait_for_ack(ack_value) == 1):
+                return 1
+            else:
+                return -1
     
     def wait_for_ack(self, ack_value=1):
         """
@@ -258,12 +345,12 @@ class RP_communications(object):
         
 
         ack = int.from_bytes(self.socket.recv(4), "little", signed=False)
-        logging.debug("Ack value received: {}, expected {}".format(ack, ack_value))
+        log.debug("Ack value received: %d, expected %d", ack, ack_value)
 
         if ack == ack_value:
             return 1
         else:
-            logging.debug("Bad acknowledge")
+            log.warning("Bad acknowledge: %d, expected %d", ack, ack_value)
             return -1
     
     # =========================================================================
@@ -273,9 +360,10 @@ class RP_communications(object):
         """Open generic client socket."""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         try:
-            self.socket.connect((self.ip, self.port))
+            with span("connect"):
+                self.socket.connect((self.ip, self.port))
         except Exception as e:
-            logging.debug(e)
+            log.warning("connect to %s:%d failed: %s", self.ip, self.port, e)
             
             
     def close_socket(self):
@@ -301,9 +389,12 @@ class RP_communications(object):
                                                   2)
             try:
                 purged = self.socket.recv(16384)
-                logging.debug("{} bytes received in purge, header = {} {} {} {}".format(len(purged), purged[0], purged[1], purged[3], purged[4]))
+                if not purged:
+                    # Server closed the connection
+                    break
+                log.debug("%d bytes received in purge, header = %s", len(purged), purged[:5].hex())
             except Exception as e:
-                logging.debug("Purge recv error: {}".format(e))
+                log.debug("Purge recv error: %s", e)
                 break
             
 
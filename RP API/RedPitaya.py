@@ -4,20 +4,32 @@ Created on Thu Jul 20 16:50:13 2023
 
 @author: cca78
 """
-from channel import channel
+from channel import channel, _modes_params
 from CBC import CBC
 from system import system
-from mem_mapping import update_FPGA_channel, update_FPGA_config
+from mem_mapping import FPGA_settings
+from _config_record import config_hash
+from convergence import steady_state_detector
+from calibration import calibration_table, board_calibration, calibrated_recording
+from envelope import MinMaxPyramid, attach_envelope
+from profiling import span, timed
+import event_log
 import numpy as np
 from time import sleep
 import os
-import traceback
 import logging
 from multiprocessing.shared_memory import SharedMemory
 from time import gmtime, strftime
-import matplotlib.pyplot as plt
+from collections import namedtuple
+
+log = event_log.get_logger("api")
+
+# Frozen copy of every config, from RedPitaya.snapshot(). Hashable, so it can
+# key caches and deduplicate sweep points.
+rp_snapshot = namedtuple("rp_snapshot", ["CH1", "CH2", "CBC", "system"])
+
+_recording_dtype = np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)])
 
-#Todo: create config.txt file to save and load offset, scale parameters, modifiable with a button push (maybe?)
 #Todo: recording progress bar/readout
 
 class RedPitaya():
@@ -44,13 +56,27 @@ class RedPitaya():
         
         self.measurement=0
         self.num_samples = 0
-
-
-        logging.basicConfig(filename='APIlog.log',
-                            level=logging.DEBUG,
-                            format='%(asctime)s.%(msecs)03d %(message)s',
-                            datefmt='%m/%d/%Y %I:%M:%S')
-        logging.debug('Logfile initialised')
+        self.recording = None
+        self.recording_snapshot = None
+        self.envelopes = None
+        self.time_saved = 0
+        self.steady_from = None
+        # Nominal gain and offset until load_calibration()
+        self.calibration = board_calibration()
+        # Index of saved recordings, opened on the first save
+        self.catalog = None
+        # Save on the writer thread (writer.py) rather than in
+        # MeasureFinished. RP.writer.flush() waits for the saves to finish.
+        self.background_save = False
+        # "csv", "npy", or "rpz" for compressed binary (storage.py)
+        self.save_format = "csv"
+        self.writer = None
+
+
+        # Written by a background thread. Raise a subsystem to DEBUG with
+        # e.g. event_log.configure(levels={"comms": logging.DEBUG})
+        event_log.configure('APIlog.log', level=logging.INFO)
+        log.info('Logfile initialised')
                 
         
     
@@ -136,12 +162,184 @@ class RedPitaya():
         elif channel == "CBC":
             self.CBC.print_config()
         elif channel == "Both":
-            logging.debug ("{:<25} {:<20} {:<20} ".format("Key", "Channel 1", "Channel 2"))
+            log.info("%-25s %-20s %-20s ", "Key", "Channel 1", "Channel 2")
             for key in self.CH1.config.keys():
-                logging.debug ("{:<25} {:<20} {:<20} ".format(key, str(self.CH1.config[key]), str(self.CH2.config[key])))
+                log.info("%-25s %-20s %-20s ", key, self.CH1.config[key], self.CH2.config[key])
         else:
             raise ValueError("'channel' must be be either 'CH1', 'CH2' or 'Both', or 'CBC'.")
 
+    def snapshot(self):
+        """
+        Returns an immutable, hashable snapshot of the CH1, CH2, CBC and
+        system configs. Equal settings give equal snapshots, so they can be
+        used as dict keys or set members, e.g. to drop repeated points from
+        a list of settings to be measured.
+
+        Returns
+        -------
+        rp_snapshot namedtuple of (CH1, CH2, CBC, system) frozen configs.
+
+        Usage
+        ----------
+        Ex.1
+        before = RP.snapshot()
+        RP.set_frequency("CH1", 20)
+        RP.restore_snapshot(before)
+            -> Puts every config back as it was.
+        """
+        return rp_snapshot(self.CH1.config.freeze(),
+                           self.CH2.config.freeze(),
+                           self.CBC.config.freeze(),
+                           self.system.config.freeze())
+
+    def restore_snapshot(self, snapshot):
+        """
+        Replace the CH1, CH2, CBC and system configs with those held in a
+        snapshot from RP.snapshot(). Sends nothing to the FPGA, call
+        RP.update_FPGA_settings() after.
+
+        Parameters
+        ----------
+        snapshot : rp_snapshot
+
+        Returns
+        -------
+        None.
+        """
+        self.CH1.config = self.CH1.config.thaw(snapshot.CH1)
+        self.CH2.config = self.CH2.config.thaw(snapshot.CH2)
+        self.CBC.config = self.CBC.config.thaw(snapshot.CBC)
+        self.system.config = self.system.config.thaw(snapshot.system)
+
+    def plan_sweep(self, order="serpentine", model=None, **axes):
+        """
+        Plan a sweep over every combination of the given values, applied to
+        the current settings. Every value is checked against the config
+        limits now, and the points are ordered to keep settling time down
+        (see sweep_planner.py). Run it with RP.run_sweep().
+
+        Parameters
+        ----------
+        order : 'grid', 'serpentine' or 'hysteresis', optional
+            The default is 'serpentine'.
+        model : sweep_planner.settling_model, optional
+            Settling time estimates. The default is None, meaning the
+            default model.
+        **axes : axis name=sequence of values
+            Named <config>_<parameter>, e.g. CBC_frequency, CH1_mode, or
+            'duration'. Also axis_order, sweep_axis and unique, passed to
+            sweep_planner.plan_sweep().
+
+        Returns
+        -------
+        sweep_planner.sweep_plan.
+
+        Usage
+        ----------
+        Ex.1
+        plan = RP.plan_sweep(CBC_reference_amplitude=[0.1, 0.2],
+                             CBC_frequency=np.linspace(94e3, 101e3, 71))
+            -> 142 points, frequency stepped up then down between amplitudes
+        """
+        # Imported on use, like the other optional parts of the API below,
+        # so importing RedPitaya stays fast
+        from sweep_planner import plan_sweep
+        return plan_sweep(self.snapshot(), order=order, model=model, **axes)
+
+    def compile_sweep(self, plan, workers=None):
+        """
+        Config packets for every point of a plan, validated and mapped in
+        worker processes (see campaign.py), starting from the config now on
+        the board. Pass the result to RP.run_sweep(compiled=...).
+
+        Returns
+        -------
+        campaign.compiled_campaign, with any errors in .errors.
+
+        """
+        from campaign import compile_plan
+        return compile_plan(plan, initial=self.system.comms.config, workers=workers)
+
+    def run_sweep(self, plan, savename=None, save=True, ramps=False, min_ramp_points=3, compiled=None,
+                  **record_options):
+        """
+        Measure each point of a plan from RP.plan_sweep() in turn: restore
+        its settings, send them to the FPGA, wait its settle time, and
+        record. A generator, so results can be handled (or the sweep
+        stopped) as they arrive.
+
+        With ramps, runs of evenly stepped points are measured as one
+        recording with the parameter ramped by the FPGA, which is split
+        back into one segment per point (see
+        sweep_planner.hardware_ramps()). This saves a config update and
+        recording round trip per point.
+
+        Parameters
+        ----------
+        plan : sweep_planner.sweep_plan
+        savename : str, optional
+            Recordings are saved as <savename>_<point number>, or
+            <savename>_<first>-<last> for a ramp. The default is None,
+            meaning the time of each recording.
+        save : bool, optional
+            The default is True.
+        ramps : bool, optional
+            Ramp runs of points in hardware. The default is False.
+        min_ramp_points : int, optional
+            Shortest run worth ramping. The default is 3.
+        compiled : campaign.compiled_campaign, optional
+            Packets from RP.compile_sweep(plan), sent for stepped points
+            instead of mapping each point as it comes. Points which failed
+            to compile are skipped. The default is None.
+        **record_options
+            Passed to RP.start_record(), e.g. transient='trim'. Ramp
+            recordings are taken without monitor or transient, as their
+            length is fixed by the ramp.
+
+        Yields
+        ------
+        (sweep_planner.sweep_point, recording), with a ramp's points each
+        given their segment of the ramp recording. Points whose recording
+        failed are logged and skipped.
+
+        """
+        from sweep_planner import hardware_ramps, split_ramp, sweep_batch
+        if ramps:
+            batches = hardware_ramps(plan, min_points=min_ramp_points)
+        else:
+            batches = [sweep_batch(number, number, None, None) for number in range(len(plan))]
+        ramp_options = {key: value for key, value in record_options.items() if key not in ("monitor", "transient")}
+
+        for batch in batches:
+            first = plan.point(batch.first)
+            packed = None
+            if compiled is not None and batch.axis is None:
+                if not compiled.valid[batch.first]:
+                    log.warning("Sweep point %d skipped, it did not compile", batch.first)
+                    continue
+                packed = compiled.packed(batch.first)
+            self.restore_snapshot(batch.snapshot or first.snapshot)
+            self.update_FPGA_settings(packed)
+            if first.settle > 0:
+                sleep(first.settle)
+            points = batch.last - batch.first + 1
+            event_log.log_event(log, logging.INFO, "sweep point", number=batch.first, points=points,
+                                of=len(plan), ramp=batch.axis, settle=round(first.settle, 3))
+            if batch.axis is None:
+                name = "{}_{:04d}".format(savename, batch.first) if savename else None
+                self.start_record(savename=name, save=save, **record_options)
+            else:
+                name = "{}_{:04d}-{:04d}".format(savename, batch.first, batch.last) if savename else None
+                self.start_record(savename=name, save=save, **ramp_options)
+            if self.recording is None:
+                log.warning("Sweep points %d-%d skipped, the recording failed", batch.first, batch.last)
+                continue
+            if batch.axis is None:
+                yield first, self.recording
+            else:
+                for number, segment in zip(range(batch.first, batch.last + 1), split_ramp(self.recording, points)):
+                    yield plan.point(number), segment
+
     # =========================================================================
     # Functions for changing parameter dictionaries.
     # =========================================================================    
@@ -318,7 +516,7 @@ class RedPitaya():
                 CH1_mode = CHx_mode[0]
                 CH2_mode = CHx_mode[1]
             if len(CHx_mode) > 2:
-                logging.debug("Warning: Only first two '*CHx_mode' arguments are considered. Additional arguments will be ignored.")
+                log.warning("Only first two '*CHx_mode' arguments are considered. Additional arguments will be ignored.")
         else:
             CH1_mode = "off"
             CH2_mode = "off"
@@ -337,7 +535,7 @@ class RedPitaya():
             self.CBC.config["CBC_enabled"] = False
         elif channel == "CBC":
             if CHx_mode:
-                logging.debug("Warning: 'CHx_mode' arguments are not used in CBC mode, and will be ignored.")
+                log.warning("'CHx_mode' arguments are not used in CBC mode, and will be ignored.")
             self.CH1.set_mode('off')
             self.CH2.set_mode('off')
             self.CBC.config["CBC_enabled"] = True
@@ -433,11 +631,11 @@ class RedPitaya():
             if isinstance(gains, (list, tuple)) and len(gains) == 1:
                 self.CBC.set_param('proportional_gain', gains[0])
                 self.CBC.set_param('derivative_gain', 0)
-                logging.debug("Warning - only one value found in 'gains'. Value for derivative_gain has been ignored.")
+                log.warning("only one value found in 'gains'. Value for derivative_gain has been ignored.")
             elif isinstance(gains, (float, int)):
                 self.CBC.set_param('proportional_gain', gains)
                 self.CBC.set_param('derivative_gain', 0)
-                logging.debug("Warning - only one value found in 'gains'. Value for derivative_gain has been ignored.")
+                log.warning("only one value found in 'gains'. Value for derivative_gain has been ignored.")
         else:
             raise ValueError("'channel' must be be 'CBC'.")
 
@@ -457,10 +655,16 @@ class RedPitaya():
     # =========================================================================
     # Functions for communicating and taking measurements from FPGA
     # =========================================================================    
-    def update_FPGA_settings(self):
+    def update_FPGA_settings(self, packed=None):
         """
         This function opens a socket to the FPGA and updates all config dictionaries. 
         The configurations updated depend on the current mode (CHx or CBC).
+
+        Parameters
+        ----------
+        packed : bytes-like, optional
+            Config packet already compiled for the current settings (see
+            campaign.py), sent as is. The default is None.
         
         Returns
         -------
@@ -473,27 +677,53 @@ class RedPitaya():
             RP.update_FPGA_settings()
                 -> Changes the 'duration' value in the FPGA
         """
-        if self.CBC.config.CBC_enabled:
-            update_FPGA_channel('CBC', self.CBC.config, self.system.comms.config)
-        else:
-            update_FPGA_channel(1, self.CH1.config, self.system.comms.config)
-            update_FPGA_channel(2, self.CH2.config, self.system.comms.config)
-            
-        update_FPGA_config(self.system.config, self.system.comms.config)
+        if packed is None:
+            with span("config mapping"):
+                # Memoised on the snapshot, so settings sent before aren't
+                # converted again.
+                self.system.comms.config.update(FPGA_settings(*self.snapshot()))
         
         try:
             # This is the only change compared to 'update_FPGA'. Essentially removes the Queue item
-            self.system.send_settings_to_FPGA()
-            logging.debug("FPGA settings successfully updated.")
+            self.system.send_settings_to_FPGA(packed)
+            log.info("FPGA settings successfully updated.")
         except Exception:
-            logging.debug("An exception occured. FPGA settings could not be updated.")
-            logging.debug(traceback.format_exc())
+            log.exception("An exception occured. FPGA settings could not be updated.")
             pass
     
 
 
     
-    def start_record(self, savename=None):
+    def replay(self, source):
+        """
+        Take recordings from a stored capture instead of the board, through
+        the same recording process, shared memory and post-processing (see
+        replay.py). Config packets are kept in source.configs rather than
+        sent.
+
+        Parameters
+        ----------
+        source : replay.replay_source, or None
+            None goes back to the board.
+
+        Returns
+        -------
+        None.
+
+        Usage
+        ----------
+        Ex.1
+        RP.replay(replay_source("Data/ringdown.rpz", speed=None))
+        RP.start_record(save=False)
+            -> RP.recording holds the first RP.num_samples of the capture
+        """
+        if source is not None and source.sample_rate is None:
+            source.sample_rate = self.get_sample_rate()
+        self.system.comms.source = source
+        log.info("Recording from %s", "the board" if source is None else source.capture
+                 if isinstance(source.capture, str) else "a replayed array")
+
+    def start_record(self, savename=None, save=True, monitor=None, transient=None):
         """
         This function enables recording of measurements from the RedPitaya hardware. 
         This is achieved in the following steps:
@@ -504,6 +734,26 @@ class RedPitaya():
         
         Recording can be accessed through RP.recording.
 
+        Parameters
+        ----------
+        savename : str, optional
+            csv file name (without extension) in ./Data/. The default is
+            None, meaning the current time.
+        save : bool, optional
+            Write the csv file. Set False for short captures which are only
+            analysed in memory (e.g. continuation.py). The default is True.
+        monitor : convergence.convergence_monitor, optional
+            Adaptive recording: the duration set becomes the longest the
+            recording may run, and it is cut short as soon as the monitor
+            reports steady state. The recording time saved is left in
+            RP.time_saved. The default is None.
+        transient : None, 'mark' or 'trim', optional
+            Find the sample from which every channel is steady (see
+            convergence.steady_state_detector), and store it in
+            RP.steady_from and the csv header ('mark'), or also drop the
+            samples before it from RP.recording and the csv ('trim'). The
+            default is None.
+
         Returns
         -------
         None.
@@ -511,29 +761,31 @@ class RedPitaya():
         """
         # Empty the previous instance of recording - otherwise it causes memory issues when forking.
         self.recording = None
+        self.time_saved = 0
         
         if self.measurement==0: 
            self.measurement = 1
           
            # Determines the number of samples required. 
            self.compute_num_samples()
+           # Settings this recording is taken with, saved alongside it
+           self.recording_snapshot = self.snapshot()
            
-           logging.debug("{} samples requested".format(self.num_samples))
+           event_log.log_event(log, logging.INFO, "record requested", samples=self.num_samples)
            try:
                # TODO1: moved Shared Memory creation from RP_comms to RP. Check if works.
                # self.shared_memory_name = self.prepare_record()
                # self.shared_mem = SharedMemory(name=self.shared_memory_name, size=self.num_bytes, create=False)
                self.prepare_record()
                
-               logging.debug("packet sent to socket process")
+               log.debug("packet sent to socket process")
                
                self.measurement = 1
-               self.monitor_recording(savename)
+               self.monitor_recording(savename, save, monitor, transient)
 
                
            except Exception:
-               logging.debug("Didn't send config to data process")
-               logging.debug(traceback.format_exc())
+               log.exception("Didn't send config to data process")
                pass
            
         else:
@@ -543,8 +795,60 @@ class RedPitaya():
            # Close shared memory
            self.shared_mem.close()
            self.shared_mem.unlink()
-   
-    
+
+
+    def start_segmented_record(self, averager, savename=None, save=True):
+        """
+        Takes every segment of a segmented.segment_averager in one
+        recording, folding each into the running average and variance as it
+        arrives (see segmented.py). The recording runs for as long as the
+        segments need, whatever duration is set, and stops early if the
+        averager has a tolerance and reaches it. Use continuous output so
+        the excitation runs through every segment.
+
+        Parameters
+        ----------
+        averager : segmented.segment_averager
+        savename, save :
+            As start_record(). The whole capture is in RP.recording, and
+            averager.segments(RP.recording) views it segment by segment.
+
+        Returns
+        -------
+        averager, with averager.count segments averaged.
+
+        Usage
+        ----------
+        Ex.1
+        averager = RP.start_segmented_record(segment_averager(200, frequency=98.2e3, cycles=40))
+        averager.mean("in1"), averager.snr("in1")
+        """
+        averager.reset(self.get_sample_rate())
+        duration = self.system.config.duration
+        self.system.set_duration((averager.total_samples() + 0.5) / self.get_sample_rate())
+        try:
+            self.start_record(savename, save, monitor=averager)
+        finally:
+            self.system.set_duration(duration)
+        if self.recording is not None:
+            # Segments completed after the last update of the recording process
+            averager.update(self.recording)
+        event_log.log_event(log, logging.INFO, "segmented record", segments=averager.count,
+                            requested=averager.n_segments, samples=averager.length,
+                            converged=averager.converged)
+        return averager
+
+
+    def get_sample_rate(self):
+        """
+        Returns the sample rate (samples per second) of the current
+        sampling_rate setting.
+        """
+        if self.system.config.sampling_rate == "fast":
+            return self.fast_sample_rate
+        return self.slow_sample_rate
+
+
     def compute_num_samples(self):
         """
         Complimentary function called by RP.start_record().
@@ -577,13 +881,13 @@ class RedPitaya():
         None.
 
         """
-        logging.debug("Recording request recieved")
+        log.debug("Recording request recieved")
         self.shared_mem = SharedMemory(size=self.num_bytes, create=True)
         self.shared_memory_name = self.shared_mem.name
-        logging.debug("Shared memory created at: " + self.shared_memory_name)
+        log.debug("Shared memory created at: %s", self.shared_memory_name)
     
     
-    def monitor_recording(self, savename=None):
+    def monitor_recording(self, savename=None, save=True, monitor=None, transient=None):
         """
         Complimentary function called by RP.start_record()
         Creates a Process which enables measurements from the RedPitaya 
@@ -596,30 +900,115 @@ class RedPitaya():
         
         """
         
+        should_stop = None
+        if monitor is not None:
+            monitor.reset(self.get_sample_rate())
+
+            def should_stop(n_bytes):
+                # View of the samples received so far
+                received = np.ndarray(n_bytes // 8, dtype=_recording_dtype, buffer=self.shared_mem.buf)
+                try:
+                    return monitor.update(received)
+                finally:
+                    del received
+
         try:
                 try:
                     # This creates a new Process which enables the recording.
-                    self.system.trigger_record(shared_memory_name=self.shared_memory_name)
+                    self.system.trigger_record(shared_memory_name=self.shared_memory_name,
+                                               should_stop=should_stop)
                 except:
-                    logging.debug("Didn't send config to data process")
-                    logging.debug(traceback.format_exc())
+                    log.exception("Didn't send config to data process")
+                self.truncate_record(monitor)
                 # We assume that the recording finishes here and therefore can proceed to the post-processing. 
-                self.MeasureFinished(savename)
+                self.MeasureFinished(savename, save, transient, monitor)
                 self.shared_memory_name = None
         except:
-            logging.debug("Shared memory does not exist")
-            logging.debug(traceback.format_exc())
+            log.exception("Shared memory does not exist")
             pass
         # else:
-        #     logging.debug("Not process run")
+        #     log.debug("Not process run")
         
         
-    def MeasureFinished(self, savename=None):
+    def truncate_record(self, monitor=None):
+        """
+        Complimentary function called by RP.monitor_recording(). Shortens
+        the recording to the samples received, so a recording stopped early
+        (by a monitor, a dropped connection or a replayed capture running
+        out) isn't padded with zeros. For adaptive recordings, works out the
+        time saved.
+
+        Returns
+        -------
+        None.
+
+        """
+        requested = self.num_samples
+        self.num_samples = min(requested, self.system.comms.bytes_received // 8)
+        if monitor is not None:
+            self.time_saved = (requested - self.num_samples) / self.get_sample_rate()
+            event_log.log_event(log, logging.INFO, "adaptive record",
+                                converged=monitor.converged, samples=self.num_samples,
+                                requested=requested, time_saved=round(self.time_saved, 3),
+                                statistic=monitor.statistic)
+        elif self.num_samples < requested:
+            log.warning("Recording ended early: %d of %d samples received", self.num_samples, requested)
+
+
+    def excitation_frequency(self):
+        """
+        Returns the fixed excitation frequency (Hz) of the current output
+        configuration: CBC's if CBC is enabled, otherwise CH1's or CH2's.
+        None if there isn't one (e.g. a frequency sweep).
+        """
+        if self.CBC.config.CBC_enabled:
+            configs = [self.CBC.config]
+        else:
+            # Only channels whose mode outputs at frequency_start
+            configs = [config for config in (self.CH1.config, self.CH2.config)
+                       if "frequency_start" in _modes_params.get(config.mode, [])]
+        for config in configs:
+            if config.frequency_start > 0 and not config.frequency_sweep:
+                return config.frequency_start
+        return None
+
+
+    def find_steady_state(self, recording, detector=None):
+        """
+        Complimentary function called by RP.MeasureFinished().
+        Returns the sample from which every channel of recording is steady,
+        or None if it never settles.
+
+        Parameters
+        ----------
+        recording : structured ndarray
+        detector : steady_state_detector, optional
+            A detector that has already seen the start of this recording
+            (e.g. passed to start_record as monitor), which then only
+            processes the rest. The default is None, meaning a new one at
+            the excitation frequency.
+
+        """
+        if not isinstance(detector, steady_state_detector):
+            detector = steady_state_detector(self.excitation_frequency())
+            detector.reset(self.get_sample_rate())
+        detector.update(recording)
+        steady_from = detector.steady_from
+
+        if steady_from is None:
+            log.warning("Recording did not reach steady state (statistic %.3g)", detector.statistic)
+        else:
+            event_log.log_event(log, logging.INFO, "transient", samples=steady_from,
+                                seconds=round(steady_from / self.get_sample_rate(), 3))
+        return steady_from
+
+
+    def MeasureFinished(self, savename=None, save=True, transient=None, monitor=None):
         """
         Complimentary function called by RP.monitor recording() via RP.start_record() 
         Takes the recording from the RedPitaya hardware and saves the shared 
-        memory space into a manipulable numpy array, and saves to a csv file for 
-        external post-processing.
+        memory space into a manipulable numpy array, and (if save) saves to a
+        csv file for external post-processing.
         
         Returns
         -------
@@ -630,16 +1019,54 @@ class RedPitaya():
         self.measurement = 0
     
         #create array with view of shared mem
-        logging.debug("data_ready recognised")
-        temp = np.ndarray((self.num_samples), dtype=np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)]), buffer=self.shared_mem.buf)
+        log.debug("data_ready recognised")
+        temp = np.ndarray((self.num_samples), dtype=_recording_dtype, buffer=self.shared_mem.buf)
+
+        # Find the end of the settling transient on the shared memory, so a
+        # trimmed recording only copies the steady part.
+        start = 0
+        self.steady_from = None
+        if transient:
+            self.steady_from = self.find_steady_state(temp, monitor)
+            if transient == 'trim' and self.steady_from is not None:
+                start = self.steady_from
         
         #copy into permanent array
-        recording = np.copy(temp)
-        logging.debug("recording copied")
+        with span("copy"):
+            recording = np.copy(temp[start:])
+        log.debug("recording copied")
         # Delete view of shared memory (important, otherwise memory still exists)
         del temp
         
         
+        if save:
+            self.save_recording(recording, savename)
+
+        # Close shared memory
+        self.shared_mem.close()
+        self.shared_mem.unlink()
+        self.recording = recording
+        self.envelopes = None
+        
+        
+    def save_recording(self, recording, savename=None):
+        """
+        Complimentary function called by RP.MeasureFinished().
+        Saves a recording to ./Data/<savename>.csv (or the current time if
+        no name is given), with the sample rate, config hash and channel
+        configs in the header. With RP.save_format = "rpz" it is saved
+        compressed to <savename>.rpz instead, with the same header text
+        (see storage.py). Existing files are not overwritten, a number
+        is appended instead. The file is then added to the catalog.
+
+        If RP.background_save is set, the file is written by the writer
+        thread (see writer.py) and this returns as soon as it is queued.
+
+        Returns
+        -------
+        str, path of the file written.
+
+        """
         # Store to *.csv
         #Set up data directory
         datadir="./Data/"
@@ -666,63 +1093,173 @@ class RedPitaya():
             sample_rate = "slow (" + str(self.fast_sample_rate) + ")"
         
         
+        # Identifies recordings taken with identical settings
+        config_string = "Config hash: {}\n".format(config_hash(self.recording_snapshot))
+        # Data stays in counts; these convert it to volts
+        config_string += "Calibration: {}\n".format(self.calibration.header())
+        if self.steady_from is not None:
+            config_string += "Steady from sample: {} ({})\n".format(
+                self.steady_from, "trimmed" if len(recording) < self.num_samples else "kept")
+
         # TODO4: Additional printing of config information.
         # It's a bit ugly in its implementation, and its code that is repeated in print_config().
         # Could use a cleanup, potentially as a reusable function.
         if self.CBC.config["CBC_enabled"]:
             # CBC mode
-            config_string = "{};{}\n".format("Key", "CBC")
+            config_string += "{};{}\n".format("Key", "CBC")
             for key in self.CBC.config.keys():
                 config_string += "{};{}\n".format(key, str(self.CBC.config[key]))
         else:
             # Channel mode
-            config_string = "{};{};{}\n".format("Key", "Channel 1", "Channel 2")
+            config_string += "{};{};{}\n".format("Key", "Channel 1", "Channel 2")
             for key in self.CH1.config.keys():
                 config_string += ("{};{};{}\n".format(key, str(self.CH1.config[key]), str(self.CH2.config[key])))
             
             
             
-        if os.path.exists(datadir + '{}.csv'.format(label)):
-            i = 0
-            while os.path.exists(datadir + '{}_{}.csv'.format(label, i)):
+        # Create the file now, so that a name is never handed out twice while
+        # earlier saves are still queued
+        extension = self.save_format
+        path = datadir + '{}.{}'.format(label, extension)
+        i = 0
+        while True:
+            try:
+                open(path, 'x').close()
+                break
+            except FileExistsError:
+                path = datadir + '{}_{}.{}'.format(label, i, extension)
                 i += 1
-            np.savetxt(datadir + '{}_{}.csv'.format(label, i), 
-                       np.transpose([recording['in1'], recording['in2'], recording['out1'], recording['out2']]), 
-                       delimiter=";", fmt='%d',
-                       header="Sample rate: {}\n".format(sample_rate) +config_string+ "In1; In2; Out1; Out2")
+
+        header = "Sample rate: {}\n".format(sample_rate) +config_string+ "In1; In2; Out1; Out2"
+        if self.save_format == "rpz":
+            options = dict(metadata=header)
         else:
-            np.savetxt(datadir + '{}.csv'.format(label), 
-                       np.transpose([recording['in1'], recording['in2'], recording['out1'], recording['out2']]), 
-                       delimiter=";", fmt='%d',
-                       header="Sample rate: {}\n".format(sample_rate) +config_string+ "In1; In2; Out1; Out2")
-        
-        
-        
-        # Close shared memory
-        self.shared_mem.close()
-        self.shared_mem.unlink()
-        self.recording = recording
-        
-        
-    def PlotRecording(self):
-        recording = self.recording
-        recording = np.transpose([recording['in1'], recording['in2'], recording['out1'], recording['out2']])
+            options = dict(delimiter=";", fmt='%d', header=header)
+        # Settings as they were for this recording, for the catalog
+        snapshot = self.recording_snapshot
+        steady_from = self.steady_from
+        rate = self.fast_sample_rate if snapshot.system.sampling_rate == "fast" else self.slow_sample_rate
+        if self.background_save:
+            if self.writer is None:
+                from writer import get_writer
+                self.writer = get_writer()
+            self.writer.submit(path, recording, self.save_format,
+                               on_done=lambda path: self.catalog_recording(path, recording, savename, snapshot,
+                                                                           steady_from, rate),
+                               **options)
+        else:
+            # Same format functions as the writer thread
+            from writer import formats
+            with span("save"):
+                with open(path, "wb") as file:
+                    formats[self.save_format](file, recording, **options)
+            self.catalog_recording(path, recording, savename, snapshot, steady_from, rate)
+        return path
+
+    def catalog_recording(self, path, recording, savename, snapshot, steady_from, sample_rate):
+        """
+        Complimentary function called by RP.save_recording().
+        Adds a saved recording to the catalog (./Data/catalog.sqlite, see
+        catalog.py) with its settings, so it can be found with
+        RP.catalog.find(). A failure is logged and the recording kept.
+        Called from the writer thread for background saves, so everything
+        comes from the arguments, captured when the save was queued.
+
+        Returns
+        -------
+        None.
+
+        """
+        try:
+            if self.catalog is None:
+                # sqlite3 is only loaded once something is saved
+                from catalog import recording_catalog
+                self.catalog = recording_catalog()
+            self.catalog.add(path, snapshot, recording, sample_rate,
+                             steady_from=steady_from, label=savename)
+        except Exception:
+            log.exception("Recording saved to %s but not added to the catalog", path)
+
+
+    # =========================================================================
+    # Calibration
+    # =========================================================================
+    def load_calibration(self, path="calibration.json"):
+        """
+        Use the stored calibration of this board (by IP address) for
+        conversions to volts. Channels without a stored calibration keep
+        nominal gain and offset. See calibration.py to fit one.
+
+        Parameters
+        ----------
+        path : str, optional
+            Calibration table. The default is "calibration.json".
+
+        Returns
+        -------
+        None.
+
+        """
+        self.calibration = calibration_table(path).for_board(self.system.config.ip_address)
+
+    def recording_volts(self, recording=None):
+        """
+        The last recording (or the one given) in volts, as a
+        calibration.calibrated_recording: indexing a channel converts it to
+        float32 on first use, and .chunks(channel) streams it in blocks.
+        """
+        if recording is None:
+            recording = self.recording
+        return calibrated_recording(recording, self.calibration)
+
+
+    @timed("plot")
+    def PlotRecording(self, volts=False):
+        """
+        Plot the last recording, one axis per channel. Each channel is drawn
+        from a min/max envelope pyramid rather than sample by sample, so the
+        plot stays responsive for captures of millions of samples, and zooming
+        in re-queries the envelope at the matching resolution.
+
+        Parameters
+        ----------
+        volts : bool, optional
+            Plot in volts through RP.calibration rather than in counts. Only
+            the points drawn are converted. The default is False (counts are
+            more useful for debugging).
+
+        Returns
+        -------
+        None.
+
+        """
+        # Imported here so that importing the API (and every recording
+        # process it spawns) doesn't load matplotlib and a GUI backend.
+        import matplotlib.pyplot as plt
+
+        envelopes = self.get_envelopes()
         fig, ax = plt.subplots(4,1, sharex=True, layout='constrained')
         ax = ax.ravel()
         
+        # From the sample rate, as adaptive and trimmed recordings are
+        # shorter than the duration set
+        time_per_sample = 1 / self.get_sample_rate()
         
-        time = np.linspace(0, self.system.config.duration, len(recording[:,0]))
-        # Nbits = 2**12
-        Nbits = 1 # counts are more useful for debugging
-        
-        ax[0].plot(time, recording[:,0]/Nbits, label="Input 1")
-        ax[0].set_title("In1")
-        ax[1].plot(time, recording[:,1]/Nbits, label="Input 2")
-        ax[1].set_title("In2")
-        ax[2].plot(time, recording[:,2]/Nbits, label="Input 3")
-        ax[2].set_title("Out1")
-        ax[3].plot(time, recording[:,3]/Nbits, label="Input 4")
-        ax[3].set_title("Out2")
-             
-        
-    
\ No newline at end of file
+        titles = {"in1": "In1", "in2": "In2", "out1": "Out1", "out2": "Out2"}
+        for i, (name, title) in enumerate(titles.items()):
+            line, = ax[i].plot([], [], label="Input {}".format(i + 1))
+            y_scale, y_offset = self.calibration.coefficients(name) if volts else (1, 0)
+            attach_envelope(ax[i], line, envelopes[name],
+                            x_scale=time_per_sample, y_scale=y_scale, y_offset=y_offset)
+            ax[i].set_title(title)
+            ax[i].set_ylabel("V" if volts else "Counts")
+    
+    def get_envelopes(self):
+        """
+        Return a dict of MinMaxPyramid envelopes, one per channel of
+        RP.recording, building them on first use after each recording.
+        """
+        if self.envelopes is None:
+            self.envelopes = {name: MinMaxPyramid(self.recording[name])
+                              for name in self.recording.dtype.names}
+        return self.envelopes
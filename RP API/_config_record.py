@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+_config_record.py
+
+Base class for the config classes (channel_config, CBC_config, system_config,
+FPGA_config).
+
+A config record is a fixed set of named fields stored in a list, in key order,
+behind __slots__. It behaves as the dict subclasses it replaces did: items and
+attributes both read and write fields, only the listed keys exist, and every
+set is type and limit checked. The checks are compiled once per class into one
+validator per field, so a set is an index lookup and a call, and copying a
+config is a list copy.
+
+A subclass lists its fields in the class statement:
+
+    class channel_config(config_record, keys=_channel_keys,
+                         datatypes=_datatypes, limits=_limits,
+                         name="Channel Config"):
+        __slots__ = ()
+
+Each subclass declares empty __slots__, so instances have no __dict__.
+
+datatypes and limits may be omitted (FPGA_config), in which case any value is
+accepted.
+
+freeze() returns an immutable, hashable snapshot of a record: a namedtuple
+of its values, available as e.g. channel_config.frozen. Snapshots compare and
+hash by value, so they can key caches (see mem_mapping.FPGA_settings) and
+deduplicate lists of settings. thaw() turns one back into a record, and
+config_hash() gives a digest of a snapshot that is stable across runs, for
+writing alongside recordings.
+
+@author: cca78
+"""
+import hashlib
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+
+def _restore(cls, values):
+    """Unpickle a config record (used by __reduce__)."""
+    record = cls.__new__(cls)
+    object.__setattr__(record, "_values", values)
+    return record
+
+
+def _make_validator(key, datatype, limits, limits_label, check_special):
+    """
+    Compile the checks the dict-based configs made on every set into a single
+    function of the value, returning the value to store or raising.
+
+    The rules are unchanged: the type must match exactly, except that an int
+    is accepted (and stored as a float) for a float field; then the value must
+    be one of a list of strings, or within a [lower, upper] pair, or pass
+    check_special when limits is None.
+    """
+    if datatype is None:
+        return lambda value: value
+
+    if limits is None:
+        in_limits = check_special
+    elif type(limits[0]) == str:
+        allowed = frozenset(limits)
+        in_limits = allowed.__contains__
+    else:
+        if len(limits) != 2:
+            raise ValueError("{} list must contain exactly two items.".format(limits_label))
+        lower_limit, upper_limit = sorted(limits)
+        in_limits = lambda value: lower_limit <= value <= upper_limit
+
+    promote = datatype == float
+
+    def validate(value):
+        value_type = type(value)
+        if value_type == datatype or (promote and value_type == int):
+            if in_limits(value):
+                return float(value) if promote else value
+            raise ValueError(f"{value} is outside of {limits_label} for {key}, which are {limits}")
+        raise TypeError(f"Parameter entered is of type '{type(value)}' whereas {key} expects a parameter of type {datatype}")
+
+    return validate
+
+
+def config_hash(snapshot):
+    """
+    Digest of a frozen config (or a tuple of them) which, unlike hash(), is
+    the same in every process and session.
+
+    Returns
+    -------
+    str of 16 hex digits.
+
+    """
+    return hashlib.sha1(repr(snapshot).encode()).hexdigest()[:16]
+
+
+class config_record(MutableMapping):
+    """
+    Fixed-key, validated parameter record with dict item access and attribute
+    access. See module docstring.
+
+    init arguments:
+        default_values: dict of initial values. Every field starts at 0
+            (unchecked, as before) and is then set from this dict through the
+            usual checks.
+    """
+    __slots__ = ("_values",)
+
+    # Set per subclass by __init_subclass__
+    _keys = ()
+    _index = {}
+    _validators = ()
+    _name = "Config"
+    _limits_label = "limits"
+    _unknown_default = "warn"
+    frozen = None
+
+    def __init_subclass__(cls, keys=(), datatypes=None, limits=None, name="Config",
+                          limits_label="limits", unknown_default="warn",
+                          check_special=None, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._keys = tuple(keys)
+        cls._index = {key: i for i, key in enumerate(cls._keys)}
+        cls._name = name
+        cls._limits_label = limits_label
+        cls._unknown_default = unknown_default
+        cls._validators = tuple(_make_validator(key,
+                                                datatypes[key] if datatypes else None,
+                                                limits[key] if limits else None,
+                                                limits_label,
+                                                check_special)
+                                for key in cls._keys)
+        # Snapshot type. Its qualified name makes it picklable as an
+        # attribute of the class.
+        cls.frozen = namedtuple(cls.__name__ + "_frozen", cls._keys, module=cls.__module__)
+        cls.frozen.__qualname__ = cls.__qualname__ + ".frozen"
+
+    def __init__(self, default_values=None):
+        object.__setattr__(self, "_values", [0] * len(self._keys))
+        if default_values:
+            for key, value in default_values.items():
+                if key in self._index:
+                    self[key] = value
+                elif self._unknown_default == "raise":
+                    raise KeyError(f"Warning: The key '{key}' is not included in {self._name} settings and has been discarded.")
+                else:
+                    print(f"Warning: The key '{key}' is not included in {self._name} settings and has been discarded.")
+
+    # Item access
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __setitem__(self, key, value):
+        """Check that key is part of the allowed list, then perform type and
+        value checks before setting any items. """
+        try:
+            i = self._index[key]
+        except KeyError:
+            raise KeyError(f"'{self._name}' object does not support adding new keys. Key '{key}' rejected") from None
+        self._values[i] = self._validators[i](value)
+
+    def __delitem__(self, key):
+        raise KeyError(f"'{self._name}' object does not support removing keys")
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    # Attribute access
+    def __getattr__(self, item):
+        # Only called when normal lookup fails, i.e. for config keys
+        index = type(self)._index
+        if item in index:
+            return self._values[index[item]]
+        raise AttributeError(f"'{self._name}' object has no attribute '{item}'")
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    # Fast paths over the MutableMapping defaults
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._keys, self._values))
+
+    def astuple(self):
+        """Field values in key order, e.g. as a hash or comparison key."""
+        return tuple(self._values)
+
+    def freeze(self):
+        """Immutable, hashable snapshot of the current values (a
+        namedtuple of type cls.frozen)."""
+        return self.frozen._make(self._values)
+
+    @classmethod
+    def thaw(cls, snapshot):
+        """New record holding the values of a snapshot from freeze()."""
+        if len(snapshot) != len(cls._keys):
+            raise ValueError(f"Snapshot has {len(snapshot)} values, {cls._name} has {len(cls._keys)} keys")
+        return _restore(cls, list(snapshot))
+
+    def copy(self):
+        """Unvalidated copy (the values have already been checked)."""
+        return _restore(type(self), list(self._values))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        # Fields are immutable scalars and strings
+        return self.copy()
+
+    def __reduce__(self):
+        return (_restore, (type(self), list(self._values)))
+
+    def __eq__(self, other):
+        if isinstance(other, config_record):
+            return self._keys == other._keys and self._values == other._values
+        return dict(self.items()) == other
+
+    __hash__ = None     # mutable
+
+    def __repr__(self):
+        return repr(dict(zip(self._keys, self._values)))
+
+    def is_within_limits(self, value, limits):
+        """
+        Determines whether the given input value(s) are within the limits specified
+        """
+        if type(limits[0]) == str:
+            return value in limits
+
+        else:
+            if len(limits) != 2:
+                raise ValueError("{} list must contain exactly two items.".format(self._limits_label))
+
+            lower_limit, upper_limit = sorted(limits)
+
+            return lower_limit <= value <= upper_limit
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+bench_dtype.py
+
+Memory and runtime of the analysis paths on a long capture, comparing the
+float64 whole-array versions they replaced with the int16/float32 blockwise
+versions (see dtype_policy.py). Run from the 'RP API' folder:
+
+    python bench_dtype.py [seconds]
+
+The capture is a synthetic slow-mode recording (488281 samples/s, 60 s by
+default, 234 MB of int16) of a decaying sinusoid with noise on every channel.
+Each stage runs in a fresh interpreter, and reports its wall time and its
+peak memory above the recording itself: peak RSS where the resource module
+exists, otherwise peak traced allocation.
+
+Stages:
+    volts       every channel from counts to volts
+    steady      steady-state detection across every channel
+    harmonics   fundamental of one channel
+
+@author: cca78
+"""
+import os
+import sys
+import subprocess
+from time import perf_counter
+
+import numpy as np
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+_sample_rate = 488281
+_frequency = 37.0
+_fields = ("in1", "in2", "out1", "out2")
+_dtype = np.dtype([(field, np.int16) for field in _fields])
+
+_stages = ("volts", "steady", "harmonics")
+
+
+def synthetic_recording(seconds):
+    """Decaying transient into a steady sinusoid, in counts, built a block
+    at a time."""
+    n = int(seconds * _sample_rate)
+    recording = np.empty(n, dtype=_dtype)
+    rng = np.random.default_rng(0)
+    block = 1 << 16
+    for start in range(0, n, block):
+        t = np.arange(start, min(start + block, n)) / _sample_rate
+        signal = 4000 * np.sin(2 * np.pi * _frequency * t) * (1 + np.exp(-t / 2))
+        for i, field in enumerate(_fields):
+            recording[field][start:start + len(t)] = signal / (i + 1) + rng.normal(0, 8, len(t))
+    return recording
+
+
+# =============================================================================
+# float64 whole-array versions, as the analysis was written before
+# =============================================================================
+def _float64_volts(recording, gain=8192.0, offset=0.0):
+    return [(recording[field] - offset) / gain for field in _fields]
+
+
+def _float64_steady(recording, window=10, tolerance=1e-3, floor=16):
+    """The running-sum monitor over a whole recording in one pass: float64
+    terms and cumulative sums for every sample."""
+    cycle = _sample_rate / _frequency
+    steady = []
+    for field in _fields:
+        x = recording[field].astype(np.float64)
+        phase = (2 * np.pi * _frequency / _sample_rate) * np.arange(len(x))
+        cumulative = np.cumsum(np.stack((x * np.cos(phase), x * np.sin(phase)), axis=1), axis=0)
+        ends = np.round(np.arange(1, int(len(x) / cycle) + 1) * cycle).astype(int) - 1
+        sums = np.diff(cumulative[ends], axis=0, prepend=np.zeros((1, 2)))
+        amplitudes = 2 * np.hypot(sums[:, 0], sums[:, 1]) / cycle
+        for k in range(2 * window, len(amplitudes) + 1):
+            recent = amplitudes[k - window:k]
+            if recent.std() / max(recent.mean(), floor) < tolerance:
+                steady.append(int(round((k - window) * cycle)))
+                break
+    return max(steady) if len(steady) == len(_fields) else None
+
+
+def _float64_harmonics(recording):
+    x = recording["in1"].astype(np.float64)
+    phase = (2 * np.pi * _frequency / _sample_rate) * np.arange(len(x))
+    basis = np.stack((np.ones(len(x)), np.cos(phase), np.sin(phase)), axis=1)
+    a, b, c = np.linalg.lstsq(basis, x, rcond=None)[0]
+    return abs(b - 1j * c)
+
+
+# =============================================================================
+# Current versions
+# =============================================================================
+def _volts(recording):
+    from calibration import board_calibration, calibrated_recording
+    volts = calibrated_recording(recording, board_calibration())
+    return [volts[field] for field in _fields]
+
+
+def _steady(recording):
+    from convergence import steady_state_detector
+    detector = steady_state_detector(_frequency, sample_rate=_sample_rate)
+    detector.update(recording)
+    return detector.steady_from
+
+
+def _harmonics(recording):
+    from harmonics import harmonic_amplitude
+    return harmonic_amplitude(recording["in1"], _frequency, _sample_rate)
+
+
+_implementations = {("volts", "before"): _float64_volts,
+                    ("steady", "before"): _float64_steady,
+                    ("harmonics", "before"): _float64_harmonics,
+                    ("volts", "after"): _volts,
+                    ("steady", "after"): _steady,
+                    ("harmonics", "after"): _harmonics}
+
+
+def _peak_memory():
+    """Peak RSS of this process in bytes, or None without resource."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_stage(stage, version, seconds):
+    """Run one stage in this process, printing 'seconds extra_bytes result'."""
+    import tracemalloc
+    import event_log
+    event_log.configure(os.devnull)
+    recording = synthetic_recording(seconds)
+    baseline = _peak_memory()
+    if baseline is None:
+        tracemalloc.start()
+    start = perf_counter()
+    result = _implementations[(stage, version)](recording)
+    elapsed = perf_counter() - start
+    if baseline is None:
+        extra = tracemalloc.get_traced_memory()[1]
+    else:
+        extra = _peak_memory() - baseline
+    if isinstance(result, list):
+        result = sum(float(np.abs(v).max()) for v in result)
+    print(elapsed, extra, result)
+
+
+def measure(stage, version, seconds):
+    output = subprocess.run([sys.executable, __file__, "--stage", stage, version, str(seconds)],
+                            cwd=_here, capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), int(output[1]), output[2]
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, _here)
+    if len(sys.argv) > 1 and sys.argv[1] == "--stage":
+        run_stage(sys.argv[2], sys.argv[3], float(sys.argv[4]))
+        sys.exit()
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    n = int(seconds * _sample_rate)
+    print("{} s slow-mode capture, {} samples, {:.0f} MB int16".format(seconds, n, n * _dtype.itemsize / 1e6))
+    print("{:<10} {:>10} {:>10} {:>12} {:>12}   {}".format("stage", "before (s)", "after (s)",
+                                                           "before (MB)", "after (MB)", "results (before, after)"))
+    for stage in _stages:
+        before = measure(stage, "before", seconds)
+        after = measure(stage, "after", seconds)
+        print("{:<10} {:10.2f} {:10.2f} {:12.0f} {:12.0f}   {}, {}".format(stage, before[0], after[0],
+                                                                         before[1] / 1e6, after[1] / 1e6,
+                                                                         before[2], after[2]))
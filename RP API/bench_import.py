@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+bench_import.py
+
+Import-time benchmark for the API. Run from the 'RP API' folder:
+
+    python bench_import.py [repeats]
+
+Reports, as the median over fresh interpreters:
+    - 'import RedPitaya', as a user script pays for it
+    - 'import RP_communications', which is what a spawned recording process
+      (Windows) imports to unpickle its target
+    - start-up and join of a spawned process importing RP_communications
+and the heaviest modules each pulls in, from python -X importtime.
+
+@author: cca78
+"""
+import os
+import sys
+import subprocess
+import statistics
+from time import perf_counter
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_import(module, repeats):
+    """Median wall time (s) of 'import module' in a fresh interpreter, less
+    the cost of starting an empty interpreter."""
+    def run(code):
+        times = []
+        for _ in range(repeats):
+            start = perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=_here, check=True)
+            times.append(perf_counter() - start)
+        return statistics.median(times)
+
+    return run("import " + module) - run("pass")
+
+
+def heaviest_imports(module, n=8):
+    """The n slowest direct imports of module (cumulative us) under
+    python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=_here, capture_output=True, text=True, check=True)
+    children = []
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        # importtime lists a module after its imports, indented one level
+        # (two spaces) further
+        depth = len(name) - len(name.lstrip())
+        if depth == 3:
+            children.append((int(cumulative_us), name.strip()))
+        elif depth == 1:
+            if name.strip() == module:
+                rows = children
+            children = []
+    return sorted(rows, reverse=True)[:n]
+
+
+def _child():
+    import RP_communications
+
+
+def time_spawn(repeats):
+    """Median time to start and join a spawned process importing
+    RP_communications."""
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        process = context.Process(target=_child)
+        process.start()
+        process.join()
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    sys.path.insert(0, _here)
+
+    for module in ("RedPitaya", "RP_communications"):
+        print("import {:<20} {:8.1f} ms".format(module, 1e3 * time_import(module, repeats)))
+        for us, name in heaviest_imports(module):
+            print("    {:<30} {:8.1f} ms".format(name, us / 1e3))
+
+    print("spawned recording process {:8.1f} ms".format(1e3 * time_spawn(repeats)))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+bench_storage.py
+
+Compression ratio and encode/decode throughput of .rpz storage (storage.py)
+for every installed codec and filter, against csv. Run from the 'RP API'
+folder:
+
+    python bench_storage.py [capture.csv | capture.rpz ...]
+
+Give saved captures (e.g. from ./Data/) to measure on real data. Without
+arguments it uses emulated captures: a Duffing rig under CBC
+(emulator.duffing_plant) near resonance, with a few counts of ADC noise.
+Throughput is in MB/s of recording in memory (8 bytes/sample), and is the
+best of three runs.
+
+@author: cca78
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_dtype = np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)])
+
+
+def load_capture(path):
+    """Recording from a saved csv or rpz capture."""
+    if path.endswith(".rpz"):
+        from storage import load_rpz
+        return load_rpz(path)[0]
+    columns = np.loadtxt(path, delimiter=";", comments="#", dtype=np.int16, ndmin=2)
+    recording = np.empty(len(columns), dtype=_dtype)
+    for i, name in enumerate(_dtype.names):
+        recording[name] = columns[:, i]
+    return recording
+
+
+def emulated_captures():
+    from emulator import duffing_plant
+    plant = duffing_plant(sample_rate=50000, noise=4 / 8192, proportional_gain=2,
+                          derivative_gain=0.003, seed=0)
+    captures = {}
+    for frequency in (9.0, 11.0):
+        plant.capture(frequency, 0.1, duration=2)           # settle
+        captures["emulated {} Hz".format(frequency)] = plant.capture(frequency, 0.1, duration=10)[0]
+    return captures
+
+
+def best_of(function, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def bench(name, recording, directory):
+    from storage import codecs, filters, save_rpz, load_rpz
+    megabytes = recording.nbytes / 1e6
+    csv_path = os.path.join(directory, "capture.csv")
+    np.savetxt(csv_path, np.transpose([recording[field] for field in _dtype.names]), delimiter=";", fmt="%d")
+    print("{}: {} samples, {:.1f} MB in memory, csv {:.1f}x larger".format(
+        name, len(recording), megabytes, os.path.getsize(csv_path) / recording.nbytes))
+    print("    {:<6} {:<14} {:>7} {:>12} {:>12}".format("codec", "filter", "ratio", "encode MB/s", "decode MB/s"))
+    path = os.path.join(directory, "capture.rpz")
+    for codec in codecs:
+        for filter in filters:
+            encode = best_of(lambda: save_rpz(path, recording, codec=codec, filter=filter))
+            decode = best_of(lambda: load_rpz(path))
+            if not np.array_equal(load_rpz(path)[0], recording):
+                raise RuntimeError("{} {} did not round trip".format(codec, filter))
+            print("    {:<6} {:<14} {:7.2f} {:12.0f} {:12.0f}".format(
+                codec, filter, recording.nbytes / os.path.getsize(path), megabytes / encode, megabytes / decode))
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, _here)
+    import event_log
+    event_log.configure(os.devnull)
+
+    if len(sys.argv) > 1:
+        captures = {os.path.basename(path): load_capture(path) for path in sys.argv[1:]}
+    else:
+        captures = emulated_captures()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, recording in captures.items():
+            bench(name, recording, directory)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+calibration.py
+
+Gain and offset calibration of the Red Pitaya's inputs and outputs, and
+conversion of recordings from counts to volts.
+
+Each channel is modelled as linear,
+
+    counts = gain * volts + offset
+
+with gain in counts per volt (nominally 8192) and offset in counts. For the
+inputs (in1, in2) this is the ADC reading for an applied voltage; for the
+outputs (out1, out2) it is the DAC command that produces a voltage at the
+output port, so recorded out1/out2 counts convert to the voltage actually
+produced.
+
+A calibration_table holds the fit for every channel of every board (keyed by
+IP address) and is stored as JSON. Calibrations are fitted from captures of
+known references:
+
+    - inputs: known DC levels applied to in1/in2, e.g. from a bench supply
+    - outputs: DC levels commanded on out1/out2, looped back to in1/in2 and
+      measured through the (already calibrated) inputs
+
+Conversion to volts is a multiply and add in float32, done in blocks that
+fit in cache through one reused buffer, so converting a recording never
+allocates a float64 copy of it. calibrated_recording wraps a recording and
+converts each channel the first time it is asked for; chunks() streams a
+channel in blocks without converting all of it.
+
+e.g.
+
+table = calibration_table("calibration.json")
+fits = calibrate_inputs(RP_reference(RP, set_reference=bench_supply), [-0.8, -0.4, 0, 0.4, 0.8])
+table.update(RP.system.config.ip_address, fits)
+table.save()
+
+RP.load_calibration("calibration.json")
+RP.start_record()
+volts = RP.recording_volts()
+plt.plot(volts["in1"])
+
+@author: cca78
+"""
+import json
+import os
+import logging
+from collections import namedtuple
+import numpy as np
+
+import event_log
+from dtype_policy import working_dtype, block_samples, blocks
+
+log = event_log.get_logger("api")
+
+channel_calibration = namedtuple("channel_calibration",
+                                 ["gain",           # counts per volt
+                                  "offset"])        # counts at 0 V
+
+# Full scale of +-1 V over the 14-bit converters, as mem_mapping assumes
+nominal_calibration = channel_calibration(8192.0, 0.0)
+
+_fields = ("in1", "in2", "out1", "out2")
+
+
+def fit_gain_offset(volts, counts):
+    """
+    Least-squares straight line through (volts, counts) pairs.
+
+    Parameters
+    ----------
+    volts : sequence of float
+        Reference voltages, at least two distinct.
+    counts : sequence of float
+        Mean counts read (inputs) or commanded (outputs) at each.
+
+    Returns
+    -------
+    (channel_calibration, rms residual in counts)
+
+    """
+    volts = np.asarray(volts, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    if len(np.unique(volts)) < 2:
+        raise ValueError("Calibration needs at least two distinct reference levels")
+    gain, offset = np.polyfit(volts, counts, 1)
+    residual = np.sqrt(np.mean((counts - (gain * volts + offset)) ** 2))
+    return channel_calibration(float(gain), float(offset)), float(residual)
+
+
+class board_calibration(object):
+    """
+    Calibration of the four channels of one board, with conversions between
+    counts and volts.
+
+    init arguments:
+        channels: dict of field: channel_calibration. Fields not given use
+            nominal_calibration.
+    """
+
+    def __init__(self, channels=None):
+        self.channels = {field: nominal_calibration for field in _fields}
+        if channels:
+            self.channels.update(channels)
+
+    def __getitem__(self, field):
+        return self.channels[field]
+
+    def coefficients(self, field):
+        """(scale, bias) such that volts = counts * scale + bias, in the
+        working dtype."""
+        gain, offset = self.channels[field]
+        return working_dtype.type(1 / gain), working_dtype.type(-offset / gain)
+
+    def to_volts(self, counts, field, out=None):
+        """
+        Convert counts on one channel to volts.
+
+        Parameters
+        ----------
+        counts : 1D array
+            e.g. recording['in1']. Strided views are fine.
+        field : 'in1', 'in2', 'out1' or 'out2'
+            Channel whose calibration is applied.
+        out : float32 array, optional
+            Destination, the same length as counts. The default is None,
+            meaning a new array.
+
+        Returns
+        -------
+        float32 ndarray.
+
+        """
+        if out is None:
+            out = np.empty(len(counts), dtype=working_dtype)
+        scale, bias = self.coefficients(field)
+        # Multiply and add block by block, so the intermediate never leaves
+        # cache, and in float32 throughout
+        for start, stop in blocks(len(counts)):
+            block = out[start:stop]
+            np.multiply(counts[start:stop], scale, out=block, dtype=working_dtype)
+            block += bias
+        return out
+
+    def to_counts(self, volts, field):
+        """Counts that read as (inputs), or produce (outputs), volts. Use to
+        correct output setpoints, e.g. an offset in mV."""
+        gain, offset = self.channels[field]
+        return np.asarray(volts) * gain + offset
+
+    def chunks(self, counts, field, chunk_size=block_samples):
+        """
+        Yield a channel in volts, block by block, through one reused float32
+        buffer (copy a block to keep it).
+        """
+        scale, bias = self.coefficients(field)
+        buffer = np.empty(min(chunk_size, len(counts)), dtype=working_dtype)
+        for start, stop in blocks(len(counts), chunk_size):
+            block = buffer[:stop - start]
+            np.multiply(counts[start:stop], scale, out=block, dtype=working_dtype)
+            block += bias
+            yield block
+
+    def header(self):
+        """One line description for recording headers."""
+        return "; ".join("{} gain {:.6g} offset {:.6g}".format(field, *self.channels[field])
+                         for field in _fields)
+
+
+class calibrated_recording(object):
+    """
+    Read-only view of a recording in volts. Each channel is converted the
+    first time it is indexed, and kept; the int16 recording is not copied.
+
+    init arguments:
+        recording: structured ndarray (in1, in2, out1, out2 counts)
+        calibration: board_calibration
+    """
+
+    def __init__(self, recording, calibration):
+        self.recording = recording
+        self.calibration = calibration
+        self._converted = {}
+
+    def __getitem__(self, field):
+        if field not in self._converted:
+            self._converted[field] = self.calibration.to_volts(self.recording[field], field)
+        return self._converted[field]
+
+    def __len__(self):
+        return len(self.recording)
+
+    @property
+    def dtype(self):
+        return np.dtype([(field, working_dtype) for field in self.recording.dtype.names])
+
+    def chunks(self, field, chunk_size=block_samples):
+        """Stream one channel in volts without converting all of it."""
+        return self.calibration.chunks(self.recording[field], field, chunk_size)
+
+
+class calibration_table(object):
+    """
+    Stored calibrations, per board and channel.
+
+    init arguments:
+        path: JSON file. Loaded if it exists. The default is
+            'calibration.json'.
+    """
+
+    def __init__(self, path="calibration.json"):
+        self.path = path
+        self.boards = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as file:
+            stored = json.load(file)
+        self.boards = {board: {field: channel_calibration(values["gain"], values["offset"])
+                               for field, values in channels.items()}
+                       for board, channels in stored.get("boards", {}).items()}
+
+    def save(self):
+        stored = {"boards": {board: {field: calibration._asdict()
+                                     for field, calibration in channels.items()}
+                             for board, channels in self.boards.items()}}
+        with open(self.path, "w") as file:
+            json.dump(stored, file, indent=2)
+
+    def update(self, board, fits):
+        """
+        Store fits for a board.
+
+        Parameters
+        ----------
+        board : str
+            Board IP address.
+        fits : dict
+            field: channel_calibration, or field: (channel_calibration,
+            residual) as returned by calibrate_inputs/calibrate_outputs.
+        """
+        channels = self.boards.setdefault(board, {})
+        for field, fit in fits.items():
+            channels[field] = fit if isinstance(fit, channel_calibration) else fit[0]
+
+    def for_board(self, board):
+        """board_calibration for board, nominal for any channel not stored."""
+        if board not in self.boards:
+            log.warning("No calibration stored for %s, using nominal gain and offset", board)
+        return board_calibration(self.boards.get(board))
+
+
+# =============================================================================
+# Calibration routines
+# =============================================================================
+def _level_means(source, levels, fields, settle_fraction):
+    """Mean counts of each field in a capture at each reference level."""
+    means = {field: [] for field in fields}
+    for level in levels:
+        recording = source.capture_reference(level)
+        start = int(len(recording) * settle_fraction)
+        for field in fields:
+            means[field].append(recording[field][start:].mean(dtype=np.float64))
+    return means
+
+
+def calibrate_inputs(source, levels, fields=("in1", "in2"), settle_fraction=0.2):
+    """
+    Fit input gain and offset from captures with known voltages applied.
+
+    Parameters
+    ----------
+    source : object
+        Provides capture_reference(volts), which applies volts to the
+        inputs, records, and returns the recording. See RP_reference, or
+        emulator.loopback_rig.
+    levels : sequence of float
+        Reference voltages, spanning the range of interest.
+    fields : tuple of str, optional
+        Inputs to fit. The default is ("in1", "in2").
+    settle_fraction : float, optional
+        Leading fraction of each capture discarded. The default is 0.2.
+
+    Returns
+    -------
+    dict of field: (channel_calibration, rms residual in counts).
+
+    """
+    means = _level_means(source, levels, fields, settle_fraction)
+    fits = {field: fit_gain_offset(levels, means[field]) for field in fields}
+    for field, (calibration, residual) in fits.items():
+        event_log.log_event(log, logging.INFO, "calibration", channel=field,
+                            gain=calibration.gain, offset=calibration.offset, residual=residual)
+    return fits
+
+
+def calibrate_outputs(source, levels, input_calibration, loopback=(("out1", "in1"), ("out2", "in2")),
+                      settle_fraction=0.2):
+    """
+    Fit output gain and offset by looping each output back to an input.
+
+    Parameters
+    ----------
+    source : object
+        Provides capture_reference(volts), which commands volts (at nominal
+        gain) on the outputs, records, and returns the recording.
+    levels : sequence of float
+        Commanded voltages.
+    input_calibration : board_calibration
+        Calibration of the inputs measuring the outputs.
+    loopback : tuple of (output, input) pairs, optional
+        Which input each output is wired to. The default is out1 to in1 and
+        out2 to in2.
+    settle_fraction : float, optional
+        Leading fraction of each capture discarded. The default is 0.2.
+
+    Returns
+    -------
+    dict of field: (channel_calibration, rms residual in counts).
+
+    """
+    loopback = dict(loopback)
+    fields = tuple(loopback) + tuple(loopback.values())
+    means = _level_means(source, levels, fields, settle_fraction)
+    fits = {}
+    for output, input_field in loopback.items():
+        # Volts actually produced, as measured through the calibrated input
+        produced = (np.array(means[input_field]) - input_calibration[input_field].offset) / input_calibration[input_field].gain
+        fits[output] = fit_gain_offset(produced, means[output])
+        event_log.log_event(log, logging.INFO, "calibration", channel=output,
+                            gain=fits[output][0].gain, offset=fits[output][0].offset,
+                            residual=fits[output][1])
+    return fits
+
+
+class RP_reference(object):
+    """
+    Reference source for the calibration routines, on a RedPitaya.
+
+    Each capture_reference(volts) sets both outputs to a DC level (fixed
+    frequency mode at zero amplitude, offset in mV) and records. For output
+    calibration, loop the outputs back to the inputs. For input calibration,
+    pass set_reference, a function called with the voltage to apply before
+    each capture (e.g. driving a bench supply, or asking the user to set
+    one); the outputs are then left at zero.
+
+    init arguments:
+        RP: RedPitaya instance
+        set_reference: callable(volts), optional. The default is None.
+        duration: seconds per capture. The default is 0.05.
+    """
+
+    def __init__(self, RP, set_reference=None, duration=0.05):
+        self.RP = RP
+        self.set_reference = set_reference
+        self.duration = duration
+
+    def capture_reference(self, volts):
+        RP = self.RP
+        if self.set_reference is not None:
+            self.set_reference(volts)
+            millivolts = 0
+        else:
+            millivolts = int(round(volts * 1000))
+        RP.choose_output("Both", "fixed_frequency")
+        for channel in ("CH1", "CH2"):
+            RP.set_param(channel, "linear_amplitude", 0)
+            RP.set_param(channel, "offset", millivolts)
+        RP.set_duration(float(self.duration))
+        RP.update_FPGA_settings()
+        RP.start_record(save=False)
+        return RP.recording
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+campaign.py
+
+Compiles a whole campaign of sweep points into packed FPGA config packets in
+one go, sharded across worker processes.
+
+Taking a point through the API one at a time (config setters and their
+checks, the mem_mapping conversion, struct.pack) costs around a millisecond
+on one core, which adds up over a large design of experiments. Here each
+worker takes a shard of points and, for each one, applies it to the base
+snapshot through the config validators (sweep_planner.apply_settings), maps
+it with mem_mapping (FPGA_settings, uncached) and checks every value fits
+its field of the packet. Workers return the mapped values and any errors,
+and the parent fills in values a point leaves unchanged (the mode not in
+use keeps whatever was sent before it, as on the board) and lays every
+packet out in one contiguous array of config_dtype, 60 bytes per point.
+
+Points are sweep_planner axis names and values, either a sweep_plan or a
+list of dicts, which need not all set the same axes. On Windows, where
+workers are spawned, call compile_* from under if __name__ == '__main__'.
+
+e.g.
+
+from campaign import compile_plan
+compiled = compile_plan(plan)                  # plan from RP.plan_sweep()
+compiled.errors                                # [(point number, message)]
+compiled.buffer                                # every packet, contiguous
+for point, recording in RP.run_sweep(plan, compiled=compiled):
+    ...
+
+@author: cca78
+"""
+import os
+import struct
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import event_log
+from FPGA_config import config_keys, config_format
+from mem_mapping import FPGA_settings
+from sweep_planner import apply_settings
+
+log = event_log.get_logger("campaign")
+
+# One config packet, laid out as struct.pack(config_format, ...) lays it out
+config_dtype = np.dtype([(key, np.uint8 if code == "B" else np.int32)
+                         for key, code in zip(config_keys, config_format)])
+assert config_dtype.itemsize == struct.calcsize(config_format)
+
+_key_index = {key: i for i, key in enumerate(config_keys)}
+_lower = np.array([np.iinfo(config_dtype[key]).min for key in config_keys], dtype=np.int64)
+_upper = np.array([np.iinfo(config_dtype[key]).max for key in config_keys], dtype=np.int64)
+
+# Points per worker below which the pool isn't worth starting
+_min_shard = 2000
+
+
+class compiled_campaign(object):
+    """
+    Packed config packets for a list of points, from compile_plan() or
+    compile_points().
+
+    Attributes:
+        configs: structured array of config_dtype, one packet per point
+        valid: bool per point. An invalid point repeats the packet before it.
+        errors: list of (point number, message)
+    """
+
+    def __init__(self, configs, valid, errors):
+        self.configs = configs
+        self.valid = valid
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.configs)
+
+    @property
+    def buffer(self):
+        """Every packet, back to back, without copying."""
+        return memoryview(self.configs).cast("B")
+
+    def packed(self, number):
+        """Packet of one point, as RP_communications sends it."""
+        size = config_dtype.itemsize
+        return self.buffer[number * size:(number + 1) * size]
+
+    def config(self, number):
+        """{FPGA_config key: value} of one point."""
+        return {key: int(self.configs[key][number]) for key in config_keys}
+
+
+def _compile_shard(base, names, values, indices):
+    """
+    Worker: validate, map and range check a shard of points.
+
+    Returns
+    -------
+    (values, mask, errors): int64 (points, keys) values, bool mask of the
+    values each point sets, and (shard index, message) per failed point.
+
+    """
+    mapped = np.zeros((len(indices), len(config_keys)), dtype=np.int64)
+    mask = np.zeros(mapped.shape, dtype=bool)
+    errors = []
+    for j, row in enumerate(indices):
+        settings = {name: values[k][i] for k, (name, i) in enumerate(zip(names, row)) if i >= 0}
+        try:
+            snapshot = apply_settings(base, settings)
+            for key, value in FPGA_settings.__wrapped__(*snapshot):
+                mapped[j, _key_index[key]] = value
+                mask[j, _key_index[key]] = True
+            outside = mask[j] & ((mapped[j] < _lower) | (mapped[j] > _upper))
+            if outside.any():
+                raise OverflowError("{} out of range of the config packet".format(
+                    ", ".join("{}={}".format(config_keys[i], mapped[j, i]) for i in np.flatnonzero(outside))))
+        except Exception as error:
+            mask[j] = False
+            errors.append((j, "{}: {}".format(type(error).__name__, error)))
+    return mapped, mask, errors
+
+
+def _compile(base, names, values, indices, initial=None, workers=None):
+    base = tuple(base)
+    n = len(indices)
+    workers = workers or os.cpu_count() or 1
+    shards = max(1, min(workers, n // _min_shard))
+    bounds = np.linspace(0, n, shards + 1).astype(int)
+    arguments = [(base, names, values, indices[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    if shards == 1:
+        results = [_compile_shard(*arguments[0])]
+    else:
+        with ProcessPoolExecutor(shards) as pool:
+            results = list(pool.map(_compile_shard, *zip(*arguments)))
+
+    mapped = np.concatenate([result[0] for result in results])
+    mask = np.concatenate([result[1] for result in results])
+    errors = [(int(a) + j, message) for a, result in zip(bounds, results) for j, message in result[2]]
+
+    # Values a point doesn't set carry on from the last point that did, or
+    # from initial
+    initial = np.array([0 if initial is None else initial[key] for key in config_keys], dtype=np.int64)
+    last_set = np.where(mask, np.arange(n)[:, None], -1)
+    np.maximum.accumulate(last_set, axis=0, out=last_set)
+    filled = np.where(last_set >= 0, mapped[np.maximum(last_set, 0), np.arange(len(config_keys))], initial)
+
+    configs = np.empty(n, dtype=config_dtype)
+    for i, key in enumerate(config_keys):
+        configs[key] = filled[:, i]
+    valid = np.ones(n, dtype=bool)
+    valid[[number for number, _ in errors]] = False
+    event_log.log_event(log, logging.INFO, "campaign compiled", points=n, workers=shards, errors=len(errors))
+    return compiled_campaign(configs, valid, errors)
+
+
+def compile_plan(plan, initial=None, workers=None):
+    """
+    Packets for every point of a sweep_planner.sweep_plan, in plan order.
+
+    Parameters
+    ----------
+    plan : sweep_planner.sweep_plan
+    initial : mapping of FPGA_config key to value, optional
+        Config on the board before the first point, e.g.
+        RP.system.comms.config. The default is None, meaning zeros.
+    workers : int, optional
+        Worker processes. The default is None, meaning one per CPU (fewer
+        for small campaigns).
+
+    Returns
+    -------
+    compiled_campaign.
+
+    """
+    indices = plan.indices.astype(np.int32)
+    return _compile(plan.base, plan.names, plan.values, indices, initial, workers)
+
+
+def compile_points(base, points, initial=None, workers=None):
+    """
+    Packets for a list of points, e.g. a design of experiments.
+
+    Parameters
+    ----------
+    base : RedPitaya.rp_snapshot
+        Settings the points are applied to, e.g. RP.snapshot().
+    points : sequence of dict of {axis name: value}
+        sweep_planner axis names. Points may set different axes.
+    initial, workers :
+        As compile_plan().
+
+    Returns
+    -------
+    compiled_campaign, with a validation error per bad point.
+
+    """
+    names = list(dict.fromkeys(name for point in points for name in point))
+    position = {name: k for k, name in enumerate(names)}
+    lookups = [{} for _ in names]
+    values = [[] for _ in names]
+    indices = np.full((len(points), len(names)), -1, dtype=np.int32)
+    for j, point in enumerate(points):
+        for name, value in point.items():
+            k = position[name]
+            # Keyed by type too, so 1 and 1.0 and True stay distinct
+            key = (type(value), value)
+            if key not in lookups[k]:
+                lookups[k][key] = len(values[k])
+                values[k].append(value)
+            indices[j, k] = lookups[k][key]
+    return _compile(base, names, [tuple(axis) for axis in values], indices, initial, workers)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+catalog.py
+
+SQLite index of saved recordings, so that captures can be found by their
+settings without opening any data files.
+
+RP.MeasureFinished() adds a row for every recording it saves, holding the
+file's path, label, save time and size, the sample rate, duration and number
+of samples, the steady-state sample (convergence.py), a hash of the settings
+(_config_record.config_hash) and a hash of the samples, and every field of
+the CH1, CH2, CBC and system configs, as columns named <config>_<key>, e.g.
+CBC_frequency_start or CH1_mode. mode is 'CBC' or 'channels'.
+
+The database is Data/catalog.sqlite, next to the recordings. Columns for new
+config keys are added when it is opened.
+
+e.g.
+
+from catalog import recording_catalog
+rows = recording_catalog().find(mode="CBC", CBC_frequency_start=(94e3, 101e3))
+paths = [row["path"] for row in rows]
+
+@author: cca78
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+from channel_config import channel_config
+from CBC_config import CBC_config
+from system_config import system_config
+from _config_record import config_hash
+
+_fixed_columns = [("path", "TEXT UNIQUE NOT NULL"),
+                  ("label", "TEXT"),
+                  ("saved_at", "TEXT"),
+                  ("size_bytes", "INTEGER"),
+                  ("mode", "TEXT"),
+                  ("sample_rate", "REAL"),
+                  ("duration", "REAL"),
+                  ("num_samples", "INTEGER"),
+                  ("steady_from", "INTEGER"),
+                  ("config_hash", "TEXT"),
+                  ("data_hash", "TEXT")]
+
+# One column per config field, in rp_snapshot order. Untyped, so values are
+# stored as the int, float, str or bool (as int) they are.
+_config_columns = ([("CH1_" + key, "") for key in channel_config._keys] +
+                   [("CH2_" + key, "") for key in channel_config._keys] +
+                   [("CBC_" + key, "") for key in CBC_config._keys] +
+                   [("system_" + key, "") for key in system_config._keys])
+
+# Columns most queries filter on
+_indexed_columns = ("mode", "saved_at", "config_hash", "CBC_frequency_start",
+                    "CH1_frequency_start", "CH2_frequency_start")
+
+
+def data_hash(recording):
+    """sha1 of a recording's samples, read in place (no copy). Identifies
+    the data whatever format it was saved in."""
+    return hashlib.sha1(memoryview(recording).cast("B")).hexdigest()
+
+
+class recording_catalog(object):
+    """
+    Index of saved recordings. See module docstring.
+
+    init arguments:
+        path: database file. The default is './Data/catalog.sqlite'.
+    """
+
+    def __init__(self, path="./Data/catalog.sqlite"):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.mkdir(directory)
+        self.path = path
+        # Rows may be added from the writer thread (writer.py)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.row_factory = sqlite3.Row
+        # Write-ahead logging: a commit per recording is one append
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.create_schema()
+
+    def create_schema(self):
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, {})".format(
+                ", ".join('"{}" {}'.format(name, kind) for name, kind in _fixed_columns + _config_columns)))
+            existing = {row["name"] for row in self.connection.execute("PRAGMA table_info(recordings)")}
+            for name, kind in _fixed_columns + _config_columns:
+                if name not in existing:
+                    self.connection.execute('ALTER TABLE recordings ADD COLUMN "{}" {}'.format(name, kind))
+            for name in _indexed_columns:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS "index_{0}" ON recordings ("{0}")'.format(name))
+        self.columns = [name for name, _ in _fixed_columns + _config_columns]
+
+    def add(self, path, snapshot, recording, sample_rate, steady_from=None, label=None):
+        """
+        Add (or replace) the row for a saved recording.
+
+        Parameters
+        ----------
+        path : str
+            File the recording was saved to.
+        snapshot : RedPitaya.rp_snapshot
+            Settings it was taken with (RP.recording_snapshot).
+        recording : structured ndarray
+            The samples saved.
+        sample_rate : float
+            Samples per second.
+        steady_from : int, optional
+            First steady sample, if found. The default is None.
+        label : str, optional
+            Save name given. The default is None, meaning the file name.
+
+        Returns
+        -------
+        int, row id.
+
+        """
+        row = {"path": os.path.abspath(path),
+               "label": label if label else os.path.splitext(os.path.basename(path))[0],
+               "saved_at": datetime.now().isoformat(timespec="seconds"),
+               "size_bytes": os.path.getsize(path),
+               "mode": "CBC" if snapshot.CBC.CBC_enabled else "channels",
+               "sample_rate": sample_rate,
+               "duration": len(recording) / sample_rate,
+               "num_samples": len(recording),
+               "steady_from": steady_from,
+               "config_hash": config_hash(snapshot),
+               "data_hash": data_hash(recording)}
+        for config, frozen in zip(("CH1", "CH2", "CBC", "system"), snapshot):
+            for key, value in frozen._asdict().items():
+                row[config + "_" + key] = value
+
+        names = list(row)
+        with self.lock, self.connection:
+            cursor = self.connection.execute("INSERT OR REPLACE INTO recordings ({}) VALUES ({})".format(
+                ", ".join('"{}"'.format(name) for name in names), ", ".join("?" * len(names))),
+                [row[name] for name in names])
+        return cursor.lastrowid
+
+    def find(self, order_by="saved_at", **conditions):
+        """
+        Recordings matching every condition.
+
+        Parameters
+        ----------
+        order_by : str, optional
+            Column to sort by. The default is "saved_at".
+        **conditions : column=value
+            A value matches equal values, a (low, high) tuple matches the
+            inclusive range, and a list matches any of its items.
+
+        Returns
+        -------
+        list of sqlite3.Row, indexable by column name.
+
+        Usage
+        ----------
+        catalog.find(mode="CBC", CBC_frequency_start=(94e3, 101e3))
+        catalog.find(CH1_mode=["fixed_frequency", "frequency_sweep"])
+        """
+        clauses = []
+        parameters = []
+        for name, value in conditions.items():
+            self.check_column(name)
+            if isinstance(value, tuple):
+                clauses.append('"{}" BETWEEN ? AND ?'.format(name))
+                parameters.extend(value)
+            elif isinstance(value, list):
+                clauses.append('"{}" IN ({})'.format(name, ", ".join("?" * len(value))))
+                parameters.extend(value)
+            elif value is None:
+                clauses.append('"{}" IS NULL'.format(name))
+            else:
+                clauses.append('"{}" = ?'.format(name))
+                parameters.append(value)
+        self.check_column(order_by)
+        sql = "SELECT * FROM recordings"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += ' ORDER BY "{}"'.format(order_by)
+        return self.query(sql, parameters)
+
+    def query(self, sql, parameters=()):
+        """Run any SQL against the catalog (table 'recordings')."""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def check_column(self, name):
+        if name not in self.columns:
+            raise KeyError("Catalog has no column '{}'".format(name))
+
+    def remove_missing(self):
+        """Drop rows whose file no longer exists. Returns the number dropped."""
+        missing = [(row["path"],) for row in self.query("SELECT path FROM recordings")
+                   if not os.path.exists(row["path"])]
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM recordings WHERE path = ?", missing)
+        return len(missing)
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) FROM recordings")[0][0]
+
+    def close(self):
+        self.connection.close()
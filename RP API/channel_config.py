@@ -6,12 +6,12 @@ Created on Thu Jul 20 16:54:25 2023
 Channel config class.
 Dictionary which stores desired physical parameters for each RP channel.
 
-Class overrides __getattr__ and __setattr__ methods so that each key can be
-called as an attribute, for convenience in API calls.
-
-Overrides __setitem__ to not allow any non-specified keys to be added.
+Each key can be read and set as an item or as an attribute, for convenience in
+API calls. Keys can't be added, and values are type and limit checked on every
+set - see _config_record.py.
 
 """
+from _config_record import config_record
 
 _channel_keys = ["mode",
                  "input_channel",
@@ -85,64 +85,9 @@ _limits = {"mode": _channel_modes,
            }
 
 
-class channel_config(dict):
-
-    def __init__(self, default_values=None):
-        super().__init__({key: 0 for key in _channel_keys})
-        if default_values:
-            for key, value in default_values.items():
-                if key in _channel_keys:
-                    self[key] = value
-                else:
-                    print(f"Warning: The key '{key}' is not included in channel settings and has been discarded.")
-    
-    
-    def __getattr__(self, item):
-        if item in self:
-            return self[item]
-        else:
-            raise AttributeError(f"'Channel Config' object has no attribute '{item}'")
-
-    def __setattr__(self, key, value):
-        self[key] = value
-
-    def __setitem__(self, key, value):
-        """Check that key is part of the allowed list, then perform type and
-        value checks before setting any items. """
-
-        if key in _channel_keys:
-
-            if type(value) == _datatypes[key]:
-                if self.is_within_limits(value, _limits[key]):
-                    super().__setitem__(key, value)
-                else:
-                    raise ValueError(f"{value} is outside of limits for {key}, which are {_limits[key]}")
-
-            elif _datatypes[key] == float and type(value) == int:
-                if self.is_within_limits(value, _limits[key]):
-                    super().__setitem__(key, float(value))
-                else:
-                    raise ValueError(f"{value} is outside of limits for {key}, which are {_limits[key]}")
-
-            else:
-                raise TypeError(f"Parameter entered is of type '{type(value)}' whereas {key} expects a parameter of type {_datatypes[key]}")
-        else:
-            raise KeyError(f"'Channel Config' object does not support adding new keys. Key '{key}' rejected")
-
-    def is_within_limits(self, value, limits):
-        """
-        Determines whether the given input value(s) are within the limits specified
-        """
-        if type(limits[0]) == str:
-            return value in limits
-
-        else:
-            if len(limits) != 2:
-                raise ValueError("Limits list must contain exactly two items.")
-
-            lower_limit, upper_limit = sorted(limits)
-
-            return lower_limit <= value <= upper_limit
+class channel_config(config_record, keys=_channel_keys, datatypes=_datatypes,
+                     limits=_limits, name="Channel Config"):
+    __slots__ = ()
 
     def clear_param(self, parameter):
         #TODO2: make this a bit more fitting with this custom dict - perhaps a new
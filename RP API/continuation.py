@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+continuation.py
+
+Numerical continuation of a CBC response curve.
+
+With the CBC output running, the controller's fundamental is the forcing the
+rig feels. For a target forcing amplitude Gamma, the points of the forced
+response curve are the (frequency, reference amplitude) pairs where
+
+    g(f, r_hat) = |U_1(f, r_hat)| - Gamma = 0
+
+with U_1 the fundamental of the control signal, measured from a short
+capture. This is one equation in two unknowns, so its solutions form a curve,
+which is traced through its folds (the S-curve of a hardening or softening
+rig) by pseudo-arclength continuation:
+
+    - predict: step along the tangent, the null vector of the Jacobian,
+      continuing the direction of the last step
+    - correct: Newton iterations on g and the arclength condition, with the
+      Jacobian of g estimated once by finite differences and then kept up
+      to date by Broyden rank-one updates from every capture, so a
+      correction step costs one capture
+    - adapt: grow the step after fast convergence, shrink it after slow
+      convergence or a failed correction, refreshing the Jacobian
+
+Each capture starts from where the rig was left by the previous one (a warm
+start), so only a short capture past a small transient is needed.
+
+Plants provide capture(frequency, reference_amplitude) returning a recording
+and its sample rate, plus settle_cycles and counts_per_unit attributes.
+RP_plant drives a RedPitaya; emulator.duffing_plant stands in for one.
+
+e.g.
+
+from emulator import duffing_plant
+from continuation import CBC_continuation
+
+tracer = CBC_continuation(duffing_plant(), forcing_amplitude=0.02)
+points = tracer.trace(frequency=7, reference_amplitude=0.01, stop_frequency=16)
+
+@author: cca78
+"""
+import logging
+from collections import namedtuple
+import numpy as np
+
+import event_log
+from harmonics import fit_harmonics
+
+log = event_log.get_logger("continuation")
+
+continuation_point = namedtuple("continuation_point",
+                                ["frequency",               # Hz
+                                 "reference_amplitude",     # r_hat
+                                 "response_amplitude",      # |X_1|, plant units
+                                 "control_amplitude",       # |U_1|, plant units
+                                 "iterations",              # corrector iterations
+                                 "captures"])               # total captures so far
+
+
+class RP_plant(object):
+    """
+    Plant interface to a RedPitaya in CBC mode. Set up the CBC gains,
+    polynomial and input order first, and enable continuous output so the
+    rig keeps running between captures.
+
+    init arguments:
+        RP: RedPitaya instance
+        cycles: reference cycles per capture. The default is 30.
+        settle_cycles: leading cycles discarded from harmonic estimates. The
+            default is 10.
+        counts_per_unit: ADC counts per unit of reference amplitude. The
+            default is 8.192 (reference amplitude in mV).
+    """
+
+    def __init__(self, RP, cycles=30, settle_cycles=10, counts_per_unit=8192/1000):
+        self.RP = RP
+        self.cycles = cycles
+        self.settle_cycles = settle_cycles
+        self.counts_per_unit = counts_per_unit
+
+    def capture(self, frequency, reference_amplitude):
+        RP = self.RP
+        RP.set_param("CBC", "frequency", float(frequency))
+        RP.set_param("CBC", "reference_amplitude", float(reference_amplitude))
+        RP.set_duration(float(self.cycles / frequency))
+        RP.update_FPGA_settings()
+        RP.start_record(save=False)
+        return RP.recording, RP.get_sample_rate()
+
+
+class CBC_continuation(object):
+    """
+    Pseudo-arclength continuation of |U_1| = forcing_amplitude over
+    (frequency, reference amplitude). See module docstring.
+
+    init arguments:
+        plant: RP_plant, emulator.duffing_plant, or similar
+        forcing_amplitude: Gamma, in plant units
+        displacement: recording field holding displacement. The default is
+            'in1'.
+        control: recording field holding the control signal. The default is
+            'out1'.
+        scale: (frequency, reference amplitude) scale factors. Steps are
+            measured in units of these, so they should be comparable to the
+            size of features on the curve (the width of a fold). The default
+            is None, meaning (starting frequency / 100, forcing_amplitude / 5).
+        step, min_step, max_step: initial, smallest and largest arclength
+            steps, in scaled units. The defaults are 0.2, 0.01 and 3.
+        tolerance: corrector stops when |g| < tolerance * forcing_amplitude.
+            This must be tight enough not to accept points past a fold. The
+            default is 0.002.
+        step_tolerance: or when a Newton step is shorter than this, in
+            scaled units, as noise in the captures sets a floor on |g|. The
+            default is 0.02.
+        max_iterations: corrector iterations before a step is rejected. The
+            default is 6.
+        fd_step: finite difference step for the Jacobian, in scaled units.
+            Large enough that the change in g stands clear of capture noise.
+            The default is 0.2.
+    """
+
+    def __init__(self, plant, forcing_amplitude, displacement='in1', control='out1',
+                 scale=None, step=0.2, min_step=0.01, max_step=3.0, tolerance=0.002,
+                 step_tolerance=0.02, max_iterations=6, fd_step=0.2):
+        self.plant = plant
+        self.forcing_amplitude = forcing_amplitude
+        self.displacement = displacement
+        self.control = control
+        self.scale = None if scale is None else np.asarray(scale, dtype=float)
+        self.step = step
+        self.min_step = min_step
+        self.max_step = max_step
+        self.tolerance = tolerance
+        self.step_tolerance = step_tolerance
+        self.max_iterations = max_iterations
+        self.fd_step = fd_step
+
+        self.jacobian = None        # dg/dz in scaled units, cached across steps
+        self.captures = 0
+        self.points = []
+
+    # =========================================================================
+    # Measurement
+    # =========================================================================
+    def measure(self, z):
+        """
+        Capture at scaled point z and return (g, |X_1|, |U_1|).
+        """
+        frequency, reference_amplitude = z * self.scale
+        if frequency <= 0:
+            raise ValueError("Continuation stepped to a non-positive frequency ({} Hz)".format(frequency))
+        recording, sample_rate = self.plant.capture(frequency, reference_amplitude)
+        self.captures += 1
+
+        settle = self.plant.settle_cycles
+        X = fit_harmonics(recording[self.displacement], frequency, sample_rate, skip_cycles=settle)[1]
+        U = fit_harmonics(recording[self.control], frequency, sample_rate, skip_cycles=settle)[1]
+        response = abs(X) / self.plant.counts_per_unit
+        control = abs(U) / self.plant.counts_per_unit
+        return control - self.forcing_amplitude, response, control
+
+    def update_jacobian(self, z, g):
+        """Finite difference Jacobian of g at z (two captures)."""
+        jacobian = np.empty(2)
+        for i in range(2):
+            dz = np.zeros(2)
+            dz[i] = self.fd_step
+            jacobian[i] = (self.measure(z + dz)[0] - g) / self.fd_step
+        # Leave the rig back at z for the next capture's warm start
+        self.measure(z)
+        self.jacobian = jacobian
+        log.debug("Jacobian %s", jacobian)
+
+    # =========================================================================
+    # Corrector
+    # =========================================================================
+    def correct(self, z_predicted, tangent):
+        """
+        Broyden-Newton solve of g(z) = 0 on the hyperplane through
+        z_predicted normal to tangent.
+
+        Returns
+        -------
+        (z, measurement, iterations), or None if not converged.
+
+        """
+        z = z_predicted.copy()
+        g, response, control = self.measure(z)
+        for iteration in range(self.max_iterations + 1):
+            if abs(g) < self.tolerance * self.forcing_amplitude:
+                return z, (g, response, control), iteration
+            if iteration == self.max_iterations:
+                break
+
+            A = np.vstack((self.jacobian, tangent))
+            residual = np.array([g, tangent @ (z - z_predicted)])
+            try:
+                dz = -np.linalg.solve(A, residual)
+            except np.linalg.LinAlgError:
+                return None
+
+            z_new = z + dz
+            g_new, response, control = self.measure(z_new)
+            # Broyden rank-one update from this capture
+            self.jacobian = self.jacobian + (g_new - g - self.jacobian @ dz) * dz / (dz @ dz)
+            z, g = z_new, g_new
+            if np.linalg.norm(dz) < self.step_tolerance:
+                return z, (g, response, control), iteration + 1
+        return None
+
+    # =========================================================================
+    # Driver
+    # =========================================================================
+    def start(self, frequency, reference_amplitude):
+        """
+        Converge onto the curve at fixed frequency, starting from a guess at
+        the reference amplitude. Returns the first continuation_point.
+        """
+        if self.scale is None:
+            self.scale = np.array([frequency / 100, self.forcing_amplitude / 5])
+        z = np.array([frequency, reference_amplitude]) / self.scale
+
+        g = self.measure(z)[0]
+        self.update_jacobian(z, g)
+        result = self.correct(z, np.array([1.0, 0.0]))
+        if result is None:
+            raise RuntimeError("Could not converge to the response curve at {} Hz".format(frequency))
+        z, (g, response, control), iterations = result
+        self.points = [continuation_point(*(z * self.scale), response, control, iterations, self.captures)]
+        self.z = [z]
+        return self.points[0]
+
+    def next_point(self, direction=1):
+        """
+        Predict, correct and adapt once, retrying with smaller steps after a
+        failed correction.
+
+        Parameters
+        ----------
+        direction : 1 or -1
+            For the first step, whether to head up or down in frequency.
+            Later steps carry on along the curve.
+
+        Returns
+        -------
+        continuation_point, or None if the step fell below min_step.
+
+        """
+        z = self.z[-1]
+        heading = z - self.z[-2] if len(self.z) > 1 else np.array([direction, 0.0])
+
+        while self.step >= self.min_step:
+            # Tangent: null vector of the Jacobian, which turns with the
+            # curve through a fold, oriented to carry on the way the last
+            # step went (or the requested way in frequency, for the first)
+            tangent = np.array([-self.jacobian[1], self.jacobian[0]])
+            if tangent @ heading < 0:
+                tangent = -tangent
+            tangent /= np.linalg.norm(tangent)
+
+            result = self.correct(z + self.step * tangent, tangent)
+            if result is not None:
+                z_new, (g, response, control), iterations = result
+                # A converged point further than two steps away has jumped
+                # to another part of the curve
+                if np.linalg.norm(z_new - z) < 2 * self.step:
+                    break
+            log.debug("Step %.3g rejected", self.step)
+            self.step /= 2
+            self.update_jacobian(z, self.measure(z)[0])
+        else:
+            return None
+
+        if iterations <= 2:
+            self.step = min(self.step * 1.5, self.max_step)
+        elif iterations >= 4:
+            self.step = max(self.step / 1.5, self.min_step)
+
+        point = continuation_point(*(z_new * self.scale), response, control, iterations, self.captures)
+        self.z.append(z_new)
+        self.points.append(point)
+        event_log.log_event(log, logging.INFO, "continuation point",
+                            frequency=point.frequency, reference=point.reference_amplitude,
+                            response=point.response_amplitude, iterations=iterations,
+                            step=self.step, captures=self.captures)
+        return point
+
+    def trace(self, frequency, reference_amplitude, stop_frequency, max_points=200):
+        """
+        Trace the response curve from frequency towards stop_frequency.
+
+        Parameters
+        ----------
+        frequency : float
+            Starting frequency (Hz), preferably away from resonance where
+            the curve is single valued.
+        reference_amplitude : float
+            Initial guess at r_hat for the starting point.
+        stop_frequency : float
+            Stop once the curve passes this frequency.
+        max_points : int, optional
+            The default is 200.
+
+        Returns
+        -------
+        list of continuation_point.
+
+        """
+        direction = 1 if stop_frequency > frequency else -1
+        self.start(frequency, reference_amplitude)
+        while len(self.points) < max_points:
+            point = self.next_point(direction)
+            if point is None:
+                log.warning("Continuation stopped: step below minimum at %.4g Hz", self.points[-1].frequency)
+                break
+            if (point.frequency - stop_frequency) * direction > 0:
+                break
+        return self.points
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+convergence.py
+
+Online steady-state detection for adaptive-length recordings.
+
+A convergence_monitor is fed the samples received so far while a recording
+is in progress (RP.start_record(monitor=...)), and reports when the signal
+has settled, at which point the recording is cut short. The statistic is
+the relative spread (std / mean) of the fundamental's amplitude over the
+last `window` cycles, when the drive frequency is known, or of the RMS over
+the last `window` blocks otherwise - a decaying transient shows up as a
+trend in either. Amplitudes are updated incrementally from running sums, so
+each update costs O(new samples), and new samples are taken a block at a time
+in float32 (sums in float64), so memory use doesn't grow with them.
+
+A steady_state_detector runs one monitor per channel, and gives the sample
+from which every channel is steady, so the transient before it can be
+trimmed from a recording before it is saved (RP.start_record(transient=
+'trim')).
+
+e.g.
+
+monitor = convergence_monitor(frequency=12.5, window=10, tolerance=1e-3)
+RP.start_record(monitor=monitor)
+print(monitor.converged_at, RP.time_saved)
+
+@author: cca78
+"""
+import numpy as np
+
+from dtype_policy import working_dtype, accumulator_dtype, blocks
+
+
+class convergence_monitor(object):
+    """
+    Steady-state detector for one channel of a recording.
+
+    init arguments:
+        frequency: drive frequency in Hz, or None to use block RMS. The
+            default is None.
+        field: recording field to watch. The default is 'in1'.
+        window: number of cycles (or blocks) the statistic is taken over.
+            The default is 10.
+        tolerance: converged when std / mean of the last window amplitudes
+            falls below this. The default is 1e-3.
+        min_cycles: never converge before this many cycles (or blocks),
+            e.g. to skip a start-up transient the window might miss. The
+            default is None, meaning 2 * window.
+        block_length: block length in seconds when frequency is None. Should
+            span many periods of the slowest component. The default is 0.5.
+        sample_rate: samples per second. Set by RP.start_record() if not
+            given here.
+        floor: amplitudes are divided by at least this many counts, so a
+            channel carrying only noise counts as steady. The default is 16.
+    """
+
+    def __init__(self, frequency=None, field='in1', window=10, tolerance=1e-3,
+                 min_cycles=None, block_length=0.5, sample_rate=None, floor=16):
+        self.frequency = frequency
+        self.field = field
+        self.window = int(window)
+        self.tolerance = tolerance
+        self.min_cycles = 2 * self.window if min_cycles is None else int(min_cycles)
+        self.block_length = block_length
+        self.sample_rate = sample_rate
+        self.floor = floor
+        self.reset()
+
+    def reset(self, sample_rate=None):
+        """Clear state before a new recording."""
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.n_processed = 0
+        self.amplitudes = []
+        self.converged = False
+        self.converged_at = None        # samples at which convergence was detected
+        self.steady_from = None         # first sample of the steady window
+        self.statistic = np.inf
+        # Running sums of x, x cos, x sin, x^2 up to n_processed, and at the
+        # start of the current cycle/block
+        self.sums = np.zeros(4)
+        self.cycle_start_sums = np.zeros(4)
+        self.cycle_start = 0
+
+    def cycle_boundary(self, k):
+        """Sample index at which cycle (or block) k starts."""
+        if self.frequency is None:
+            period = self.block_length * self.sample_rate
+        else:
+            period = self.sample_rate / self.frequency
+        return int(round(k * period))
+
+    def update(self, recording):
+        """
+        Process the samples of recording not seen yet.
+
+        Parameters
+        ----------
+        recording : structured ndarray
+            Every sample received so far (a growing prefix of the
+            recording), or a 1D array of the watched channel.
+
+        Returns
+        -------
+        bool, True once converged.
+
+        """
+        if self.converged:
+            return True
+        if self.sample_rate is None:
+            raise ValueError("convergence_monitor needs a sample_rate")
+
+        signal = recording[self.field] if recording.dtype.names else recording
+        n = len(signal)
+        if n <= self.n_processed:
+            return False
+
+        # Block by block, so the float temporaries stay O(block) for
+        # however many new samples there are (a whole recording, offline)
+        for start, stop in blocks(n - self.n_processed):
+            self.process_block(signal, self.n_processed + start, self.n_processed + stop)
+            if self.converged:
+                break
+        self.n_processed = n
+        return self.converged
+
+    def process_block(self, signal, first, last):
+        """Add samples [first, last) to the running sums, closing (and
+        testing) every cycle that ends among them."""
+        x = signal[first:last].astype(working_dtype)
+        terms = np.empty((len(x), 4), dtype=working_dtype)
+        terms[:, 0] = x
+        if self.frequency is not None:
+            # Phase wrapped in float64 (sample index times radians per
+            # sample is large), then sin and cos in float32
+            phase = np.remainder((2 * np.pi * self.frequency / self.sample_rate) * np.arange(first, last),
+                                 2 * np.pi).astype(working_dtype)
+            np.multiply(x, np.cos(phase), out=terms[:, 1], casting='unsafe')
+            np.multiply(x, np.sin(phase), out=terms[:, 2], casting='unsafe')
+        else:
+            terms[:, 1:3] = 0
+        np.multiply(x, x, out=terms[:, 3])
+        cumulative = np.cumsum(terms, axis=0, dtype=accumulator_dtype)
+        cumulative += self.sums
+
+        k = len(self.amplitudes)
+        while not self.converged:
+            end = self.cycle_boundary(k + 1)
+            if end > last:
+                break
+            end_sums = cumulative[end - 1 - first] if end > first else self.sums
+            self.amplitudes.append(self.amplitude(end_sums - self.cycle_start_sums, end - self.cycle_start))
+            self.cycle_start_sums = end_sums
+            self.cycle_start = end
+            k += 1
+            self.test()
+        self.sums = cumulative[-1]
+
+    def test(self):
+        """Update the statistic over the last window of cycles."""
+        if len(self.amplitudes) >= max(self.min_cycles, self.window):
+            recent = np.array(self.amplitudes[-self.window:])
+            self.statistic = recent.std() / max(recent.mean(), self.floor)
+            if self.statistic < self.tolerance:
+                self.converged = True
+                self.converged_at = self.cycle_start
+                self.steady_from = self.cycle_boundary(len(self.amplitudes) - self.window)
+
+    def amplitude(self, sums, length):
+        """Fundamental amplitude (or sqrt(2) * AC RMS, the amplitude of a
+        sinusoid with that RMS) of one cycle from its sums."""
+        total, cos_sum, sin_sum, square_sum = sums
+        if self.frequency is not None:
+            return 2 * np.hypot(cos_sum, sin_sum) / length
+        mean = total / length
+        return np.sqrt(2 * max(square_sum / length - mean * mean, 0))
+
+
+class steady_state_detector(object):
+    """
+    Steady-state detection across several channels of a recording. Has the
+    same update() interface as convergence_monitor, so it can also be passed
+    as RP.start_record(monitor=...) to stop once every channel is steady.
+
+    init arguments:
+        frequency: excitation frequency in Hz, which sets the cycle length
+            the statistic is taken over, or None for block RMS.
+        fields: recording fields to watch. The default is all four.
+        kwargs: passed to each channel's convergence_monitor (window,
+            tolerance, min_cycles, block_length, sample_rate, floor).
+    """
+
+    def __init__(self, frequency=None, fields=('in1', 'in2', 'out1', 'out2'), **kwargs):
+        self.monitors = [convergence_monitor(frequency, field, **kwargs) for field in fields]
+
+    def reset(self, sample_rate=None):
+        for monitor in self.monitors:
+            monitor.reset(sample_rate)
+
+    def update(self, recording):
+        """Process new samples on every channel. Returns True once all are
+        steady."""
+        # Every channel is updated, so each records where it settled
+        return all([monitor.update(recording) for monitor in self.monitors])
+
+    @property
+    def converged(self):
+        return all(monitor.converged for monitor in self.monitors)
+
+    @property
+    def statistic(self):
+        return max(monitor.statistic for monitor in self.monitors)
+
+    @property
+    def steady_from(self):
+        """First sample from which every channel is steady, or None."""
+        if not self.converged:
+            return None
+        return max(monitor.steady_from for monitor in self.monitors)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+dtype_policy.py
+
+Which dtypes recordings are held and processed in, so that analysis of a long
+capture never makes a float64 copy of it.
+
+    storage:     int16 counts, as received. Recordings, envelopes and saved
+                 files stay in counts.
+    working:     float32, for per-sample arithmetic (counts to volts, products
+                 with a basis). 24 bits of mantissa hold a 14-bit sample and
+                 any calibration of it exactly enough.
+    accumulator: float64, for sums over many samples, which lose precision
+                 in float32 after about 1e7 terms.
+
+Per-sample work is done in blocks of block_samples, through buffers that are
+reused from block to block, so temporaries take O(block) memory whatever the
+recording length, and stay in cache between the steps applied to them.
+
+@author: cca78
+"""
+import numpy as np
+
+storage_dtype = np.dtype(np.int16)
+working_dtype = np.dtype(np.float32)
+accumulator_dtype = np.dtype(np.float64)
+
+# int16 in and float32 out of a block fit within L2
+block_samples = 1 << 16
+
+
+def blocks(n, block=block_samples):
+    """Yield (start, stop) of consecutive blocks covering range(n)."""
+    for start in range(0, n, block):
+        yield start, min(start + block, n)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+emulator.py
+
+Local stand-in for a Red Pitaya running CBC on a nonlinear rig, for testing
+CBC scripts (e.g. continuation.py) without hardware.
+
+The plant is a Duffing oscillator
+
+    x'' + 2 zeta w0 x' + w0^2 (x + beta x^3) = w0^2 u
+
+under the CBC law the FPGA applies,
+
+    u = Kp (r - x) + Kd (r' - x'),    r = r_hat sin(2 pi f t)
+
+integrated with fixed-step RK4 at the sample rate. u is scaled as a static
+displacement, so x, r and u share units and Kp is dimensionless.
+
+Captures come back as recordings in the API's format (in1, in2, out1, out2
+as int16 counts): in1 is displacement, in2 velocity / w0, out1 the control
+signal and out2 the reference. The state and reference phase carry over from one capture to
+the next, as the hardware keeps running between recordings with continuous
+output enabled, so a small parameter change only has a small transient.
+
+loopback_rig stands in for a board with converter gain and offset errors,
+for testing calibration.py.
+
+@author: cca78
+"""
+import math
+import numpy as np
+
+_recording_dtype = np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)])
+
+
+class duffing_plant(object):
+    """
+    Emulated CBC rig with the capture() interface used by continuation.py.
+
+    init arguments:
+        natural_frequency: w0 / 2 pi in Hz. The default is 10.
+        damping_ratio: zeta. The default is 0.02.
+        cubic_stiffness: beta. The default is 4 (hardening).
+        proportional_gain: Kp. The default is 1.
+        derivative_gain: Kd. The default is 0.
+        sample_rate: samples per second, also the integration rate. The
+            default is 2000.
+        counts_per_unit: scale from plant units to int16 counts. The default
+            is 8192 (one unit is one volt at the ADC).
+        noise: standard deviation of measurement noise, in plant units. The
+            default is 0.
+        cycles: reference cycles per capture. The default is 30.
+        settle_cycles: leading cycles discarded from harmonic estimates,
+            read by continuation.py. The default is 10.
+        seed: seed for the noise generator. The default is None.
+
+    e.g.
+
+    plant = duffing_plant()
+    recording, sample_rate = plant.capture(9.5, 0.2)
+    """
+
+    def __init__(self, natural_frequency=10, damping_ratio=0.02, cubic_stiffness=4,
+                 proportional_gain=1, derivative_gain=0, sample_rate=2000,
+                 counts_per_unit=8192, noise=0, cycles=30, settle_cycles=10, seed=None):
+        self.w0 = 2 * math.pi * natural_frequency
+        self.zeta = damping_ratio
+        self.beta = cubic_stiffness
+        self.kp = proportional_gain
+        self.kd = derivative_gain
+        self.sample_rate = sample_rate
+        self.counts_per_unit = counts_per_unit
+        self.noise = noise
+        self.cycles = cycles
+        self.settle_cycles = settle_cycles
+        self.rng = np.random.default_rng(seed)
+
+        self.state = (0.0, 0.0)
+        self.phase = 0.0
+        self.n_captures = 0
+        self.n_samples = 0
+
+    def reset(self):
+        """Return the plant to rest."""
+        self.state = (0.0, 0.0)
+        self.phase = 0.0
+
+    def capture(self, frequency, reference_amplitude, duration=None):
+        """
+        Run the plant with a new reference and record it.
+
+        Parameters
+        ----------
+        frequency : float
+            Reference frequency in Hz.
+        reference_amplitude : float
+            r_hat, in plant units.
+        duration : float, optional
+            Seconds to record. The default is None, meaning self.cycles
+            cycles of the reference.
+
+        Returns
+        -------
+        recording : structured ndarray (in1, in2, out1, out2 int16 counts)
+        sample_rate : float
+        """
+        if duration is None:
+            duration = self.cycles / frequency
+        n = int(duration * self.sample_rate)
+        dt = 1.0 / self.sample_rate
+        omega = 2 * math.pi * frequency
+        w0_sq = self.w0 ** 2
+        inverse_w0 = 1 / self.w0
+        c = 2 * self.zeta * self.w0
+        beta = self.beta
+        kp = self.kp
+        kd = self.kd
+
+        def acceleration(x, v, r, r_dot):
+            u = kp * (r - x) + kd * (r_dot - v)
+            return w0_sq * (u - x - beta * x * x * x) - c * v, u
+
+        out = np.empty((n, 4))
+        x, v = self.state
+        phase = self.phase
+        for i in range(n):
+            s0 = math.sin(phase)
+            c0 = math.cos(phase)
+            r0 = reference_amplitude * s0
+            a1, u = acceleration(x, v, r0, reference_amplitude * omega * c0)
+            out[i] = (x, v * inverse_w0, u, r0)
+
+            half = phase + 0.5 * omega * dt
+            rh = reference_amplitude * math.sin(half)
+            rh_dot = reference_amplitude * omega * math.cos(half)
+            a2, _ = acceleration(x + 0.5 * dt * v, v + 0.5 * dt * a1, rh, rh_dot)
+            a3, _ = acceleration(x + 0.5 * dt * (v + 0.5 * dt * a1), v + 0.5 * dt * a2, rh, rh_dot)
+            full = phase + omega * dt
+            a4, _ = acceleration(x + dt * (v + 0.5 * dt * a2), v + dt * a3,
+                                 reference_amplitude * math.sin(full),
+                                 reference_amplitude * omega * math.cos(full))
+            x, v = (x + dt * (v + dt * (a1 + a2 + a3) / 6),
+                    v + dt * (a1 + 2 * a2 + 2 * a3 + a4) / 6)
+            phase = full % (2 * math.pi)
+
+        self.state = (x, v)
+        self.phase = phase
+        self.n_captures += 1
+        self.n_samples += n
+
+        if self.noise:
+            out += self.rng.normal(0, self.noise, out.shape)
+        counts = np.clip(np.rint(out * self.counts_per_unit), -32768, 32767).astype(np.int16)
+        recording = np.empty(n, dtype=_recording_dtype)
+        for column, name in enumerate(_recording_dtype.names):
+            recording[name] = counts[:, column]
+        return recording, self.sample_rate
+
+
+class loopback_rig(object):
+    """
+    Emulated board with imperfect converters and each output wired to an
+    input, with the capture_reference() interface used by calibration.py.
+
+    The DAC produces (command - dac_offset) / dac_gain volts for a command
+    in counts, and the ADC reads adc_gain * volts + adc_offset counts. With
+    external=True, the inputs see the reference voltage itself (as from a
+    bench supply) and the outputs stay at zero; otherwise they see the
+    outputs, commanded to the reference at nominal gain.
+
+    init arguments:
+        adc_gain, adc_offset, dac_gain, dac_offset: dicts keyed by 'in1',
+            'in2' and 'out1', 'out2' respectively, in counts per volt and
+            counts. Missing channels are ideal (8192, 0).
+        noise: standard deviation of ADC noise, in counts. The default is 4.
+        sample_rate: samples per second. The default is 2000.
+        duration: seconds per capture. The default is 0.05.
+        external: apply references directly to the inputs. The default is
+            False.
+        seed: seed for the noise generator. The default is None.
+
+    e.g.
+
+    rig = loopback_rig(adc_gain={'in1': 8050}, adc_offset={'in1': 85}, external=True)
+    fits = calibration.calibrate_inputs(rig, [-0.8, 0, 0.8])
+    """
+
+    def __init__(self, adc_gain=None, adc_offset=None, dac_gain=None, dac_offset=None,
+                 noise=4, sample_rate=2000, duration=0.05, external=False, seed=None):
+        self.adc_gain = dict({'in1': 8192, 'in2': 8192}, **(adc_gain or {}))
+        self.adc_offset = dict({'in1': 0, 'in2': 0}, **(adc_offset or {}))
+        self.dac_gain = dict({'out1': 8192, 'out2': 8192}, **(dac_gain or {}))
+        self.dac_offset = dict({'out1': 0, 'out2': 0}, **(dac_offset or {}))
+        self.noise = noise
+        self.sample_rate = sample_rate
+        self.duration = duration
+        self.external = external
+        self.rng = np.random.default_rng(seed)
+
+    def capture_reference(self, volts):
+        n = int(self.duration * self.sample_rate)
+        command = 0 if self.external else int(round(volts * 8192))
+        recording = np.empty(n, dtype=_recording_dtype)
+        for output, input_field in (('out1', 'in1'), ('out2', 'in2')):
+            recording[output] = command
+            applied = volts if self.external else (command - self.dac_offset[output]) / self.dac_gain[output]
+            counts = self.adc_gain[input_field] * applied + self.adc_offset[input_field]
+            counts = counts + self.rng.normal(0, self.noise, n)
+            recording[input_field] = np.clip(np.rint(counts), -32768, 32767)
+        return recording
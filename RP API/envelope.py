@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+envelope.py
+
+Multi-resolution min/max envelope ("pyramid") of a recording, for plotting
+captures that are far longer than the screen is wide.
+
+Level k of the pyramid holds the min and max of consecutive blocks of
+factor**(k+1) samples. Plotting asks for the window it is showing and the
+number of pixels it has, and gets back the coarsest level that still has
+at least one block per pixel, as an interleaved min/max line. A redraw then
+costs O(pixels) regardless of how long the capture is.
+
+The pyramid keeps a reference to (not a copy of) the data, so it can be built
+over a buffer that is still being filled (e.g. the shared memory block of a
+recording in progress) and brought up to date with update(n_valid).
+
+@author: cca78
+"""
+import numpy as np
+
+
+class MinMaxPyramid(object):
+    """
+    Min/max envelope pyramid over a 1D array.
+
+    init arguments:
+        data: 1D array (any numeric dtype, typically int16 counts). Not copied.
+        factor: reduction factor between levels. The default is 4.
+        n_valid: number of leading samples of data which are valid. The
+            default is None, meaning all of them.
+
+    e.g.
+
+    pyramid = MinMaxPyramid(recording['in1'])
+    x, y = pyramid.query(0, len(recording), 1000)
+    line.set_data(x, y)
+    """
+
+    def __init__(self, data, factor=4, n_valid=None):
+        if factor < 2:
+            raise ValueError("'factor' must be at least 2")
+
+        self.data = data
+        self.factor = int(factor)
+        self.n_valid = 0
+
+        # Preallocate every level for the full length of the buffer, so that
+        # update() never reallocates.
+        self.block_sizes = []
+        self.mins = []
+        self.maxs = []
+        self.filled = []
+        block = self.factor
+        while block <= len(data):
+            n_blocks = len(data) // block
+            self.block_sizes.append(block)
+            self.mins.append(np.empty(n_blocks, dtype=data.dtype))
+            self.maxs.append(np.empty(n_blocks, dtype=data.dtype))
+            self.filled.append(0)
+            block *= self.factor
+
+        self.update(len(data) if n_valid is None else n_valid)
+
+    def __len__(self):
+        return self.n_valid
+
+    def update(self, n_valid):
+        """
+        Extend the envelope to cover data[:n_valid]. Only blocks completed
+        since the last call are reduced, so calling this once per received
+        chunk costs O(chunk) in total.
+
+        Parameters
+        ----------
+        n_valid : int
+            Number of leading samples of the buffer which now hold data.
+
+        Returns
+        -------
+        None.
+
+        """
+        n_valid = min(int(n_valid), len(self.data))
+        if n_valid <= self.n_valid:
+            return
+        self.n_valid = n_valid
+
+        source_min = source_max = self.data
+        source_len = n_valid
+        for level in range(len(self.block_sizes)):
+            done = self.filled[level]
+            ready = source_len // self.factor
+            if ready > done:
+                lo = done * self.factor
+                hi = ready * self.factor
+                self.mins[level][done:ready] = source_min[lo:hi].reshape(-1, self.factor).min(axis=1)
+                self.maxs[level][done:ready] = source_max[lo:hi].reshape(-1, self.factor).max(axis=1)
+                self.filled[level] = ready
+            source_min = self.mins[level]
+            source_max = self.maxs[level]
+            source_len = self.filled[level]
+
+    def choose_level(self, span, n_pixels):
+        """Return the coarsest level with at least one block per pixel over
+        span samples, or -1 if the raw samples should be drawn."""
+        level = -1
+        for i, block in enumerate(self.block_sizes):
+            if span / block >= n_pixels:
+                level = i
+            else:
+                break
+        return level
+
+    def query(self, start, stop, n_pixels):
+        """
+        Return a line through the envelope of data[start:stop] suitable for
+        Line2D.set_data(), with between 2 and 2 * factor points per pixel.
+
+        Parameters
+        ----------
+        start, stop : int
+            Sample index window being displayed. Clipped to the valid data.
+        n_pixels : int
+            Width of the axes in pixels.
+
+        Returns
+        -------
+        x : ndarray
+            Sample indices (float64).
+        y : ndarray
+            Values, same dtype as data - min and max of each block interleaved.
+
+        """
+        start = max(0, int(start))
+        stop = min(self.n_valid, int(np.ceil(stop)))
+        if stop <= start:
+            return np.zeros(0), np.zeros(0, dtype=self.data.dtype)
+
+        level = self.choose_level(stop - start, max(1, int(n_pixels)))
+        if level < 0:
+            return np.arange(start, stop, dtype=np.float64), self.data[start:stop]
+
+        block = self.block_sizes[level]
+        first = start // block
+        last = min(-(-stop // block), self.filled[level])
+        mins = self.mins[level][first:last]
+        maxs = self.maxs[level][first:last]
+
+        y = np.empty(2 * len(mins), dtype=self.data.dtype)
+        y[0::2] = mins
+        y[1::2] = maxs
+        x = np.repeat(np.arange(first, last, dtype=np.float64) * block + block / 2, 2)
+
+        # Samples past the last complete block (at most block - 1 of them)
+        # are below a pixel wide, draw them raw.
+        tail = last * block
+        if tail < stop and last == self.filled[level]:
+            x = np.concatenate((x, np.arange(tail, stop, dtype=np.float64)))
+            y = np.concatenate((y, self.data[tail:stop]))
+        return x, y
+
+    def limits(self, start=0, stop=None):
+        """
+        Min and max of data[start:stop] in O(log n) blocks per edge, for
+        setting axis limits without a full pass over the data.
+
+        Returns
+        -------
+        (min, max) tuple, or (0, 0) if the window is empty.
+
+        """
+        stop = self.n_valid if stop is None else min(self.n_valid, int(stop))
+        start = max(0, int(start))
+        if stop <= start:
+            return 0, 0
+
+        lo = None
+        hi = None
+
+        def merge(values_min, values_max):
+            nonlocal lo, hi
+            if len(values_min):
+                vmin = values_min.min()
+                vmax = values_max.max()
+                lo = vmin if lo is None else min(lo, vmin)
+                hi = vmax if hi is None else max(hi, vmax)
+
+        # Walk down from the coarsest level, taking whole blocks inside the
+        # window and leaving ragged edges to the finer levels and raw data.
+        remaining = [(start, stop)]
+        for level in reversed(range(len(self.block_sizes))):
+            block = self.block_sizes[level]
+            next_remaining = []
+            for a, b in remaining:
+                first = -(-a // block)
+                last = min(b // block, self.filled[level])
+                if last > first:
+                    merge(self.mins[level][first:last], self.maxs[level][first:last])
+                    next_remaining.append((a, first * block))
+                    next_remaining.append((last * block, b))
+                else:
+                    next_remaining.append((a, b))
+            remaining = [(a, b) for a, b in next_remaining if b > a]
+
+        for a, b in remaining:
+            merge(self.data[a:b], self.data[a:b])
+
+        return lo, hi
+
+
+def attach_envelope(ax, line, pyramid, x_scale=1.0, y_scale=1.0, y_offset=0.0):
+    """
+    Draw pyramid on an existing Line2D and keep it at the right resolution
+    as the user zooms and pans (re-queries on the axes' xlim_changed event).
+
+    Arguments:
+        ax: matplotlib axes holding line
+        line: Line2D to draw the envelope into
+        pyramid: MinMaxPyramid
+        x_scale: x units per sample, e.g. 1/sample_rate to plot against time
+        y_scale, y_offset: applied to the (few) envelope points only, so the
+            recording is never converted as a whole.
+
+    Returns:
+        callback id from ax.callbacks.connect, for disconnecting.
+    """
+
+    def redraw(ax):
+        x_lo, x_hi = ax.get_xlim()
+        n_pixels = max(1, int(ax.bbox.width))
+        x, y = pyramid.query(x_lo / x_scale, x_hi / x_scale + 1, n_pixels)
+        line.set_data(x * x_scale, y * y_scale + y_offset)
+
+    x, y = pyramid.query(0, len(pyramid), max(1, int(ax.bbox.width)))
+    line.set_data(x * x_scale, y * y_scale + y_offset)
+    ax.set_xlim(0, max(len(pyramid) - 1, 1) * x_scale)
+    y_lo, y_hi = sorted(v * y_scale + y_offset for v in pyramid.limits())
+    if y_hi > y_lo:
+        ax.set_ylim(y_lo, y_hi)
+    return ax.callbacks.connect('xlim_changed', redraw)
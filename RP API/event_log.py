@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+event_log.py
+
+Structured, levelled logging for the API.
+
+Each subsystem ("api", "comms", "system", ...) logs through its own logger,
+"RP.<subsystem>", so levels can be set per subsystem. Records are handed to a
+queue and formatted and written to file by a background thread, so logging on
+the hot path costs a level check and a queue put, and never waits on the disk.
+
+Messages use logging's lazy %-style arguments, or log_event() for an event
+name plus key=value fields. Either way nothing is formatted unless the level
+is enabled.
+
+e.g.
+
+import logging
+import event_log
+
+event_log.configure(level=logging.INFO, levels={"comms": logging.DEBUG})
+log = event_log.get_logger("comms")
+log.debug("%d bytes to receive", n_bytes)
+event_log.log_event(log, logging.INFO, "record", samples=n_samples)
+
+@author: cca78
+"""
+import os
+import atexit
+import queue
+import logging
+import logging.handlers
+
+_root_name = "RP"
+_listener = None
+_listener_pid = None
+
+
+class _deferred_queue_handler(logging.handlers.QueueHandler):
+    """QueueHandler which leaves all formatting to the writer thread (the
+    stock prepare() formats the message in the caller's thread). Arguments
+    are formatted when written, so log immutable values, or copies."""
+    def prepare(self, record):
+        return record
+
+
+class event_formatter(logging.Formatter):
+    """Formatter which appends a record's 'fields' as key=value pairs."""
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join("{}={}".format(key, value) for key, value in fields.items())
+        return message
+
+
+def get_logger(subsystem):
+    """Logger for one subsystem, e.g. get_logger("comms")."""
+    return logging.getLogger(_root_name + "." + subsystem)
+
+
+def configure(filename="APIlog.log", level=None, levels=None):
+    """
+    Set levels and, once per process, start the writer thread.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Log file, appended to. Only used by the first call in a process.
+        The default is 'APIlog.log'.
+    level : int, optional
+        Level for all subsystems (e.g. logging.INFO). The default is None,
+        which leaves it unchanged (logging.WARNING if never set).
+    levels : dict, optional
+        {subsystem: level} overrides, e.g. {"comms": logging.DEBUG}.
+
+    Returns
+    -------
+    None.
+
+    """
+    global _listener, _listener_pid
+
+    root = logging.getLogger(_root_name)
+    if level is not None:
+        root.setLevel(level)
+    for subsystem, subsystem_level in (levels or {}).items():
+        get_logger(subsystem).setLevel(subsystem_level)
+
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+
+    # First call, or a forked child whose copy of the writer thread doesn't
+    # run: replace the handler with one feeding a new writer.
+    for handler in list(root.handlers):
+        if isinstance(handler, _deferred_queue_handler):
+            root.removeHandler(handler)
+
+    records = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(event_formatter("%(asctime)s.%(msecs)03d %(name)s %(levelname)s %(message)s",
+                                              datefmt="%m/%d/%Y %I:%M:%S"))
+    root.addHandler(_deferred_queue_handler(records))
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(stop)
+
+
+def stop():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
+
+
+def log_event(logger, level, event, **fields):
+    """Log an event name with key=value fields, if level is enabled."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+harmonics.py
+
+Harmonic estimates of periodic recordings at a known frequency, e.g. the
+fundamental of the displacement and control signals during a CBC capture.
+
+Coefficients are found by least squares against a [1, cos, sin, ...] basis,
+so the window need not hold a whole number of samples per period. The fit is
+accumulated a block at a time, so memory use doesn't grow with the window. Returned
+as complex amplitudes A_k, where the signal is
+
+    x(t) ~ A_0 + sum_k Re(A_k exp(2j pi k f t))
+
+with t measured from the first sample of the window. |A_k| is the amplitude
+of harmonic k.
+
+@author: cca78
+"""
+import numpy as np
+
+from dtype_policy import working_dtype, accumulator_dtype, blocks
+
+
+def fit_harmonics(signal, frequency, sample_rate, n_harmonics=1, skip_cycles=0,
+                  n_cycles=None):
+    """
+    Least-squares harmonic coefficients of a signal.
+
+    Parameters
+    ----------
+    signal : 1D array
+        Samples (any numeric dtype, e.g. int16 counts from a recording).
+    frequency : float
+        Fundamental frequency in Hz.
+    sample_rate : float
+        Samples per second.
+    n_harmonics : int, optional
+        Number of harmonics above the mean to fit. The default is 1.
+    skip_cycles : float, optional
+        Cycles to discard from the start, e.g. a transient after a settings
+        change. The default is 0.
+    n_cycles : int, optional
+        Fit only the last n_cycles whole cycles after skip_cycles. The
+        default is None, meaning every whole cycle available.
+
+    Returns
+    -------
+    ndarray of n_harmonics + 1 complex amplitudes [A_0, A_1, ...].
+
+    """
+    samples_per_cycle = sample_rate / frequency
+    start = int(round(skip_cycles * samples_per_cycle))
+    available = int((len(signal) - start) / samples_per_cycle)
+    if n_cycles is not None:
+        available = min(available, int(n_cycles))
+    if available < 1:
+        raise ValueError("Recording holds less than one cycle at {} Hz after skipping {} cycles".format(frequency, skip_cycles))
+
+    # Last whole cycles of the recording
+    n_samples = int(round(available * samples_per_cycle))
+    stop = len(signal)
+    start = stop - n_samples
+
+    # Normal equations, accumulated block by block so that neither the basis
+    # nor a float copy of the signal is ever held whole
+    n_terms = 2 * n_harmonics + 1
+    gram = np.zeros((n_terms, n_terms), dtype=accumulator_dtype)
+    projection = np.zeros(n_terms, dtype=accumulator_dtype)
+    radians_per_sample = 2 * np.pi * frequency / sample_rate
+    for first, last in blocks(n_samples):
+        phase = radians_per_sample * np.arange(first, last)
+        basis = np.empty((last - first, n_terms), dtype=accumulator_dtype)
+        basis[:, 0] = 1
+        for k in range(1, n_harmonics + 1):
+            np.cos(k * phase, out=basis[:, 2 * k - 1])
+            np.sin(k * phase, out=basis[:, 2 * k])
+        gram += basis.T @ basis
+        projection += basis.T @ signal[start + first:start + last].astype(working_dtype)
+    coefficients = np.linalg.solve(gram, projection)
+
+    # a cos + b sin = Re((a - jb) exp(j phase))
+    amplitudes = np.empty(n_harmonics + 1, dtype=np.complex128)
+    amplitudes[0] = coefficients[0]
+    amplitudes[1:] = coefficients[1::2] - 1j * coefficients[2::2]
+    return amplitudes
+
+
+def harmonic_amplitude(signal, frequency, sample_rate, harmonic=1, **kwargs):
+    """Amplitude |A_k| of one harmonic. kwargs are passed to fit_harmonics."""
+    return abs(fit_harmonics(signal, frequency, sample_rate, n_harmonics=harmonic, **kwargs)[harmonic])
@@ -18,10 +18,14 @@ arbitrary shifts by a number of bits are commented next to the entry in the mapp
 otherwise scale_and_convert does the work. _millivolts_to_counts scales by 8.191, and float_to_fix
 left shifts the integer by 16 bits, and represents the fractional portion as the remaining 16 bits.
 Mathematically, kind of like a 16 bit left shift, but with some truncation/quantisation.
+
+FPGA_settings() runs the same mappings on frozen config snapshots and caches
+the result, so re-sending a setting that has been sent before (e.g. returning
+to a sweep point) skips the conversion.
 """
 
 from float_converter import NumpyFloatToFixConverter
-from functools import partial
+from functools import partial, lru_cache
 
 
 # Map mode names to their number representation on fabric
@@ -314,6 +318,33 @@ def update_FPGA_config(system_dict, FPGA):
     # _trigger = int(trigger) << 2 // trigger removed as it is set in the comms module, I will need to handle it there. Delete this comment if still here June 2024.
     settings_byte = int(fast_mode | continuous_mode)
     FPGA['system'] = settings_byte
+
+
+@lru_cache(maxsize=1024)
+def FPGA_settings(CH1, CH2, CBC, system):
+    """Memoised mapping of a full set of frozen configs to FPGA config
+    values, as update_FPGA_settings() applies them: CBC if enabled, else both
+    channels, then the system settings.
+
+    Arguments:
+        CH1, CH2 (channel_config.frozen), CBC (CBC_config.frozen),
+        system (system_config.frozen): snapshots from config.freeze()
+
+    Returns:
+        tuple of (FPGA parameter, value) pairs. Parameters belonging to the
+        mode not in use are absent, and should be left as they are.
+
+    e.g.
+    RP.system.comms.config.update(FPGA_settings(*RP.snapshot()))
+    """
+    FPGA = {}
+    if CBC.CBC_enabled:
+        update_FPGA_channel('CBC', CBC._asdict(), FPGA)
+    else:
+        update_FPGA_channel(1, CH1._asdict(), FPGA)
+        update_FPGA_channel(2, CH2._asdict(), FPGA)
+    update_FPGA_config(system, FPGA)
+    return tuple(FPGA.items())
     
 
 """Mapping dictionaries. One dictionary per mode. Each dictionary is keyed by
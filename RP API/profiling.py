@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+profiling.py
+
+Named timing spans for the API's hot stages (config mapping, packing, socket
+connect, handshake, receive loop, copy, save, plot), timed with
+time.perf_counter_ns.
+
+Spans are collected into a session, which can summarise them as per-stage
+statistics and histograms, or export them as Chrome trace JSON
+(chrome://tracing or https://ui.perfetto.dev) to see where a capture's wall
+time goes. Spans timed in the recording process are passed back and merged
+into the parent's session. numpy is only imported by the analysis methods,
+so recording processes don't pay for it at start-up.
+
+e.g.
+
+from profiling import session
+
+RP.start_record()
+session.print_summary()
+session.export_chrome_trace("capture_trace.json")
+
+@author: cca78
+"""
+import os
+import json
+import threading
+from time import perf_counter_ns
+from contextlib import contextmanager
+from functools import wraps
+
+
+class profiling_session(object):
+    """
+    Collection of timed spans.
+
+    init arguments:
+        enabled: record spans. When False span() and timed() cost a function
+            call and nothing more. The default is True.
+        max_events: oldest spans are dropped beyond this many. The default
+            is 100000.
+
+    Each span is stored as a tuple (name, start_ns, duration_ns, pid, tid).
+    """
+
+    def __init__(self, enabled=True, max_events=100000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start_ns, duration_ns, pid=None, tid=None):
+        """Record a span that was timed elsewhere."""
+        event = (name, start_ns, duration_ns,
+                 os.getpid() if pid is None else pid,
+                 threading.get_ident() if tid is None else tid)
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) > self.max_events:
+                del self.events[:len(self.events) - self.max_events]
+
+    @contextmanager
+    def span(self, name):
+        """Context manager timing the enclosed block as span 'name'."""
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, perf_counter_ns() - start)
+
+    def timed(self, name=None):
+        """Decorator timing every call of a function as span 'name'
+        (default: the function's qualified name)."""
+        def decorator(func):
+            span_name = func.__qualname__ if name is None else name
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def take(self):
+        """Remove and return all recorded spans, e.g. to send them from a
+        child process to the parent's session."""
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def merge(self, events):
+        """Add spans taken from another session (e.g. a child process).
+        perf_counter_ns is system-wide on Windows and Linux, so timestamps from
+        both processes share a time base."""
+        with self.lock:
+            self.events.extend(events)
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+
+    def durations(self):
+        """dict of span name: array of durations in ns"""
+        import numpy as np
+        grouped = {}
+        for name, _, duration, _, _ in self.events:
+            grouped.setdefault(name, []).append(duration)
+        return {name: np.array(values, dtype=np.int64) for name, values in grouped.items()}
+
+    def histograms(self, bins_per_decade=5):
+        """
+        Log-spaced histograms of span durations.
+
+        Returns
+        -------
+        dict of span name: (counts, bin_edges_ns)
+        """
+        import numpy as np
+        histograms = {}
+        for name, values in self.durations().items():
+            lo = np.floor(np.log10(max(values.min(), 1)))
+            hi = np.ceil(np.log10(max(values.max(), 1))) + (values.max() == values.min())
+            edges = np.logspace(lo, hi, int((hi - lo) * bins_per_decade) + 1)
+            counts, edges = np.histogram(values, bins=edges)
+            histograms[name] = (counts, edges)
+        return histograms
+
+    def summary(self):
+        """
+        Per-span statistics.
+
+        Returns
+        -------
+        dict of span name: dict with count, total, mean, median, p99 and max
+        in ms.
+        """
+        import numpy as np
+        stats = {}
+        for name, values in self.durations().items():
+            ms = values / 1e6
+            stats[name] = {"count": len(ms),
+                           "total": ms.sum(),
+                           "mean": ms.mean(),
+                           "median": np.median(ms),
+                           "p99": np.percentile(ms, 99),
+                           "max": ms.max()}
+        return stats
+
+    def print_summary(self):
+        """Print summary() as a table, longest total first."""
+        stats = self.summary()
+        print("{:<25} {:>7} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+            "Span", "Count", "Total (ms)", "Mean", "Median", "p99", "Max"))
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+            print("{:<25} {:>7} {:>12.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                name, s["count"], s["total"], s["mean"], s["median"], s["p99"], s["max"]))
+
+    def export_chrome_trace(self, filename):
+        """Write all spans as Chrome trace event JSON ('X' complete events,
+        timestamps in us)."""
+        trace = [{"name": name,
+                  "ph": "X",
+                  "ts": start / 1e3,
+                  "dur": duration / 1e3,
+                  "pid": pid,
+                  "tid": tid}
+                 for name, start, duration, pid, tid in self.events]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+# Session shared by the API modules
+session = profiling_session()
+span = session.span
+timed = session.timed
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+replay.py
+
+Replays stored recordings through the live recording pipeline, for tuning
+and regression testing live analysis, plotting and adaptive-duration logic
+without hardware.
+
+A replay_source stands in for the board in RP_communications: config packets
+are kept (in .configs) rather than sent, and the recording process receives
+from the source instead of the socket, through the same recv_into loop, into
+the same shared memory. Everything downstream (monitors, transient
+detection, saving, the catalog, plotting) runs as it would live.
+
+Chunks are emitted at the capture's sample rate times speed (speed=None is
+as fast as possible), optionally with random extra delay per chunk (jitter)
+and occasional stalls, drawn from a seeded generator so runs repeat exactly.
+Each recording carries on from where the last stopped, wrapping to the start
+of the capture with loop=True. If the capture runs out the connection
+closes, as a dropped socket would.
+
+Captures can be .rpz (only the chunks each recording covers are decoded),
+.npy (memory-mapped), .csv as saved by RP.save_recording, or a recording
+array.
+
+e.g.
+
+from replay import replay_source
+RP.replay(replay_source("Data/ringdown.rpz", speed=4, jitter=0.002, seed=1))
+RP.start_record(monitor=convergence_monitor(frequency=98.2e3))
+RP.replay(None)                                 # back to the board
+
+@author: cca78
+"""
+import logging
+from collections import deque
+from time import perf_counter, sleep
+import numpy as np
+
+import event_log
+
+log = event_log.get_logger("replay")
+
+_recording_dtype = np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)])
+
+
+def load_csv(path):
+    """Recording from a csv saved by RP.save_recording."""
+    columns = np.loadtxt(path, delimiter=";", comments="#", dtype=np.int16, ndmin=2)
+    recording = np.empty(len(columns), dtype=_recording_dtype)
+    for i, name in enumerate(_recording_dtype.names):
+        recording[name] = columns[:, i]
+    return recording
+
+
+class replay_source(object):
+    """
+    Stored capture played back in place of the board. See module docstring.
+
+    init arguments:
+        capture: path of a .rpz, .npy or .csv recording, or a recording
+            array.
+        sample_rate: samples per second of the capture. The default is
+            None, meaning the RedPitaya's rate when given to RP.replay().
+        speed: multiple of real time, or None for as fast as possible. The
+            default is 1.
+        chunk_bytes: bytes per chunk received. The default is 65536.
+        jitter: mean extra delay per chunk in seconds (exponentially
+            distributed). The default is 0.
+        stall_probability: chance per chunk of a stall. The default is 0.
+        stall: seconds a stall lasts. The default is 0.2.
+        loop: wrap to the start at the end of the capture. The default is
+            True.
+        seed: seed for jitter and stalls. The default is None.
+    """
+
+    def __init__(self, capture, sample_rate=None, speed=1.0, chunk_bytes=65536, jitter=0.0,
+                 stall_probability=0.0, stall=0.2, loop=True, seed=None):
+        self.capture = capture
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.chunk_bytes = chunk_bytes - chunk_bytes % _recording_dtype.itemsize
+        self.jitter = jitter
+        self.stall_probability = stall_probability
+        self.stall = stall
+        self.loop = loop
+        self.seed = seed
+
+        if isinstance(capture, np.ndarray):
+            self.data = capture
+        elif str(capture).endswith(".csv"):
+            self.data = load_csv(capture)
+        elif str(capture).endswith(".npy"):
+            self.data = np.load(capture, mmap_mode="r")
+        elif str(capture).endswith(".rpz"):
+            self.data = None        # read per recording
+            from storage import rpz_file
+            with rpz_file(capture) as stored:
+                self.samples = len(stored)
+        else:
+            raise ValueError("Can't replay {}: expected .rpz, .npy, .csv or an array".format(capture))
+        if self.data is not None:
+            if self.data.dtype != _recording_dtype:
+                raise ValueError("Capture has dtype {}, expected {}".format(self.data.dtype, _recording_dtype))
+            self.samples = len(self.data)
+        if not self.samples:
+            raise ValueError("Capture {} is empty".format(capture))
+
+        self.position = 0               # samples replayed so far
+        self.recordings = 0
+        self.configs = deque(maxlen=1024)   # config packets "sent"
+
+    def read(self, start, stop):
+        if self.data is not None:
+            return self.data[start:stop]
+        from storage import rpz_file
+        with rpz_file(self.capture, workers=1) as stored:
+            return stored.read(start, stop)
+
+    def samples_from(self, start, n):
+        """n samples from start, wrapped if looping, else as many as are
+        left."""
+        if self.loop:
+            start %= self.samples
+        pieces = []
+        while n > 0 and start < self.samples:
+            piece = self.read(start, min(start + n, self.samples))
+            pieces.append(piece)
+            n -= len(piece)
+            start = 0 if self.loop else self.samples
+        if not pieces:
+            return np.empty(0, dtype=_recording_dtype)
+        return np.concatenate(pieces) if len(pieces) > 1 else np.ascontiguousarray(pieces[0])
+
+    # =========================================================================
+    # RP_communications interface
+    # =========================================================================
+    def configure(self, packet):
+        """Keep a config packet in place of sending it."""
+        self.configs.append(bytes(packet))
+
+    def connect(self, nbytes):
+        """Start replaying a recording of nbytes. Returns an object with
+        the socket's recv_into."""
+        data = self.samples_from(self.position, nbytes // _recording_dtype.itemsize)
+        # Runs in the recording process: the count is advanced by the
+        # parent, in advance()
+        seed = None if self.seed is None else (self.seed, self.recordings)
+        event_log.log_event(log, logging.DEBUG, "replay", position=self.position, samples=len(data))
+        return replay_stream(data, self, np.random.default_rng(seed))
+
+    def advance(self, nbytes):
+        """Move past the samples a recording took. Called in the parent
+        once the recording process has finished."""
+        self.recordings += 1
+        self.position += nbytes // _recording_dtype.itemsize
+        if self.loop:
+            self.position %= self.samples
+
+
+class replay_stream(object):
+    """One recording's worth of playback, paced as set by its source."""
+
+    def __init__(self, data, source, rng):
+        self.data = memoryview(data.view(np.uint8)).cast("B")
+        self.sent = 0
+        self.rate = None
+        if source.speed and source.sample_rate:
+            self.rate = source.sample_rate * _recording_dtype.itemsize * source.speed
+        self.source = source
+        self.rng = rng
+        self.delay = 0.0
+        self.start = perf_counter()
+
+    def recv_into(self, view, nbytes):
+        size = min(nbytes, self.source.chunk_bytes, len(self.data) - self.sent)
+        if size <= 0:
+            return 0
+        if self.source.jitter:
+            self.delay += self.rng.exponential(self.source.jitter)
+        if self.source.stall_probability and self.rng.random() < self.source.stall_probability:
+            self.delay += self.source.stall
+        if self.rate:
+            due = self.start + (self.sent + size) / self.rate + self.delay
+        else:
+            due = self.start + self.delay
+        wait = due - perf_counter()
+        if wait > 0:
+            sleep(wait)
+        view[:size] = self.data[self.sent:self.sent + size]
+        self.sent += size
+        return size
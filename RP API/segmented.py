@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+segmented.py
+
+Segmented acquisition: many short, repeated segments (ring-downs, impulse or
+periodic responses) taken in one recording session and coherently averaged
+as they arrive.
+
+The board has one software trigger per recording, so the segments are cut
+from a single continuous capture rather than triggered one by one: with a
+periodic excitation running (continuous output on), segment k starts at
+sample round((skip + k) * period), where the period is a whole number of
+excitation cycles at the sample rate and may be fractional in samples.
+Rounding each start separately keeps every segment within half a sample of
+the excitation phase, however many segments are taken. The capture lands in
+the one shared memory buffer allocated for the recording, and
+segment_averager.segments() gives it back as a (segments, samples) view.
+
+segment_averager has the convergence_monitor interface, so it is updated
+while the recording is running (RP.start_record(monitor=...)): each complete
+segment is folded into a running mean and variance per sample index with
+Welford's update, in float64, so there is never more than one segment of
+temporaries. With a tolerance, the recording stops early once the standard
+error of the average, relative to its RMS, falls below it.
+
+e.g.
+
+averager = segment_averager(segments=200, frequency=98.2e3, cycles=40, skip=2)
+RP.start_segmented_record(averager)
+averager.mean("in1"), averager.standard_error("in1"), averager.count
+
+@author: cca78
+"""
+import numpy as np
+
+from dtype_policy import accumulator_dtype
+
+
+class segment_averager(object):
+    """
+    Running coherent average and variance of repeated segments. See module
+    docstring.
+
+    init arguments:
+        segments: segments to average (K).
+        segment_samples: samples per segment, or None to give frequency and
+            cycles instead. The default is None.
+        frequency: excitation frequency in Hz. The default is None.
+        cycles: excitation cycles per segment. The default is 1.
+        skip: segments' worth of samples ignored at the start, while the
+            response settles. The default is 0.
+        fields: recording fields to average. The default is all four.
+        tolerance: stop once standard error / RMS of the average of field
+            falls below this. The default is None, meaning take every
+            segment.
+        field: field tolerance is tested on. The default is 'in1'.
+        min_segments: segments before tolerance is tested. The default
+            is 8.
+        sample_rate: samples per second. Set by RP.start_segmented_record()
+            if not given here.
+    """
+
+    def __init__(self, segments, segment_samples=None, frequency=None, cycles=1, skip=0,
+                 fields=('in1', 'in2', 'out1', 'out2'), tolerance=None, field='in1',
+                 min_segments=8, sample_rate=None):
+        if segment_samples is None and frequency is None:
+            raise ValueError("Give segment_samples, or frequency and cycles")
+        self.n_segments = int(segments)
+        self.segment_samples = segment_samples
+        self.frequency = frequency
+        self.cycles = cycles
+        self.skip = skip
+        self.fields = tuple(fields)
+        self.tolerance = tolerance
+        self.field = field
+        self.min_segments = min_segments
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self, sample_rate=None):
+        """Clear the averages before a new recording."""
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if self.segment_samples is None and self.sample_rate is None:
+            # Allocated once the sample rate is known
+            self.length = None
+        else:
+            self.length = int(self.period())
+        self.count = 0
+        self.converged = False
+        self.statistic = np.inf
+        if self.length is not None:
+            # Welford's running mean, and M2: the sum of squared deviations
+            # from it, per sample and field
+            self.running_mean = np.zeros((self.length, len(self.fields)), dtype=accumulator_dtype)
+            self.m2 = np.zeros_like(self.running_mean)
+
+    def period(self):
+        """Samples from one segment start to the next (may be fractional)."""
+        if self.segment_samples is not None:
+            return float(self.segment_samples)
+        return self.cycles * self.sample_rate / self.frequency
+
+    def start(self, k):
+        """First sample of segment k."""
+        return int(round((self.skip + k) * self.period()))
+
+    def total_samples(self):
+        """Samples a recording needs for every segment."""
+        return self.start(self.n_segments - 1) + self.length
+
+    def segments(self, recording):
+        """(segments, samples) view of the segments of a recording, when
+        the period is a whole number of samples, else a copy."""
+        period = self.period()
+        count = min(self.n_segments, self.available(len(recording)))
+        if period == int(period):
+            first = self.start(0)
+            return recording[first:first + count * self.length].reshape(count, self.length)
+        return np.stack([recording[self.start(k):self.start(k) + self.length] for k in range(count)])
+
+    def available(self, n):
+        """Complete segments among n samples."""
+        # Estimate the last segment that fits, then correct it with start()
+        # itself, as starts are rounded and may fall either side of k * period
+        k = max(int((n - self.length) / self.period() - self.skip), -1)
+        while self.start(k + 1) + self.length <= n:
+            k += 1
+        while k >= 0 and self.start(k) + self.length > n:
+            k -= 1
+        return k + 1
+
+    def update(self, recording):
+        """
+        Fold every complete segment of recording not seen yet into the
+        averages.
+
+        Parameters
+        ----------
+        recording : structured ndarray
+            Every sample received so far.
+
+        Returns
+        -------
+        bool, True once converged (tolerance reached).
+
+        """
+        if self.length is None:
+            raise ValueError("segment_averager needs a sample_rate")
+        available = min(self.n_segments, self.available(len(recording)))
+        x = np.empty((self.length, len(self.fields)), dtype=accumulator_dtype)
+        while self.count < available and not self.converged:
+            first = self.start(self.count)
+            segment = recording[first:first + self.length]
+            for i, field in enumerate(self.fields):
+                x[:, i] = segment[field]
+            # Welford's update, one pass
+            self.count += 1
+            delta = x - self.running_mean
+            self.running_mean += delta / self.count
+            self.m2 += delta * (x - self.running_mean)
+            self.test()
+        return self.converged
+
+    def test(self):
+        if self.tolerance is None or self.count < max(self.min_segments, 2):
+            return
+        i = self.fields.index(self.field)
+        rms = np.sqrt(np.mean(self.running_mean[:, i] ** 2))
+        self.statistic = np.sqrt(np.mean(self.m2[:, i])
+                                 / (self.count - 1) / self.count) / max(rms, 1.0)
+        if self.statistic < self.tolerance:
+            self.converged = True
+
+    # =========================================================================
+    # Results, in counts
+    # =========================================================================
+    def mean(self, field='in1'):
+        """Average segment."""
+        return self.running_mean[:, self.fields.index(field)]
+
+    def variance(self, field='in1'):
+        """Variance between segments, per sample."""
+        if self.count < 2:
+            return np.full(self.length, np.nan)
+        return self.m2[:, self.fields.index(field)] / (self.count - 1)
+
+    def standard_error(self, field='in1'):
+        """Standard error of the average, per sample."""
+        return np.sqrt(self.variance(field) / self.count)
+
+    def snr(self, field='in1'):
+        """RMS of the average over RMS of its standard error."""
+        noise = np.sqrt(np.mean(self.standard_error(field) ** 2))
+        return np.sqrt(np.mean(self.mean(field) ** 2)) / noise if noise else np.inf
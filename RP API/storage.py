@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+storage.py
+
+Compressed binary storage for recordings (.rpz).
+
+ADC data is band-limited and mostly uses a small part of the int16 range, so
+consecutive samples differ by little. Each channel is delta encoded (int16,
+wrapping, so it is exactly reversible), then byte shuffled (all low bytes,
+then all high bytes, so the mostly constant high bytes compress to almost
+nothing), then compressed with the fastest codec available:
+
+    zstd    stdlib compression.zstd (Python 3.14+), or the zstandard package
+    lz4     the lz4 package
+    zlib    stdlib, always available (level 1)
+
+The recording is split into chunks of chunk_samples, each filtered and
+compressed on its own, so any range can be read by decoding only the chunks
+it covers, and chunks are compressed and decompressed in parallel threads
+(the codecs release the GIL).
+
+File layout (little endian):
+
+    b"RPZ1", uint32 header length, header (JSON: dtype, samples,
+    chunk_samples, codec, filter, metadata string)
+    chunk 0, chunk 1, ...
+    index: uint64 (offset, length) per chunk
+    uint64 index offset, b"RPZ1"
+
+e.g.
+
+save_rpz("Data/run.rpz", recording, metadata=header_text)
+with rpz_file("Data/run.rpz") as stored:
+    window = stored.read(100000, 200000)            # decodes two chunks
+recording, metadata = load_rpz("Data/run.rpz")
+
+@author: cca78
+"""
+import os
+import json
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from dtype_policy import block_samples
+
+_magic = b"RPZ1"
+
+# Codecs by name: (compress(bytes, level), decompress(bytes)). Optional
+# packages are used when installed.
+codecs = {"zlib": (lambda data, level: zlib.compress(data, 1 if level is None else level),
+                   zlib.decompress)}
+
+try:
+    from compression import zstd as _zstd
+    codecs["zstd"] = (lambda data, level: _zstd.compress(data, level=level or 1), _zstd.decompress)
+except ImportError:
+    try:
+        import zstandard as _zstandard
+        # Decompressor objects aren't thread safe, so one per call
+        codecs["zstd"] = (lambda data, level: _zstandard.ZstdCompressor(level=level or 1).compress(data),
+                          lambda data: _zstandard.ZstdDecompressor().decompress(data))
+    except ImportError:
+        pass
+
+try:
+    import lz4.frame as _lz4
+    codecs["lz4"] = (lambda data, level: _lz4.compress(data, compression_level=level or 0), _lz4.decompress)
+except ImportError:
+    pass
+
+# First available is the default
+default_codec = next(name for name in ("zstd", "lz4", "zlib") if name in codecs)
+
+filters = ("none", "delta", "delta+shuffle")
+
+
+def _workers():
+    return min(8, os.cpu_count() or 1)
+
+
+# =============================================================================
+# Filters
+# =============================================================================
+def encode_chunk(chunk, filter, compress, level):
+    """Filter each field of a structured chunk and compress them together."""
+    planes = []
+    for name in chunk.dtype.names:
+        x = chunk[name]
+        if filter != "none":
+            delta = np.empty(len(x), dtype=x.dtype)
+            delta[0] = x[0]
+            np.subtract(x[1:], x[:-1], out=delta[1:])      # wraps, reversibly
+            x = delta
+        if filter == "delta+shuffle":
+            # Low bytes of every sample, then high bytes
+            x = x.view(np.uint8).reshape(-1, x.itemsize).T
+        planes.append(np.ascontiguousarray(x).tobytes())
+    return compress(b"".join(planes), level)
+
+
+def decode_chunk(payload, dtype, n, filter, decompress):
+    """Inverse of encode_chunk, returning n samples of dtype."""
+    raw = decompress(payload)
+    chunk = np.empty(n, dtype=dtype)
+    position = 0
+    for name in dtype.names:
+        field_dtype = dtype[name]
+        size = n * field_dtype.itemsize
+        plane = np.frombuffer(raw, dtype=np.uint8, count=size, offset=position)
+        position += size
+        if filter == "delta+shuffle":
+            # Interleave the byte planes back into samples
+            x = np.empty(n, dtype=field_dtype)
+            columns = x.view(np.uint8).reshape(n, field_dtype.itemsize)
+            for byte in range(field_dtype.itemsize):
+                columns[:, byte] = plane[byte * n:(byte + 1) * n]
+        else:
+            x = plane.view(field_dtype)
+        if filter != "none":
+            np.cumsum(x, dtype=field_dtype, out=chunk[name])
+        else:
+            chunk[name] = x
+    return chunk
+
+
+# =============================================================================
+# Writing
+# =============================================================================
+def write_rpz(file, data, codec=None, level=None, filter="delta+shuffle",
+              chunk_samples=block_samples, metadata="", workers=None):
+    """
+    Write a structured recording to an open binary file. Also a writer.py
+    format (format="rpz").
+
+    Parameters
+    ----------
+    file : binary file object
+    data : structured ndarray
+        e.g. in1, in2, out1, out2 int16 counts.
+    codec : str, optional
+        Key of codecs. The default is None, meaning default_codec.
+    level : int, optional
+        Codec level. The default is None, each codec's fastest useful level.
+    filter : 'none', 'delta' or 'delta+shuffle', optional
+        The default is 'delta+shuffle'.
+    chunk_samples : int, optional
+        Samples per independently decodable chunk. The default is
+        dtype_policy.block_samples.
+    metadata : str, optional
+        Stored in the header, e.g. the csv header text. The default is "".
+    workers : int, optional
+        Compression threads. The default is None, meaning up to 8.
+
+    Returns
+    -------
+    None.
+
+    """
+    codec = codec or default_codec
+    if filter not in filters:
+        raise ValueError("'filter' must be one of {}".format(filters))
+    compress = codecs[codec][0]
+    header = json.dumps({"dtype": [[name, data.dtype[name].str] for name in data.dtype.names],
+                         "samples": len(data),
+                         "chunk_samples": int(chunk_samples),
+                         "codec": codec,
+                         "filter": filter,
+                         "metadata": metadata}).encode()
+    file.write(_magic + struct.pack("<I", len(header)) + header)
+    position = len(_magic) + 4 + len(header)
+
+    starts = range(0, len(data), chunk_samples)
+    index = []
+    with ThreadPoolExecutor(workers or _workers()) as pool:
+        # map keeps chunk order; results are written as they complete in order
+        payloads = pool.map(lambda start: encode_chunk(data[start:start + chunk_samples], filter, compress, level),
+                            starts)
+        for payload in payloads:
+            file.write(payload)
+            index.append((position, len(payload)))
+            position += len(payload)
+
+    file.write(np.array(index, dtype="<u8").reshape(-1, 2).tobytes())
+    file.write(struct.pack("<Q", position) + _magic)
+
+
+def save_rpz(path, data, **options):
+    """write_rpz to path. Returns the number of bytes written."""
+    with open(path, "wb") as file:
+        write_rpz(file, data, **options)
+        return file.tell()
+
+
+# =============================================================================
+# Reading
+# =============================================================================
+class rpz_file(object):
+    """
+    Random access reader for .rpz files. Only the header and chunk index are
+    read on opening.
+
+    init arguments:
+        path: .rpz file
+        workers: decompression threads. The default is None, meaning up
+            to 8.
+    """
+
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers or _workers()
+        self.file = open(path, "rb")
+        if self.file.read(4) != _magic:
+            raise ValueError("{} is not an .rpz file".format(path))
+        header_length, = struct.unpack("<I", self.file.read(4))
+        header = json.loads(self.file.read(header_length))
+        self.dtype = np.dtype([(name, dtype) for name, dtype in header["dtype"]])
+        self.samples = header["samples"]
+        self.chunk_samples = header["chunk_samples"]
+        self.codec = header["codec"]
+        self.filter = header["filter"]
+        self.metadata = header["metadata"]
+        if self.codec not in codecs:
+            raise ImportError("{} was compressed with {}, which is not installed".format(path, self.codec))
+        self.decompress = codecs[self.codec][1]
+
+        self.file.seek(-12, os.SEEK_END)
+        index_offset, = struct.unpack("<Q", self.file.read(8))
+        if self.file.read(4) != _magic:
+            raise ValueError("{} is truncated (no chunk index)".format(path))
+        n_chunks = -(-self.samples // self.chunk_samples)
+        self.file.seek(index_offset)
+        self.index = np.frombuffer(self.file.read(16 * n_chunks), dtype="<u8").reshape(-1, 2)
+
+    def __len__(self):
+        return self.samples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def chunk_payloads(self, first, last):
+        """Compressed bytes of chunks first to last - 1, in one read."""
+        start = int(self.index[first, 0])
+        end = int(self.index[last - 1, 0] + self.index[last - 1, 1])
+        self.file.seek(start)
+        block = self.file.read(end - start)
+        return [block[int(offset) - start:int(offset + length) - start]
+                for offset, length in self.index[first:last]]
+
+    def read(self, start=0, stop=None):
+        """
+        Samples start to stop - 1, decoding only the chunks they fall in.
+
+        Returns
+        -------
+        structured ndarray.
+
+        """
+        stop = self.samples if stop is None else min(int(stop), self.samples)
+        start = max(0, int(start))
+        out = np.empty(max(stop - start, 0), dtype=self.dtype)
+        if stop <= start:
+            return out
+        first = start // self.chunk_samples
+        last = -(-stop // self.chunk_samples)
+        payloads = self.chunk_payloads(first, last)
+        sizes = [min(self.chunk_samples, self.samples - k * self.chunk_samples) for k in range(first, last)]
+
+        def decode(k):
+            chunk = decode_chunk(payloads[k], self.dtype, sizes[k], self.filter, self.decompress)
+            chunk_start = (first + k) * self.chunk_samples
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + sizes[k])
+            out[lo - start:hi - start] = chunk[lo - chunk_start:hi - chunk_start]
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(decode, range(last - first)))
+        return out
+
+
+def load_rpz(path, workers=None):
+    """Whole recording and its metadata string from an .rpz file."""
+    with rpz_file(path, workers) as stored:
+        return stored.read(), stored.metadata
@@ -0,0 +1,588 @@
+# -*- coding: utf-8 -*-
+"""
+sweep_planner.py
+
+Plans parameter-grid sweeps: every combination of values over any CH1, CH2,
+CBC and system settings, checked up front and put in an order that keeps
+settling time and config churn down.
+
+Axes are named as catalog columns, <config>_<key>, with sweepable parameters
+named without _start (e.g. CBC_frequency, CH1_linear_amplitude, CH2_mode),
+plus 'duration', which sets every duration as RP.set_duration() does. A
+point sets each sweepable parameter as a fixed value (_stop 0, _sweep
+False), and a mode axis resets the channel's unused parameters as
+RP.choose_channel_mode() does, before the point's other values are set
+(values for parameters the point's mode doesn't use are left cleared).
+
+Every axis value is checked once against the config limits when the plan is
+made, and every failure is reported together, so a sweep never stops
+partway through on a bad value. Points with identical settings are dropped.
+
+Orders:
+    'grid'          itertools.product order, the first axis outermost
+    'serpentine'    the most expensive axes to change outermost, and each
+                    inner axis reversed on alternate passes, so every step
+                    changes one value by one grid step
+    'hysteresis'    as serpentine, but the innermost (sweep_axis) is swept
+                    up and then back down at each outer point, measuring
+                    both branches of a hysteretic response in one plan
+
+hardware_ramps() finds runs of consecutive points which step one sweepable
+parameter evenly, with nothing else changing, and turns each into a single
+recording over which the FPGA ramps the parameter (the start/interval
+encoding of mem_mapping.interval_if_sweep). The ramp runs from half a step
+before the first value to half a step past the last, taking one point's
+duration per point, so the k-th equal segment of the recording is centred
+on the k-th value. Runs are split where a recording would exceed the
+longest allowed. A ramp is quasi-static only if each point's duration is
+long against the rig's settling time, the condition for stepped points
+too.
+
+Costs come from a settling_model: seconds to settle after a jump, growing
+with the size of the jump across an axis's range, plus a larger cost for
+changing a mode (or any other categorical setting), which reconfigures the
+output. Each point carries its settle time, which RP.run_sweep() waits
+before recording.
+
+The plan is compact: the validated values of each axis, and an array of
+small integer indices into them per point. Settings and snapshots are built
+one point at a time as the plan is streamed.
+
+e.g.
+
+plan = RP.plan_sweep(order="serpentine",
+                     CBC_reference_amplitude=[0.05, 0.1, 0.2],
+                     CBC_frequency=np.linspace(94e3, 101e3, 71))
+print(len(plan), plan.total_settle())
+for point, recording in RP.run_sweep(plan, savename="backbone"):
+    ...
+
+@author: cca78
+"""
+import logging
+from collections import namedtuple
+import numpy as np
+
+import event_log
+from channel import _modes_params
+from channel_config import channel_config
+from CBC_config import CBC_config
+from system_config import system_config
+from _utils import _sweepable_params, _modes_sweep_params
+
+log = event_log.get_logger("sweep")
+
+orders = ("grid", "serpentine", "hysteresis")
+
+_config_classes = {"CH1": channel_config,
+                   "CH2": channel_config,
+                   "CBC": CBC_config,
+                   "system": system_config}
+
+# Settings which reconfigure an output rather than move it
+_reset_keys = ("mode", "input_channel", "input_order", "polynomial_target", "CBC_enabled",
+               "sampling_rate", "continuous_output")
+
+sweep_point = namedtuple("sweep_point",
+                         ["number",         # position in the plan
+                          "settings",       # {axis name: value}
+                          "snapshot",       # RedPitaya.rp_snapshot
+                          "direction",      # 1, or -1 on a hysteresis down pass
+                          "settle"])        # seconds to wait before recording
+
+# Points first to last of a plan, measured by one recording of snapshot. A
+# single point has axis None; a run has its points' values ramped along
+# axis by the FPGA.
+sweep_batch = namedtuple("sweep_batch", ["first", "last", "axis", "snapshot"])
+
+# Longest recording per sampling rate (see README errata)
+_max_ramp_duration = {"slow": 60.0, "fast": 0.1}
+
+
+def axis_fields(name):
+    """
+    (config, field) pairs an axis name sets.
+
+    e.g.
+    axis_fields("CBC_frequency")
+    >> [("CBC", "frequency_start"), ("CBC", "frequency_stop"), ("CBC", "frequency_sweep")]
+    """
+    if name == "duration":
+        return [(config, "duration") for config in _config_classes]
+    config, _, key = name.partition("_")
+    if config not in _config_classes or not key:
+        raise KeyError("Axis '{}' is not <config>_<key> with config one of {}".format(name, list(_config_classes)))
+    if key in _sweepable_params:
+        fields = [key + "_start", key + "_stop", key + "_sweep"]
+    else:
+        fields = [key]
+    for field in fields:
+        if field not in _config_classes[config]._index:
+            raise KeyError("{} has no key '{}' (axis '{}')".format(config, field, name))
+    return [(config, field) for field in fields]
+
+
+def validate_axes(axes):
+    """
+    Check every value of every axis against the config limits.
+
+    Parameters
+    ----------
+    axes : dict of {axis name: sequence of values}
+
+    Returns
+    -------
+    dict of {axis name: tuple of values}, converted as the configs store
+    them (e.g. int to float).
+
+    Raises
+    ------
+    ValueError listing every bad name and value, if any.
+
+    """
+    validated = {}
+    errors = []
+    for name, values in axes.items():
+        try:
+            config, field = axis_fields(name)[0]
+        except KeyError as error:
+            errors.append(str(error.args[0]))
+            continue
+        values = list(values.tolist() if isinstance(values, np.ndarray) else values)
+        if not values:
+            errors.append("Axis '{}' has no values".format(name))
+            continue
+        cls = _config_classes[config]
+        validator = cls._validators[cls._index[field]]
+        checked = []
+        for value in values:
+            try:
+                checked.append(validator(value))
+            except (TypeError, ValueError) as error:
+                errors.append("{} = {!r}: {}".format(name, value, error))
+        validated[name] = tuple(checked)
+    if errors:
+        raise ValueError("{} invalid sweep value(s):\n    {}".format(len(errors), "\n    ".join(errors)))
+    return validated
+
+
+def is_categorical(name, values):
+    return name.partition("_")[2] in _reset_keys or isinstance(values[0], (str, bool))
+
+
+class settling_model(object):
+    """
+    Estimated seconds to wait after moving between two points.
+
+    init arguments:
+        settle: seconds after any change. The default is 0.
+        full_span: extra seconds for a jump across the whole range of a
+            numeric axis, in proportion to the jump. The default is 1.
+        reset: seconds after a change of mode or another categorical
+            setting. The default is 2.
+        axis_spans: {axis name: full_span} for axes which settle more or
+            less slowly than full_span, e.g. {"CBC_frequency": 5}. The
+            default is None.
+    """
+
+    def __init__(self, settle=0.0, full_span=1.0, reset=2.0, axis_spans=None):
+        self.settle = settle
+        self.full_span = full_span
+        self.reset = reset
+        self.axis_spans = axis_spans or {}
+
+    def weights(self, names, values):
+        """Seconds per unit change of each axis, with categorical axes
+        marked as None."""
+        weights = []
+        for name, axis in zip(names, values):
+            if is_categorical(name, axis):
+                weights.append(None)
+            else:
+                span = max(axis) - min(axis)
+                full_span = self.axis_spans.get(name, self.full_span)
+                weights.append(full_span / span if span else 0.0)
+        return weights
+
+    def step_cost(self, name, values):
+        """Average seconds for one step along an axis, in the given order."""
+        weight = self.weights([name], [values])[0]
+        if weight is None:
+            return self.reset
+        if len(values) < 2:
+            return 0.0
+        return weight * float(np.mean(np.abs(np.diff(values))))
+
+    def settle_times(self, names, values, indices):
+        """Settle time before each point of a plan. The first point is
+        treated as a change of everything."""
+        settle = np.full(len(indices), self.settle, dtype=np.float32)
+        if not len(indices):
+            return settle
+        for k, (weight, axis) in enumerate(zip(self.weights(names, values), values)):
+            column = indices[:, k]
+            moved = np.empty(len(column), dtype=bool)
+            moved[0] = True
+            np.not_equal(column[1:], column[:-1], out=moved[1:])
+            if weight is None:
+                settle[moved] += self.reset
+            else:
+                axis = np.asarray(axis, dtype=np.float64)
+                jump = np.abs(np.diff(axis[column], prepend=axis[column[0]]))
+                jump[0] = axis.max() - axis.min()
+                settle += (weight * jump).astype(np.float32)
+        return settle
+
+
+# =============================================================================
+# Orders
+# =============================================================================
+def _grid_indices(shape):
+    grids = np.meshgrid(*[np.arange(n) for n in shape], indexing="ij")
+    return np.stack([grid.ravel() for grid in grids], axis=1)
+
+
+def _serpentine_indices(shape):
+    """Boustrophedon over any number of axes: the whole inner sequence is
+    reversed on every other step of the axis outside it."""
+    indices = np.zeros((1, 0), dtype=np.int64)
+    for n in reversed(shape):
+        passes = [indices if i % 2 == 0 else indices[::-1] for i in range(n)]
+        indices = np.concatenate([np.column_stack((np.full(len(p), i), p)) for i, p in enumerate(passes)])
+    return indices
+
+
+def _hysteresis_indices(shape):
+    """Serpentine over the outer axes, the last axis up then down at each."""
+    n = shape[-1]
+    sweep = np.concatenate((np.arange(n), np.arange(n - 2, -1, -1)))
+    direction = np.concatenate((np.ones(n, dtype=np.int8), -np.ones(max(n - 1, 0), dtype=np.int8)))
+    outer = _serpentine_indices(shape[:-1])
+    indices = np.column_stack((np.repeat(outer, len(sweep), axis=0), np.tile(sweep, len(outer))))
+    return indices, np.tile(direction, len(outer))
+
+
+class sweep_plan(object):
+    """
+    Ordered sweep points over a base snapshot. Made by plan_sweep(); iterate
+    over it for sweep_point tuples.
+
+    Attributes:
+        names: axis names, outermost first
+        values: validated values of each axis
+        indices: (points, axes) array of indices into values
+        direction: 1 per point, or -1 on a hysteresis down pass
+        settle: estimated seconds to settle before each point
+        base: snapshot the points are applied to
+        order: 'grid', 'serpentine' or 'hysteresis'
+    """
+
+    def __init__(self, base, names, values, indices, direction, settle, order):
+        self.base = base
+        self.names = tuple(names)
+        self.values = tuple(values)
+        self.indices = indices
+        self.direction = direction
+        self.settle = settle
+        self.order = order
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self.point(number)
+
+    def settings(self, number):
+        """{axis name: value} of a point."""
+        return {name: values[i] for name, values, i in zip(self.names, self.values, self.indices[number])}
+
+    def point(self, number):
+        settings = self.settings(number)
+        return sweep_point(number, settings, apply_settings(self.base, settings),
+                           int(self.direction[number]), float(self.settle[number]))
+
+    def total_settle(self):
+        """Estimated seconds spent settling over the whole plan."""
+        return float(self.settle.sum(dtype=np.float64))
+
+    def __repr__(self):
+        return "<sweep_plan {} points, {} order over {}, {:.1f} s settling>".format(
+            len(self), self.order, ", ".join(self.names), self.total_settle())
+
+
+def apply_settings(base, settings):
+    """
+    Snapshot of base with a point's settings applied, mode axes first.
+
+    Parameters
+    ----------
+    base : RedPitaya.rp_snapshot
+    settings : dict of {axis name: value}, already validated
+
+    Returns
+    -------
+    rp_snapshot.
+
+    """
+    records = {config: _config_classes[config].thaw(frozen) for config, frozen in zip(_config_classes, base)}
+    names = sorted(settings, key=lambda name: not name.endswith("_mode"))
+    for name in names:
+        value = settings[name]
+        fields = axis_fields(name)
+        if name.endswith("_mode") and name[:3] in ("CH1", "CH2"):
+            # As channel.set_mode: reset what the new mode doesn't use
+            record = records[name[:3]]
+            record["mode"] = value
+            for field in record.keys():
+                if field not in _modes_params[value] and field != "mode":
+                    record.clear_param(field)
+        elif name[:3] + "_mode" in settings and fields[0][1] not in _modes_params[settings[name[:3] + "_mode"]]:
+            # Unused in this point's mode: left cleared, so points which
+            # differ only in it are repeats
+            continue
+        elif len(fields) == 3:
+            config = fields[0][0]
+            records[config][fields[0][1]] = value
+            records[config][fields[1][1]] = type(value)(0)
+            records[config][fields[2][1]] = False
+        else:
+            for config, field in fields:
+                records[config][field] = value
+    return _rebuild(base, records)
+
+
+def _rebuild(base, records):
+    """Snapshot of the same type as base (an rp_snapshot, or a plain tuple
+    as sent to campaign.py workers) from config records."""
+    frozen = [record.freeze() for record in records.values()]
+    return base._make(frozen) if hasattr(base, "_make") else tuple(frozen)
+
+
+def plan_sweep(base, order="serpentine", model=None, axis_order=None, sweep_axis=None, unique=True, **axes):
+    """
+    Plan a sweep over every combination of the axis values.
+
+    Parameters
+    ----------
+    base : RedPitaya.rp_snapshot
+        Settings the points are applied to, e.g. RP.snapshot().
+    order : 'grid', 'serpentine' or 'hysteresis', optional
+        The default is 'serpentine'.
+    model : settling_model, optional
+        The default is None, meaning settling_model().
+    axis_order : list of axis names, optional
+        Outermost first. The default is None, meaning the order given for
+        'grid', and the most expensive axis to step outermost otherwise.
+    sweep_axis : str, optional
+        Innermost axis, swept up and down for 'hysteresis'. The default is
+        None, meaning the cheapest axis to step.
+    unique : bool, optional
+        Drop points with the same settings (and direction) as an earlier
+        one. The default is True.
+    **axes : axis name=sequence of values
+        e.g. CBC_frequency=np.linspace(94e3, 101e3, 71).
+
+    Returns
+    -------
+    sweep_plan.
+
+    """
+    if order not in orders:
+        raise ValueError("'order' must be one of {}".format(orders))
+    if not axes:
+        raise ValueError("No axes given to sweep")
+    model = model or settling_model()
+    validated = validate_axes(axes)
+
+    names = list(validated)
+    if axis_order is not None:
+        if sorted(axis_order) != sorted(names):
+            raise ValueError("'axis_order' must list every axis once: {}".format(names))
+        names = list(axis_order)
+    elif order != "grid":
+        # Stepping the outer axes least, the most expensive go outside
+        names.sort(key=lambda name: -model.step_cost(name, validated[name]))
+    if sweep_axis is not None:
+        if sweep_axis not in names:
+            raise ValueError("'sweep_axis' {} is not an axis".format(sweep_axis))
+        names.remove(sweep_axis)
+        names.append(sweep_axis)
+    values = [validated[name] for name in names]
+    _warn_unused(names, values, base)
+
+    shape = [len(axis) for axis in values]
+    if order == "grid":
+        indices = _grid_indices(shape)
+    elif order == "serpentine":
+        indices = _serpentine_indices(shape)
+    if order == "hysteresis":
+        indices, direction = _hysteresis_indices(shape)
+    else:
+        direction = np.ones(len(indices), dtype=np.int8)
+    indices = indices.astype(np.min_scalar_type(max(shape)))
+
+    plan = sweep_plan(base, names, values, indices, direction, None, order)
+    if unique:
+        seen = set()
+        keep = np.ones(len(indices), dtype=bool)
+        for number in range(len(indices)):
+            key = (apply_settings(base, plan.settings(number)), direction[number])
+            keep[number] = key not in seen
+            seen.add(key)
+        if not keep.all():
+            log.info("%d repeated sweep points dropped", np.count_nonzero(~keep))
+            plan.indices = indices = indices[keep]
+            plan.direction = direction = direction[keep]
+    plan.settle = model.settle_times(names, values, indices)
+    event_log.log_event(log, logging.INFO, "sweep planned", points=len(plan), order=order,
+                        axes=",".join(names), settle=round(plan.total_settle(), 2))
+    return plan
+
+
+def _warn_unused(names, values, base):
+    """Warn about channel axes which no mode in the sweep uses."""
+    for channel in ("CH1", "CH2"):
+        mode_axis = channel + "_mode"
+        modes = values[names.index(mode_axis)] if mode_axis in names else (getattr(base, channel).mode,)
+        for name in names:
+            config, _, key = name.partition("_")
+            if config != channel or name == mode_axis:
+                continue
+            used = {field for mode in modes for field in _modes_params.get(mode, [])}
+            if not any(field in used for _, field in axis_fields(name)):
+                log.warning("%s has no effect in %s mode(s) %s", name, channel, list(modes))
+
+
+# =============================================================================
+# Hardware ramps
+# =============================================================================
+def _ramp_mode(snapshot, name):
+    """Mode a point's config must be in for the FPGA to ramp axis name, or
+    None if it can't."""
+    config, _, key = name.partition("_")
+    if key not in _sweepable_params:
+        return None
+    if config == "CBC":
+        return "CBC" if snapshot.CBC.CBC_enabled else None
+    if config not in ("CH1", "CH2"):
+        return None
+    mode = getattr(snapshot, config).mode
+    if key in _modes_sweep_params.get(mode, ()):
+        return mode
+    if mode == "fixed_frequency" and key == "frequency":
+        # frequency_sweep uses the same parameters, plus the sweep
+        return "frequency_sweep"
+    return None
+
+
+def ramp_snapshot(snapshot, name, first_value, last_value, points):
+    """
+    Snapshot of a point with axis name ramped over points values, from
+    half a step before first_value to half a step past last_value, and
+    every duration set to points times the point's duration.
+
+    Returns
+    -------
+    rp_snapshot, or None if the ramp would leave the config limits.
+
+    """
+    mode = _ramp_mode(snapshot, name)
+    config = name.partition("_")[0]
+    key = name.partition("_")[2]
+    half_step = (last_value - first_value) / (points - 1) / 2
+    start, stop = first_value - half_step, last_value + half_step
+    if isinstance(first_value, int):
+        start, stop = int(round(start)), int(round(stop))
+    duration = snapshot.system.duration * points
+    records = {cfg: _config_classes[cfg].thaw(frozen) for cfg, frozen in zip(_config_classes, snapshot)}
+    try:
+        record = records[config]
+        if config != "CBC":
+            record["mode"] = mode
+        record[key + "_start"] = start
+        record[key + "_stop"] = stop
+        record[key + "_sweep"] = True
+        for cfg in records:
+            records[cfg]["duration"] = duration
+    except (TypeError, ValueError):
+        return None
+    return _rebuild(snapshot, records)
+
+
+def _is_run_step(plan, number, axis, value_step):
+    """Whether point number follows number - 1 by value_step along axis,
+    one grid step, with nothing else changing."""
+    step = plan.indices[number].astype(np.int64) - plan.indices[number - 1]
+    if np.count_nonzero(step) != 1 or abs(step[axis]) != 1:
+        return False
+    if plan.direction[number] != plan.direction[number - 1]:
+        return False
+    values = plan.values[axis]
+    this = values[plan.indices[number, axis]] - values[plan.indices[number - 1, axis]]
+    return bool(np.isclose(this, value_step, rtol=1e-6, atol=0))
+
+
+def hardware_ramps(plan, min_points=3, max_duration=None):
+    """
+    Group a plan's points into recordings, ramping runs of evenly stepped
+    points in hardware. See module docstring.
+
+    Parameters
+    ----------
+    plan : sweep_plan
+    min_points : int, optional
+        Shortest run worth a ramp, at least 2. The default is 3.
+    max_duration : float, optional
+        Longest ramp recording in seconds. The default is None, meaning 60
+        s in slow mode and 0.1 s in fast mode.
+
+    Returns
+    -------
+    list of sweep_batch, covering every point in order.
+
+    """
+    batches = []
+    number = 0
+    while number < len(plan):
+        start = plan.point(number)
+        end = number
+        axis = None
+        if number + 1 < len(plan):
+            step = plan.indices[number + 1].astype(np.int64) - plan.indices[number]
+            moved = np.flatnonzero(step)
+            # Only numeric axes can ramp
+            if len(moved) == 1 and not is_categorical(plan.names[moved[0]], plan.values[moved[0]]):
+                axis = int(moved[0])
+                values = plan.values[axis]
+                value_step = values[plan.indices[number + 1, axis]] - values[plan.indices[number, axis]]
+                while end + 1 < len(plan) and _is_run_step(plan, end + 1, axis, value_step):
+                    end += 1
+        name = plan.names[axis] if axis is not None else None
+        limit = max_duration or _max_ramp_duration[start.snapshot.system.sampling_rate]
+        longest = int(limit / start.snapshot.system.duration) if start.snapshot.system.duration else 0
+        end = min(end, number + longest - 1)
+        snapshot = None
+        if (name is not None and end - number + 1 >= max(min_points, 2)
+                and _ramp_mode(start.snapshot, name) is not None):
+            values = plan.values[axis]
+            snapshot = ramp_snapshot(start.snapshot, name, values[plan.indices[number, axis]],
+                                     values[plan.indices[end, axis]], end - number + 1)
+        if snapshot is None:
+            batches.append(sweep_batch(number, number, None, start.snapshot))
+            number += 1
+        else:
+            batches.append(sweep_batch(number, end, name, snapshot))
+            number = end + 1
+    ramps = sum(batch.axis is not None for batch in batches)
+    event_log.log_event(log, logging.INFO, "sweep ramps", points=len(plan), recordings=len(batches),
+                        ramps=ramps)
+    return batches
+
+
+def split_ramp(recording, points):
+    """The equal segments of a ramp recording, one per point (views, not
+    copies). Samples left over from uneven division are dropped from the
+    end."""
+    length = len(recording) // points
+    return [recording[k * length:(k + 1) * length] for k in range(points)]
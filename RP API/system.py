@@ -14,7 +14,9 @@ from FPGA_config import FPGA_config
 from RP_communications import RP_communications
 from re import match
 import traceback
-import logging
+import event_log
+
+log = event_log.get_logger("system")
 
 _default_init = {"continuous_output": False,
             "ip_address": "192.168.1.3",
@@ -56,7 +58,7 @@ class system:
         self.config["duration"] = duration
     
         
-    def send_settings_to_FPGA(self):
+    def send_settings_to_FPGA(self, packed=None):
         """
         This function acts only as an intermediate medium to call RP.comms.send_settings_to_FPGA()
         
@@ -65,9 +67,9 @@ class system:
         None.
         """
         
-        self.comms.send_settings_to_FPGA()
+        self.comms.send_settings_to_FPGA(packed)
        
-    def trigger_record(self, shared_memory_name):       
+    def trigger_record(self, shared_memory_name, should_stop=None):       
         """
         This function acts only as an intermediate medium to call RP.comms.recording_process()
         
@@ -78,11 +80,11 @@ class system:
         
         self.comms.trigger = 1
         self.comms.send_settings_to_FPGA()     
-        logging.debug("{} to receive".format(self.comms.bytes_to_receive))  
+        log.debug("%d to receive", self.comms.bytes_to_receive)
 
-        self.comms.recording_process(shared_memory_name=shared_memory_name)
+        self.comms.recording_process(shared_memory_name=shared_memory_name, should_stop=should_stop)
 
         self.comms.trigger = 0
         self.comms.send_settings_to_FPGA()     
-        logging.debug("Trigger off sent")
+        log.debug("Trigger off sent")
         
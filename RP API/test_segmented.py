@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Checks segment_averager takes every segment of a recording of
+total_samples(), including when the period is a fractional number of samples.
+
+    python -m pytest test_segmented.py
+
+@author: cca78
+"""
+import numpy as np
+
+from segmented import segment_averager
+
+_dtype = np.dtype([('in1', np.int16), ('in2', np.int16), ('out1', np.int16), ('out2', np.int16)])
+
+
+def test_every_segment_at_total_samples():
+    for frequency in (37, 1000, 61.7):
+        for cycles in (1, 3, 7):
+            for skip in (0, 1, 2):
+                averager = segment_averager(50, frequency=frequency, cycles=cycles, skip=skip,
+                                            sample_rate=1000 if frequency < 100 else 4999)
+                assert averager.period() != int(averager.period())
+                n = averager.total_samples()
+                assert averager.available(n) == averager.n_segments
+                assert averager.available(n - 1) == averager.n_segments - 1
+                averager.update(np.zeros(n, dtype=_dtype))
+                assert averager.count == averager.n_segments
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+writer.py
+
+Background writer for recordings, so saving never holds up acquisition or a
+GUI event loop.
+
+submit() queues a recording and returns immediately. A writer thread takes
+recordings off the queue in order, writes each in the requested format, and
+fsyncs files in batches (when the queue runs dry, or every fsync_batch
+files) rather than one by one. The queue is bounded by count and by bytes:
+submit() only blocks when it is full, i.e. when the disk really is falling
+behind acquisition, and the time spent blocked is counted in stats().
+
+Formats are functions of (file, data, **options) writing to an open binary
+file, looked up by name in formats. Add one with register_format().
+
+e.g.
+
+from writer import get_writer
+writer = get_writer()
+writer.submit("Data/run.csv", recording, format="csv", fmt="%d", delimiter=";")
+...
+writer.flush()          # wait until everything queued is on disk
+print(writer.stats())
+
+@author: cca78
+"""
+import os
+import atexit
+import logging
+import threading
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+import event_log
+
+log = event_log.get_logger("writer")
+
+
+def write_csv(file, data, **options):
+    """np.savetxt, e.g. with fmt, delimiter and header options. A structured
+    recording is written one column per field."""
+    if data.dtype.names:
+        data = np.transpose([data[name] for name in data.dtype.names])
+    np.savetxt(file, data, **options)
+
+
+def write_npy(file, data, **options):
+    """numpy .npy, readable with np.load (memory-mappable)."""
+    np.save(file, data, allow_pickle=False)
+
+
+def write_rpz(file, data, **options):
+    """Compressed, chunked binary (see storage.py), e.g. with a metadata
+    option holding the csv header text."""
+    from storage import write_rpz
+    write_rpz(file, data, **options)
+
+
+formats = {"csv": write_csv,
+           "npy": write_npy,
+           "rpz": write_rpz}
+
+
+def register_format(name, function):
+    """Make function(file, data, **options) available as format=name."""
+    formats[name] = function
+
+
+class recording_writer(object):
+    """
+    Writer thread fed by a bounded queue. See module docstring.
+
+    init arguments:
+        max_queue: most recordings waiting to be written. The default is 16.
+        max_pending_bytes: most bytes of recordings waiting. A single
+            recording larger than this is still accepted once the queue is
+            empty. The default is 512 MB.
+        fsync_batch: fsync after this many files even if more are queued. 0
+            leaves syncing to the operating system. The default is 8.
+    """
+
+    def __init__(self, max_queue=16, max_pending_bytes=512 * 1024 * 1024, fsync_batch=8):
+        self.max_queue = max_queue
+        self.max_pending_bytes = max_pending_bytes
+        self.fsync_batch = fsync_batch
+
+        self.jobs = deque()
+        self.pending_bytes = 0
+        self.busy = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.files_written = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.errors = []
+
+        self.thread = threading.Thread(target=self.run, name="recording_writer", daemon=True)
+        self.thread.start()
+
+    # =========================================================================
+    # Producer side
+    # =========================================================================
+    def submit(self, path, data, format="csv", on_done=None, **options):
+        """
+        Queue data to be written to path. Blocks only while the queue is
+        full.
+
+        Parameters
+        ----------
+        path : str
+            File to write. Replaced if it exists, and removed if the write
+            fails.
+        data : ndarray
+            Not copied, so it must not be modified after submitting.
+        format : str, optional
+            Key of formats. The default is "csv".
+        on_done : callable(path), optional
+            Called from the writer thread once the file is written (before
+            it is fsynced). The default is None.
+        **options
+            Passed to the format function.
+
+        Returns
+        -------
+        None.
+
+        """
+        if format not in formats:
+            raise KeyError("No writer format '{}', registered formats are {}".format(format, list(formats)))
+        if format == "rpz":
+            # Raise ImportError here rather than on the writer thread if
+            # storage.py isn't on the path
+            import storage
+        n_bytes = data.nbytes
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("recording_writer is closed")
+            if self.full(n_bytes):
+                event_log.log_event(log, logging.INFO, "writer backpressure",
+                                    depth=len(self.jobs), pending_bytes=self.pending_bytes)
+                start = perf_counter()
+                while self.full(n_bytes):
+                    self.condition.wait()
+                self.blocked_seconds += perf_counter() - start
+            self.jobs.append((path, data, format, on_done, options))
+            self.pending_bytes += n_bytes
+            self.max_depth = max(self.max_depth, len(self.jobs))
+            self.condition.notify_all()
+
+    def full(self, n_bytes):
+        if not self.jobs:
+            return False
+        return (len(self.jobs) >= self.max_queue
+                or self.pending_bytes + n_bytes > self.max_pending_bytes)
+
+    def flush(self, timeout=None):
+        """Wait until every queued recording is written and synced. Returns
+        False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.jobs and not self.busy, timeout)
+
+    def close(self):
+        """Write what is queued, then stop the thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        """Queue depth, bytes waiting, totals written, throughput (bytes/s
+        while writing) and time producers spent blocked."""
+        with self.condition:
+            return {"queue_depth": len(self.jobs),
+                    "max_depth": self.max_depth,
+                    "pending_bytes": self.pending_bytes,
+                    "files_written": self.files_written,
+                    "bytes_written": self.bytes_written,
+                    "throughput": self.bytes_written / self.write_seconds if self.write_seconds else 0.0,
+                    "blocked_seconds": self.blocked_seconds,
+                    "errors": len(self.errors)}
+
+    # =========================================================================
+    # Writer thread
+    # =========================================================================
+    def run(self):
+        unsynced = []
+        while True:
+            with self.condition:
+                if not self.jobs and unsynced:
+                    # Queue has run dry: sync the batch before sleeping
+                    job = None
+                else:
+                    self.busy = False
+                    self.condition.notify_all()
+                    while not self.jobs and not self.closed:
+                        self.condition.wait()
+                    if not self.jobs:
+                        return
+                    job = self.jobs[0]
+                self.busy = True
+
+            if job is None:
+                self.sync(unsynced)
+                continue
+
+            path, data, format, on_done, options = job
+            file = None
+            written = False
+            try:
+                start = perf_counter()
+                file = open(path, "wb")
+                formats[format](file, data, **options)
+                file.flush()
+                elapsed = perf_counter() - start
+                size = file.tell()
+                unsynced.append(file)
+                written = True
+                event_log.log_event(log, logging.DEBUG, "written", path=path, bytes=size,
+                                    seconds=round(elapsed, 4))
+                if on_done is not None:
+                    on_done(path)
+            except Exception as error:
+                log.exception("Could not write %s", path)
+                self.errors.append((path, error))
+                if file is not None and not written:
+                    file.close()
+                # Don't leave a partial file, or the empty one a caller
+                # created to reserve the name
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size = 0
+                elapsed = 0.0
+
+            with self.condition:
+                self.jobs.popleft()
+                self.pending_bytes -= data.nbytes
+                self.files_written += written
+                self.bytes_written += size
+                self.write_seconds += elapsed
+                self.condition.notify_all()
+
+            if self.fsync_batch and len(unsynced) >= self.fsync_batch:
+                self.sync(unsynced)
+
+    def sync(self, files):
+        """fsync (if enabled) and close written files."""
+        for file in files:
+            try:
+                if self.fsync_batch:
+                    os.fsync(file.fileno())
+            except OSError:
+                log.exception("Could not fsync %s", file.name)
+            finally:
+                file.close()
+        files.clear()
+
+
+_writer = None
+_writer_pid = None
+
+
+def get_writer():
+    """The writer shared by this process, started on first use and
+    flushed at exit."""
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        _writer = recording_writer()
+        _writer_pid = os.getpid()
+        atexit.register(_writer.close)
+    return _writer